@@ -0,0 +1,84 @@
+"""Formats of the delivered and intermediate alignments
+
+`output_format` is the format of the alignments delivered to `output_dir` (`{sample}_chained` and the
+realigned alignments): `bam`, or `cram` which is compressed against the reference and usually much smaller.
+Later stages (and re-runs) that use a delivered alignment convert a CRAM back to BAM when they import it.
+`intermediate_format` is the format of the alignment shards that only live in the job store and are read
+once: `sam`, `ubam` (uncompressed BAM) or `bam`. The pysam that marginAlign uses can only write BAM at the
+default compression level or uncompressed, so there's no low-level BAM option.
+"""
+from __future__ import print_function
+import uuid
+
+from execution import runTool
+
+ALIGNMENT_EXTENSIONS = {"bam": ".bam", "cram": ".cram"}
+INTERMEDIATE_MODES   = {"sam": "wh", "ubam": "wbu", "bam": "wb"}
+
+
+def intermediateWriteMode(config):
+    """the pysam write mode for intermediate alignments
+    """
+    from toil_lib import require
+
+    require(config["intermediate_format"] in INTERMEDIATE_MODES,
+            "[intermediateWriteMode]intermediate_format must be one of {formats}, got {f}"
+            "".format(formats=", ".join(sorted(INTERMEDIATE_MODES)), f=config["intermediate_format"]))
+    return INTERMEDIATE_MODES[config["intermediate_format"]]
+
+
+def alignmentFilename(config, label):
+    from toil_lib import require
+
+    require(config["output_format"] in ALIGNMENT_EXTENSIONS,
+            "[alignmentFilename]output_format must be bam or cram, got {}".format(config["output_format"]))
+    return "{sample}_{label}{ext}".format(sample=config["sample_label"], label=label,
+                                         ext=ALIGNMENT_EXTENSIONS[config["output_format"]])
+
+
+def samtoolsConvert(parent_job, config, workdir, input_file, to_cram, samtools_image="quay.io/ucsc_cgl/samtools"):
+    # type: (toil.job.Job, dict, str, LocalFile, bool, str) -> LocalFile
+    """converts a BAM to CRAM (or a CRAM to BAM) with samtools, the reference is needed both ways. the
+    output is in `workdir` with the input's name and the new extension
+    """
+    from margin.toil.localFileManager import LocalFile
+
+    reference = LocalFile(workdir=workdir, filename="reference{}.fa".format(uuid.uuid4().hex))
+    parent_job.fileStore.readGlobalFile(config["reference_FileStoreID"], userPath=reference.fullpathGetter())
+    stem      = input_file.filenameGetter().rsplit(".", 1)[0]
+    output    = LocalFile(workdir=workdir, filename=stem + (".cram" if to_cram else ".bam"))
+    runTool(parent_job, config, samtools_image,
+            parameters=["view", "-C" if to_cram else "-b",
+                        "-T", "/data/{}".format(reference.filenameGetter()),
+                        "-o", "/data/{}".format(output.filenameGetter()),
+                        "/data/{}".format(input_file.filenameGetter())],
+            work_dir=(workdir + "/"))
+    return output
+
+
+def deliverAlignment(parent_job, config, local_bam):
+    """delivers the BAM in `local_bam` (a LocalFile named like alignmentFilename with the .bam extension)
+    to `output_dir` in the `output_format`
+    """
+    from margin.toil.localFileManager import deliverOutput
+
+    if config["output_format"] == "cram":
+        local_bam = samtoolsConvert(parent_job, config, parent_job.fileStore.getLocalTempDir(), local_bam,
+                                    to_cram=True)
+    deliverOutput(parent_job, local_bam, config["output_dir"])
+
+
+def importAlignment(parent_job, config, label):
+    """imports `{sample}_{label}` from `output_dir` into the job store, as a BAM whatever it was delivered as
+    """
+    from toil_lib import require
+    from margin.toil.localFileManager import importToJobstore, urlDownloadToLocalFile
+
+    url = config["output_dir"] + alignmentFilename(config, label)
+    if config["output_format"] == "bam":
+        return importToJobstore(parent_job, url)
+    workdir = parent_job.fileStore.getLocalTempDir()
+    cram    = urlDownloadToLocalFile(parent_job, workdir, url, filename=alignmentFilename(config, label))
+    require(cram is not None, "[importAlignment]Couldn't download {}".format(url))
+    return parent_job.fileStore.writeGlobalFile(samtoolsConvert(parent_job, config, workdir, cram,
+                                                                to_cram=False).fullpathGetter())
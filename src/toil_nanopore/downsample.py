@@ -0,0 +1,74 @@
+"""Depth capping for the variant caller
+
+Posterior calculation is linear in the number of reads over a region but the calls saturate well below the
+depths seen over amplicons or the mitochondria, so before a calling shard is aligned its reads are
+downsampled so no position in the shard's region is covered by more than `max_depth` reads. The reads kept
+are chosen by a hash of the read name (and `downsample_seed`) so re-runs keep the same reads.
+"""
+from __future__ import print_function
+import hashlib
+
+from telemetry import addTelemetryCounts
+
+# depth is tracked in bins of this many bases, a read is kept if every bin it touches is under the cap
+DEPTH_BIN_SIZE = 50
+
+
+def readPriority(read_name, seed):
+    # type: (str, int) -> str
+    return hashlib.sha1("%s\0%s" % (seed, read_name)).hexdigest()
+
+
+def depthCappedReads(read_spans, max_depth, region_start=None, region_end=None, bin_size=DEPTH_BIN_SIZE, seed=0):
+    # type: (list<(str, int, int)>, int, int, int, int, int) -> set<int>
+    """`read_spans` are (read_name, reference_start, reference_end), returns the indices of the reads to keep.
+    reads are taken in priority order and kept if the region they cover (clipped to the region, when given)
+    is below `max_depth` everywhere
+    """
+    depth = {}  # bin: reads covering it
+    kept  = set()
+    for i in sorted(xrange(len(read_spans)), key=lambda i: readPriority(read_spans[i][0], seed)):
+        _, start, end = read_spans[i]
+        if region_start is not None:
+            start = max(start, region_start)
+        if region_end is not None:
+            end = min(end, region_end)
+        if end <= start:
+            # doesn't cover the region so it doesn't add to the depth
+            kept.add(i)
+            continue
+        bins = xrange(start // bin_size, ((end - 1) // bin_size) + 1)
+        if all(depth.get(b, 0) < max_depth for b in bins):
+            for b in bins:
+                depth[b] = depth.get(b, 0) + 1
+            kept.add(i)
+    return kept
+
+
+def downsampleAlignmentShard(parent_job, alignment_shard, max_depth, seed=0, write_mode="wh"):
+    """returns an AlignmentShard with at most `max_depth` reads over any position in the shard's region
+    (written with the pysam `write_mode`), the shard is returned as it is if it's already under the cap
+    """
+    import pysam
+    from margin.toil.alignment import AlignmentShard
+
+    sam        = pysam.Samfile(parent_job.fileStore.readGlobalFile(alignment_shard.FileStoreID), 'r')
+    alignments = [aln for aln in sam if not aln.is_unmapped]
+    read_spans = [(aln.query_name, aln.reference_start, aln.reference_end) for aln in alignments]
+    kept       = depthCappedReads(read_spans, max_depth, alignment_shard.start, alignment_shard.end, seed=seed)
+    addTelemetryCounts(downsampled_reads=(len(alignments) - len(kept)))
+    if len(kept) == len(alignments):
+        sam.close()
+        return alignment_shard
+
+    temp_sam  = parent_job.fileStore.getLocalTempFileName()
+    small_sam = pysam.Samfile(temp_sam, write_mode, template=sam)
+    for i in sorted(kept):
+        small_sam.write(alignments[i])
+    small_sam.close()
+    sam.close()
+    parent_job.fileStore.logToMaster("[downsampleAlignmentShard]Kept {kept} of {total} reads in region "
+                                     "{start}-{end}".format(kept=len(kept), total=len(alignments),
+                                                            start=alignment_shard.start, end=alignment_shard.end))
+    return AlignmentShard(start=alignment_shard.start, end=alignment_shard.end,
+                          FileStoreID=parent_job.fileStore.writeGlobalFile(temp_sam))
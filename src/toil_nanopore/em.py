@@ -0,0 +1,299 @@
+"""Expectation maximisation for the base-aligning pair HMM
+
+The batches are sampled here, then a plain training (no band, one starting model, cPecan run with docker) is
+marginAlign's own expectationMaximisationJobFunction. The iterations below are only used when marginAlign's
+can't do the job: its expectation step always runs cPecan through docker_call without the band options (see
+`band_width`), and with `random_start: N` each of the N randomly initialised trainings has to hand back its
+model and likelihood so that the most likely can be kept. marginAlign's normalizeModelJobFunction
+normalises and delivers the model either way.
+"""
+from __future__ import print_function
+import os
+import sys
+import uuid
+import heapq
+import random
+
+from telemetry import instrumentJobFunction, addTelemetryCounts
+from realign import cPecanBandParameters, requireBandSupport
+from resources import predictedResources
+from execution import runTool
+
+DOCKER_DIR = "/data/"
+
+
+@instrumentJobFunction("em")
+def performBaumWelchOnSamJobFunction(job, config, input_samfile_fid):
+    requested = predictedResources(config, "em_prepare", (config, input_samfile_fid),
+                                   disk=int(2.5 * input_samfile_fid.size), memory=(6 * input_samfile_fid.size))
+    job.fileStore.logToMaster("[performBaumWelchOnSamJobFunction]Asking for disk {disk} and "
+                              "memory {mem} for batch prep".format(disk=requested["disk"], mem=requested["memory"]))
+    job.addFollowOnJobFn(prepareBatchesJobFunction, config, input_samfile_fid, **requested)
+
+
+def randomRestarts(config):
+    """number of randomly initialised EM trainings to run, 0 means a single training from the input model
+    (or an equalised one). `random_start: True` is one random start
+    """
+    if config["input_hmm_FileStoreID"] is not None or not config["random_start"]:
+        return 0
+    return int(config["random_start"])
+
+
+def upstreamTraining(config):
+    """True when marginAlign's EM iterations can train the model, see the module docstring
+    """
+    return not cPecanBandParameters(config) and randomRestarts(config) <= 1 and \
+        (config.get("tool_backend") or "docker") == "docker"
+
+
+def startingModel(job, config, randomise=False):
+    """establishes the starting model, uploads it to the FileStore and returns the FileStoreID
+    """
+    from margin.toil.hmm import Hmm
+
+    if config["input_hmm_FileStoreID"] is not None:
+        # load the input model, normalize it, and make a copy that we use as the starting model
+        # this way the input model is not changed
+        local_hmm = job.fileStore.readGlobalFile(config["input_hmm_FileStoreID"])
+        assert(os.path.exists(local_hmm)), "[startingModel]ERROR couldn't find local HMM here {}".format(local_hmm)
+        hmm = Hmm.loadHmm(local_hmm)
+        job.fileStore.logToMaster("[startingModel]Loaded model type {}".format(hmm.modelType))
+        hmm.normalise()
+    else:
+        # no input model was provided, make a blank one
+        assert(config["model_type"] is not None), "[startingModel]ERROR No model or model type provided"
+        job.fileStore.logToMaster("[startingModel]Making model of type {}".format(config["model_type"]))
+        hmm = Hmm(config["model_type"])
+        if randomise:
+            job.fileStore.logToMaster("[startingModel]Using random starting parameters")
+            hmm.randomise()
+        else:
+            job.fileStore.logToMaster("[startingModel]Using equal transition starting parameters")
+            hmm.equalise()
+
+    if config["set_Jukes_Cantor_emissions"] is not None:
+        hmm.setEmissionsToJukesCantor(float(config["set_Jukes_Cantor_emissions"]))
+
+    starting_hmm = job.fileStore.getLocalTempFile()
+    hmm.write(starting_hmm)
+    return job.fileStore.writeGlobalFile(starting_hmm)
+
+
+def weightedReservoirSample(weighted_items, target_weight, rng):
+    # type: (iterable<(object, int)>, int, random.Random) -> list<(int, object)>
+    """one pass weighted reservoir sample (Efraimidis-Spirakis keys, u ** (1 / weight)) that keeps the
+    smallest set of the highest keyed items whose weights add up to at least `target_weight`. memory is
+    bounded by the sample, not the input. returns [(position in the input, item)...] in input order
+    """
+    reservoir    = []  # min-heap of (key, position, weight, item)
+    total_weight = 0
+    for position, (item, weight) in enumerate(weighted_items):
+        if weight <= 0:
+            continue
+        key = rng.random() ** (1.0 / weight)
+        if reservoir and total_weight - reservoir[0][2] >= target_weight and key <= reservoir[0][0]:
+            continue  # wouldn't make it into the sample
+        heapq.heappush(reservoir, (key, position, weight, item))
+        total_weight += weight
+        # drop the lowest keyed items while the rest still reach the target
+        while total_weight - reservoir[0][2] >= target_weight:
+            total_weight -= heapq.heappop(reservoir)[2]
+    return sorted((position, item) for _, position, _, item in reservoir)
+
+
+@instrumentJobFunction("em_prepare")
+def prepareBatchesJobFunction(job, config, input_samfile_fid):
+    """samples `max_sample_alignment_length` aligned bases worth of alignments in one pass (weighted by
+    aligned length, reproducible with `em_seed`), splits them into batches with about
+    `max_alignment_length_per_job` aligned bases and uploads them in exonerate/FASTA format for cPecan
+    """
+    import pysam
+    from sonLib.bioio import fastaWrite
+    from margin.utils import getExonerateCigarFormatString, samIterator
+    from margin.toil.expectationMaximisation import expectationMaximisationJobFunction as upstreamEmJobFunction
+
+    def batch_alignments(sampled_alignments):
+        # [[AlignedSegment...]...]
+        batches           = []
+        alignment_batch   = []
+        cum_alignment_len = 0
+        for _, aR in sampled_alignments:
+            alignment_batch.append(aR)
+            cum_alignment_len += aR.query_alignment_length
+            if cum_alignment_len >= config["max_alignment_length_per_job"]:
+                batches.append(alignment_batch)
+                alignment_batch   = []
+                cum_alignment_len = 0
+        if alignment_batch:
+            batches.append(alignment_batch)
+        return batches
+
+    def pack_up(aR_list):
+        cigar_file = job.fileStore.getLocalTempFile()
+        reads_file = job.fileStore.getLocalTempFile()
+        with open(cigar_file, "w") as cigar_handle, open(reads_file, "w") as reads_handle:
+            for aR in aR_list:
+                cigar_handle.write(getExonerateCigarFormatString(aR, sam) + "\n")
+                fastaWrite(reads_handle, aR.query_name, aR.seq)
+        return job.fileStore.writeGlobalFile(cigar_file), job.fileStore.writeGlobalFile(reads_file)
+
+    assert(config["max_sample_alignment_length"] > 0), "[prepareBatchesJobFunction]ERROR max alignment length " \
+                                                       "to sample <= 0"
+    sam     = pysam.Samfile(job.fileStore.readGlobalFile(input_samfile_fid), 'r')
+    sampled = weightedReservoirSample(((aR, aR.query_alignment_length) for aR in samIterator(sam)),
+                                      config["max_sample_alignment_length"], random.Random(config["em_seed"]))
+    assert(len(sampled) >= 1), "[prepareBatchesJobFunction]ERROR no alignments to sample"
+    batches    = batch_alignments(sampled)
+    batch_fids = [pack_up(batch) for batch in batches]
+    sam.close()
+    job.fileStore.logToMaster("[prepareBatchesJobFunction]Sampled {total} alignment bases from {n} alignments "
+                              "split into {batches} batches"
+                              "".format(total=sum(aR.query_alignment_length for _, aR in sampled), n=len(sampled),
+                                        batches=len(batches)))
+
+    restarts = randomRestarts(config)
+    if restarts <= 1:
+        random.seed(config["em_seed"])
+        starting_model_fid = startingModel(job, config, randomise=(restarts == 1))
+        if upstreamTraining(config):
+            # update_band (never implemented upstream) isn't one of our options any more
+            job.addFollowOnJobFn(upstreamEmJobFunction, dict(config, update_band=False), starting_model_fid,
+                                 batch_fids)
+        else:
+            job.addFollowOnJobFn(expectationMaximisationJobFunction, config, starting_model_fid, batch_fids)
+        return
+
+    # train from `restarts` random starting models in parallel on the same batches, keep the best
+    job.fileStore.logToMaster("[prepareBatchesJobFunction]Training {} randomly initialised models".format(restarts))
+    trained_models = []
+    for restart in xrange(restarts):
+        random.seed((config["em_seed"], restart))  # the random starting models are reproducible too
+        trained_models.append(job.addChildJobFn(expectationMaximisationJobFunction, config,
+                                                startingModel(job, config, randomise=True), batch_fids,
+                                                restart=restart).rv())
+    job.addFollowOnJobFn(selectBestModelJobFunction, config, trained_models)
+
+
+def expectationMaximisationJobFunction(job, config, working_model_fid, batch_fids,
+                                       running_likelihood=None, iteration=0, restart=None):
+    """one EM iteration per call. when training one of the random restarts (`restart` is its number) the
+    final job returns (trained model FileStoreID, final likelihood) instead of normalising and delivering
+    the model
+    """
+    from margin.toil.expectationMaximisation import normalizeModelJobFunction
+
+    if running_likelihood is None:
+        running_likelihood = []
+
+    if iteration < config["em_iterations"]:
+        job.fileStore.logToMaster("[expectationMaximisationJobFunction]At iteration {}".format(iteration))
+        expectations_fids = [job.addChildJobFn(getExpectationsJobFunction, batch, config, working_model_fid).rv()
+                             for batch in batch_fids]
+        return job.addFollowOnJobFn(maximizationJobFunction, config, expectations_fids, working_model_fid,
+                                    batch_fids, running_likelihood, iteration, restart).rv()
+
+    job.fileStore.logToMaster("[expectationMaximisationJobFunction]Performed %s iterations" % iteration)
+    trained_model_path = job.fileStore.readGlobalFile(working_model_fid, mutable=True)
+    assert(os.path.exists(trained_model_path)), "[expectationMaximisationJobFunction]ERROR getting local "\
+                                                "copy of the trained model"
+    # add the likelihoods to the bottom
+    with open(trained_model_path, 'a') as fH:
+        fH.write("\t".join(map(str, running_likelihood)) + "\n")
+
+    # upload the final, trained but unnormalized, model to the FileStore
+    trained_model_fid = job.fileStore.writeGlobalFile(trained_model_path)
+    job.fileStore.deleteGlobalFile(working_model_fid)
+    if restart is not None:
+        final_likelihood = running_likelihood[-1] if running_likelihood else None
+        job.fileStore.logToMaster("[expectationMaximisationJobFunction]Restart {r} finished with likelihood {l}"
+                                  "".format(r=restart, l=final_likelihood))
+        return trained_model_fid, final_likelihood
+    config["unnormalized_model_FileStoreID"] = trained_model_fid
+    job.addFollowOnJobFn(normalizeModelJobFunction, config)
+
+
+def selectBestModelJobFunction(job, config, trained_models):
+    """keeps the random restart with the best final likelihood, normalises and delivers it
+    """
+    from margin.toil.expectationMaximisation import normalizeModelJobFunction
+
+    best_fid, best_likelihood = max(trained_models, key=lambda model: model[1])
+    for fid, _ in trained_models:
+        if fid != best_fid:
+            job.fileStore.deleteGlobalFile(fid)
+    job.fileStore.logToMaster("[selectBestModelJobFunction]Best of {n} random restarts has likelihood {l}, "
+                              "others {others}".format(n=len(trained_models), l=best_likelihood,
+                                                       others=sorted(l for _, l in trained_models)))
+    addTelemetryCounts(em_restarts=len(trained_models))
+    config["unnormalized_model_FileStoreID"] = best_fid
+    job.addFollowOnJobFn(normalizeModelJobFunction, config)
+
+
+@instrumentJobFunction("em_expectations")
+def getExpectationsJobFunction(job, batch_fid, config, working_model_fid,
+                               cPecan_image="quay.io/artrand/cpecanrealign"):
+    """runs the cPecan container to collect expectations for a batch of alignments, returns the FileStoreID
+    of the expectations file
+    """
+    from margin.toil.localFileManager import LocalFileManager, LocalFile
+
+    requireBandSupport(job, config, cPecan_image)
+    assert(len(batch_fid) == 2), "[getExpectationsJobFunction]illegal batch_fid input"
+    cigar_fid, reads_fid = batch_fid
+    local_files          = LocalFileManager(job=job, fileIds_to_get=[cigar_fid, reads_fid,
+                                                                     config["reference_FileStoreID"],
+                                                                     working_model_fid])
+    expectations_file    = LocalFile(workdir=local_files.workDir(),
+                                     filename="expectations.{}.expectations".format(uuid.uuid4().hex))
+
+    cPecan_params = [
+        "--em",
+        "--aln_file={}".format(DOCKER_DIR + local_files.localFileName(cigar_fid)),
+        "--reference={}".format(DOCKER_DIR + local_files.localFileName(config["reference_FileStoreID"])),
+        "--query={}".format(DOCKER_DIR + local_files.localFileName(reads_fid)),
+        "--hmm_file={}".format(DOCKER_DIR + local_files.localFileName(working_model_fid)),
+        "--expectations={}".format(DOCKER_DIR + expectations_file.filenameGetter()),
+    ] + cPecanBandParameters(config)
+    runTool(job, config, cPecan_image, parameters=cPecan_params, work_dir=local_files.workDir(), outfile=sys.stdout)
+
+    assert(os.path.exists(expectations_file.fullpathGetter())), "[getExpectationsJobFunction]Didn't find "\
+        "expectations file here {}".format(expectations_file.fullpathGetter())
+    return job.fileStore.writeGlobalFile(expectations_file.fullpathGetter())
+
+
+@instrumentJobFunction("em_maximization")
+def maximizationJobFunction(job, config, expectations_fids, working_model_fid, aln_batch_fids,
+                            running_likelihood, iteration, restart=None):
+    from toil_lib import require
+    from margin.toil.hmm import Hmm
+    from margin.toil.localFileManager import LocalFileManager
+
+    require(len(expectations_fids) > 0, "[maximizationJobFunction]Didn't get any expectations FileStoreIDs")
+
+    local_files = LocalFileManager(job, expectations_fids + [working_model_fid])
+    hmm         = Hmm.loadHmm(local_files.localFilePath(expectations_fids[0]))
+    for fid in expectations_fids[1:]:  # add them up and normalize
+        hmm.addExpectationsFile(local_files.localFilePath(fid))
+    hmm.normalise()
+
+    if config["debug"]:
+        job.fileStore.logToMaster("[maximizationJobFunction]On %i iteration got likelihood: %s for model-type: %s"
+                                  % (iteration, hmm.likelihood, hmm.modelType))
+        job.fileStore.logToMaster("[maximizationJobFunction]On %i iteration got transitions: %s"
+                                  % (iteration, " ".join(map(str, hmm.transitions))))
+
+    running_likelihood.append(hmm.likelihood)
+
+    if config["train_emissions"]:
+        hmm.tieEmissions()
+    else:
+        hmm.emissions = Hmm.loadHmm(local_files.localFilePath(working_model_fid)).emissions
+
+    # write the new model
+    new_model = job.fileStore.getLocalTempFileName()
+    hmm.write(new_model)
+    new_model_fid = job.fileStore.writeGlobalFile(new_model)
+    job.fileStore.deleteGlobalFile(working_model_fid)
+    return job.addFollowOnJobFn(expectationMaximisationJobFunction, config, new_model_fid, aln_batch_fids,
+                                running_likelihood, (iteration + 1), restart).rv()
@@ -0,0 +1,289 @@
+"""Evaluating variant calls against a truth set, for `toil-nanopore evaluate`
+
+The calls (a VCF) and the truth (a VCF, or a TSV like tests/mutations.txt: contig, 0-based position, alt
+base, ref base) are compared with a streaming merge, one contig at a time, so memory doesn't grow with the
+number of variants. Each file is scanned once for the offset of each contig's block of records, a file whose
+records for a contig aren't together, or aren't in position order within it, has to be sorted first
+(e.g. `bcftools sort`, or `sort -k1,1 -k2,2n` for the TSV). A variant matches when the contig, position and
+alt allele match, multi-allelic records are split into one variant per alt allele.
+
+The counts (true positives, false positives, false negatives) are kept by stratum and variant type. Every
+variant is in the `all` stratum, and in each named BED stratum (e.g. homopolymers=hp.bed) that covers it.
+Contigs can be evaluated on several processes, or split into shards on different machines whose count files
+are combined afterwards.
+"""
+from __future__ import print_function
+import gzip
+import json
+from collections import namedtuple
+
+from targets import parseBed, overlapsTargets
+
+Variant = namedtuple("Variant", ["contig", "pos", "ref", "alt"])  # pos is 1-based, as in VCF
+
+ALL_STRATUM   = "all"
+VARIANT_TYPES = ("snv", "insertion", "deletion", "complex")
+
+
+def variantType(variant):
+    if len(variant.ref) == len(variant.alt) == 1:
+        return "snv"
+    if len(variant.alt) > len(variant.ref) and variant.alt.startswith(variant.ref):
+        return "insertion"
+    if len(variant.ref) > len(variant.alt) and variant.ref.startswith(variant.alt):
+        return "deletion"
+    return "complex"
+
+
+def _open(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "r")
+
+
+def isVcf(path):
+    return path.endswith((".vcf", ".vcf.gz"))
+
+
+def parseVcfLine(line, pass_only=False):
+    """the variants in a VCF record, one per alt allele. none for reference-only and symbolic alleles, or
+    for filtered records with `pass_only`
+    """
+    fields = line.rstrip("\n").split("\t")
+    contig, pos, ref, alts = fields[0], int(fields[1]), fields[3].upper(), fields[4]
+    if pass_only and len(fields) > 6 and fields[6] not in ("PASS", "."):
+        return []
+    return [Variant(contig, pos, ref, alt.upper()) for alt in alts.split(",")
+            if alt not in (".", "*") and not alt.startswith("<")]
+
+
+def parseTsvLine(line, pass_only=False):
+    """a line of a mutations.txt style truth set: contig, 0-based position, alt base and (optionally) ref base
+    """
+    fields = line.split()
+    ref    = fields[3].upper() if len(fields) > 3 else "N"
+    return [Variant(fields[0], int(fields[1]) + 1, ref, fields[2].upper())]
+
+
+class VariantFile(object):
+    """a VCF or truth TSV, with the offset of each contig's records so they can be read one contig at a time
+    """
+    def __init__(self, path, pass_only=False):
+        from toil_lib import require
+
+        self.path       = path
+        self.pass_only  = pass_only
+        self.parse_line = parseVcfLine if isVcf(path) else parseTsvLine
+        self.offsets    = {}  # contig -> offset of its first record
+        self.contigs    = []  # in the order they're in the file
+        with _open(path) as fH:
+            last_contig, last_pos = None, None
+            while True:
+                offset = fH.tell()
+                line   = fH.readline()
+                if not line:
+                    break
+                if not line.strip() or line.startswith("#"):
+                    continue
+                fields = line.split(None, 2)
+                contig = fields[0]
+                pos    = int(fields[1])
+                if contig != last_contig:
+                    require(contig not in self.offsets, "[VariantFile]The records for {contig} in {path} aren't "
+                            "together, it needs sorting".format(contig=contig, path=path))
+                    self.offsets[contig] = offset
+                    self.contigs.append(contig)
+                else:
+                    require(pos >= last_pos, "[VariantFile]{path} isn't sorted by position at {contig}:{pos}"
+                                             "".format(path=path, contig=contig, pos=pos))
+                last_contig, last_pos = contig, pos
+
+    def variants(self, contig, start=None, end=None):
+        """the variants on `contig` in position order, only those with 1-based positions in [start, end)
+        when they're given
+        """
+        if contig not in self.offsets:
+            return
+        with _open(self.path) as fH:
+            fH.seek(self.offsets[contig])
+            while True:
+                line = fH.readline()
+                if not line:
+                    return
+                if not line.strip() or line.startswith("#"):
+                    continue
+                if line.split(None, 1)[0] != contig:  # the end of the contig's block
+                    return
+                for variant in self.parse_line(line, self.pass_only):
+                    if start is not None and variant.pos < start:
+                        continue
+                    if end is not None and variant.pos >= end:
+                        return
+                    yield variant
+
+
+def _atPosition(variants):
+    """groups a position-sorted stream of variants into (pos, {alt: Variant})
+    """
+    pos, alleles = None, {}
+    for variant in variants:
+        if variant.pos != pos:
+            if pos is not None:
+                yield pos, alleles
+            pos, alleles = variant.pos, {}
+        alleles[variant.alt] = variant
+    if pos is not None:
+        yield pos, alleles
+
+
+def _count(counts, strata, variant, outcome):
+    for stratum in [ALL_STRATUM] + [name for name, intervals in strata
+                                    if overlapsTargets(intervals, variant.contig, variant.pos - 1,
+                                                       variant.pos - 1 + len(variant.ref))]:
+        by_type = counts.setdefault(stratum, {})
+        cells   = by_type.setdefault(variantType(variant), {"tp": 0, "fp": 0, "fn": 0})
+        cells[outcome] += 1
+
+
+def compareContig(calls, truth, strata, counts, contig, start=None, end=None):
+    """merges the calls and the truth on a contig (or the [start, end) part of it), adding to `counts`
+    """
+    call_positions  = _atPosition(calls.variants(contig, start, end))
+    truth_positions = _atPosition(truth.variants(contig, start, end))
+    call, true      = next(call_positions, None), next(truth_positions, None)
+    while call is not None or true is not None:
+        if true is None or (call is not None and call[0] < true[0]):
+            for variant in call[1].values():
+                _count(counts, strata, variant, "fp")
+            call = next(call_positions, None)
+        elif call is None or true[0] < call[0]:
+            for variant in true[1].values():
+                _count(counts, strata, variant, "fn")
+            true = next(truth_positions, None)
+        else:
+            for alt, variant in call[1].items():
+                _count(counts, strata, true[1].get(alt, variant), "tp" if alt in true[1] else "fp")
+            for alt, variant in true[1].items():
+                if alt not in call[1]:
+                    _count(counts, strata, variant, "fn")
+            call, true = next(call_positions, None), next(truth_positions, None)
+    return counts
+
+
+def combineCounts(all_counts):
+    combined = {}
+    for counts in all_counts:
+        for stratum, by_type in counts.items():
+            for vtype, cells in by_type.items():
+                total = combined.setdefault(stratum, {}).setdefault(vtype, {"tp": 0, "fp": 0, "fn": 0})
+                for outcome, n in cells.items():
+                    total[outcome] += n
+    return combined
+
+
+def loadStrata(strata_args):
+    # type: (list<str>) -> list<(str, dict<str, list<(int, int)>>)>
+    """the `name=path.bed` strata
+    """
+    from toil_lib import require
+
+    strata = []
+    for arg in strata_args or []:
+        name, _, path = arg.partition("=")
+        require(name and path, "[loadStrata]Strata are given as name=path.bed, got {}".format(arg))
+        with open(path, "r") as fH:
+            strata.append((name, parseBed(fH)))
+    return strata
+
+
+def parseRegion(region):
+    """`contig` or `contig:start-end` (1-based, inclusive like samtools) to (contig, start, end) with end
+    exclusive
+    """
+    contig, _, span = region.partition(":")
+    if not span:
+        return contig, None, None
+    start, _, end = span.replace(",", "").partition("-")
+    return contig, int(start), (int(end) + 1 if end else None)
+
+
+def shardContigs(contigs, shard, shards):
+    """the contigs for shard `shard` (0-based) of `shards`, contigs are dealt out in name order
+    """
+    return [contig for i, contig in enumerate(sorted(contigs)) if i % shards == shard]
+
+
+_worker_strata = None  # the strata in a worker process, loaded once by _initWorker
+
+
+def _initWorker(strata_args):
+    global _worker_strata
+    _worker_strata = loadStrata(strata_args)
+
+
+def _evaluateRegion(args):
+    calls, truth, (contig, start, end) = args
+    return compareContig(calls, truth, _worker_strata, {}, contig, start, end)
+
+
+def evaluateCalls(calls_path, truth_path, strata_args=None, regions=None, shard=0, shards=1, processes=1,
+                  pass_only=False):
+    """the counts for the calls against the truth, over `regions` (or the contigs of this shard). with
+    `processes` > 1 the contigs are compared in parallel
+    """
+    calls = VariantFile(calls_path, pass_only)
+    truth = VariantFile(truth_path)
+    if regions:
+        work = [parseRegion(region) for region in regions]
+    else:
+        work = [(contig, None, None) for contig in shardContigs(set(calls.contigs) | set(truth.contigs),
+                                                                shard, shards)]
+    if processes > 1 and len(work) > 1:  # the VariantFiles go to the workers with their contig offsets
+        from multiprocessing import Pool
+        pool = Pool(processes, initializer=_initWorker, initargs=(strata_args,))
+        try:
+            return combineCounts(pool.map(_evaluateRegion, [(calls, truth, region) for region in work]))
+        finally:
+            pool.close()
+            pool.join()
+    strata = loadStrata(strata_args)
+    counts = {}
+    for contig, start, end in work:
+        compareContig(calls, truth, strata, counts, contig, start, end)
+    return counts
+
+
+def precisionRecall(cells):
+    called    = cells["tp"] + cells["fp"]
+    true      = cells["tp"] + cells["fn"]
+    precision = float(cells["tp"]) / called if called else 0.0
+    recall    = float(cells["tp"]) / true if true else 0.0
+    f1        = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
+
+
+def formatReport(counts):
+    """TSV of the counts, precision, recall and F1 by stratum and variant type, with a total row for each
+    stratum
+    """
+    lines = ["\t".join(["stratum", "type", "tp", "fp", "fn", "precision", "recall", "f1"])]
+    for stratum in sorted(counts, key=lambda s: (s != ALL_STRATUM, s)):
+        by_type = counts[stratum]
+        rows    = [(vtype, by_type[vtype]) for vtype in VARIANT_TYPES if vtype in by_type]
+        rows.append(("total", {outcome: sum(cells[outcome] for cells in by_type.values())
+                               for outcome in ("tp", "fp", "fn")}))
+        for vtype, cells in rows:
+            lines.append("\t".join([stratum, vtype, str(cells["tp"]), str(cells["fp"]), str(cells["fn"])] +
+                                   ["%.4f" % x for x in precisionRecall(cells)]))
+    return "\n".join(lines)
+
+
+def writeCounts(counts, path):
+    with open(path, "w") as fH:
+        json.dump(counts, fH, sort_keys=True, indent=1)
+
+
+def loadCounts(paths):
+    counts = []
+    for path in paths:
+        with open(path, "r") as fH:
+            counts.append(json.load(fH))
+    return combineCounts(counts)
@@ -0,0 +1,171 @@
+"""Running the containerised tools (samtools, bwa, cPecan)
+
+`tool_backend` picks how the tools are run:
+    docker     a fresh container per invocation (toil_lib's docker_call), the default
+    native     the tool's executable from the PATH (samtools and bwa), tools that aren't installed or don't
+               have a native executable fall back to docker
+    container  one long-lived container per image on each node, every invocation is a `docker exec` into it.
+               the container mounts `tool_mount_root` (Toil's work directory, the system temp dir when it's
+               blank) at the same path, and exits once nothing has used it for `tool_container_idle` seconds
+The job's work directory is mounted at /data in the docker backend, the other backends rewrite /data/ in the
+parameters to the work directory. Each invocation adds tool_calls and tool_seconds to the job's telemetry.
+"""
+from __future__ import print_function
+import os
+import time
+import json
+import hashlib
+import tempfile
+import threading
+import subprocess
+from distutils.spawn import find_executable
+
+from telemetry import addTelemetryCounts
+
+DOCKER_DIR         = "/data/"
+TOOL_BACKENDS      = ("docker", "native", "container")
+NATIVE_EXECUTABLES = {"quay.io/ucsc_cgl/samtools": "samtools", "quay.io/ucsc_cgl/bwa": "bwa"}
+HEARTBEAT_SECONDS  = 30
+
+_container_lock = threading.Lock()  # the pooled shard jobs run tools from several threads
+_entrypoints    = {}
+
+
+def _nativeParameters(parameters, work_dir):
+    local_dir = os.path.join(work_dir, "")
+    return [p.replace(DOCKER_DIR, local_dir) for p in parameters]
+
+
+def _mountRoot(config):
+    return os.path.realpath(config.get("tool_mount_root") or tempfile.gettempdir())
+
+
+def _containerName(tool, mount_root):
+    return "toil-nanopore-" + hashlib.sha1("{}\0{}".format(tool, mount_root)).hexdigest()[:12]
+
+
+def _heartbeatPath(mount_root, name):
+    return os.path.join(mount_root, ".{}.heartbeat".format(name))
+
+
+def _touch(path):
+    with open(path, "a"):
+        os.utime(path, None)
+
+
+def _containerRunning(name):
+    with open(os.devnull, "w") as null:
+        try:
+            state = subprocess.check_output(["docker", "inspect", "-f", "{{.State.Running}}", name], stderr=null)
+        except subprocess.CalledProcessError:
+            return False
+    return state.strip() == "true"
+
+
+def _entrypoint(tool):
+    """the image's entrypoint, `docker exec` doesn't use it so it's put in front of the parameters
+    """
+    if tool not in _entrypoints:
+        output             = subprocess.check_output(["docker", "inspect", "-f", "{{json .Config.Entrypoint}}", tool])
+        _entrypoints[tool] = json.loads(output) or []
+    return _entrypoints[tool]
+
+
+def _ensureContainer(config, tool):
+    """starts the node's container for `tool` unless it's already running, returns its name
+    """
+    mount_root = _mountRoot(config)
+    name       = _containerName(tool, mount_root)
+    heartbeat  = _heartbeatPath(mount_root, name)
+    with _container_lock:
+        _touch(heartbeat)
+        if _containerRunning(name):
+            return name
+        with open(os.devnull, "w") as null:
+            subprocess.call(["docker", "rm", "-f", name], stdout=null, stderr=null)  # an exited one
+            # the keep-alive loop exits when the heartbeat file hasn't been touched for tool_container_idle
+            keep_alive = ("while [ $(( $(date +%s) - $(stat -c %Y {hb}) )) -lt {idle} ]; do sleep 10; done"
+                          "".format(hb=heartbeat, idle=int(config.get("tool_container_idle") or 600)))
+            started = subprocess.call(["docker", "run", "-d", "--rm", "--log-driver=none", "--name", name,
+                                       "-v", "{root}:{root}".format(root=mount_root),
+                                       "--entrypoint", "sh", tool, "-c", keep_alive], stdout=null, stderr=null)
+        if started != 0 and not _containerRunning(name):  # another worker on the node may have started it
+            raise RuntimeError("[_ensureContainer]Couldn't start a {tool} container".format(tool=tool))
+        return name
+
+
+class _Heartbeat(object):
+    """keeps the container's heartbeat file fresh while a (possibly long) invocation runs
+    """
+    def __init__(self, path):
+        self.path           = path
+        self._stop          = threading.Event()
+        self._thread        = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            _touch(self.path)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+
+def _containerCall(config, tool, parameters, work_dir, outfile):
+    mount_root = _mountRoot(config)
+    name       = _ensureContainer(config, tool)
+    stat       = os.stat(work_dir)
+    command    = (["docker", "exec", "-u", "{}:{}".format(stat.st_uid, stat.st_gid), "-w", work_dir, name] +
+                  _entrypoint(tool) + _nativeParameters(parameters, work_dir))
+    with _Heartbeat(_heartbeatPath(mount_root, name)):
+        try:
+            subprocess.check_call(command, stdout=outfile)
+        except subprocess.CalledProcessError:
+            if _containerRunning(name):  # the tool failed
+                raise
+            # it exited for being idle just before the exec, so nothing ran. start it again and retry once
+            _ensureContainer(config, tool)
+            subprocess.check_call(command, stdout=outfile)
+
+
+def toolBackend(config, tool, work_dir):
+    """the backend that `tool` will actually be run with
+    """
+    from toil_lib import require
+
+    backend = config.get("tool_backend") or "docker"
+    require(backend in TOOL_BACKENDS, "[toolBackend]tool_backend must be one of {backends}, got {b}"
+            "".format(backends=", ".join(TOOL_BACKENDS), b=backend))
+    if backend == "native":
+        executable = NATIVE_EXECUTABLES.get(tool)
+        if executable is None or find_executable(executable) is None:
+            return "docker"
+    if backend == "container" and not os.path.realpath(work_dir).startswith(_mountRoot(config) + os.sep):
+        return "docker"
+    return backend
+
+
+def runTool(job, config, tool, parameters, work_dir, outfile=None):
+    # type: (toil.job.Job, dict, str, list<str>, str, file) -> None
+    """runs the `tool` image's program with `parameters` in `work_dir` using the configured tool_backend, files
+    in the work directory are referred to as /data/<name> whatever the backend. stdout goes to `outfile`
+    """
+    from toil_lib.programs import docker_call
+
+    backend = toolBackend(config, tool, work_dir)
+    start   = time.time()
+    if backend == "native":
+        subprocess.check_call([find_executable(NATIVE_EXECUTABLES[tool])] + _nativeParameters(parameters, work_dir),
+                              cwd=work_dir, stdout=outfile)
+    elif backend == "container":
+        _containerCall(config, tool, parameters, work_dir, outfile)
+    else:
+        docker_call(job=job, tool=tool, parameters=parameters, work_dir=work_dir, outfile=outfile)
+    addTelemetryCounts(tool_calls=1, tool_seconds=(time.time() - start))
+    if backend != (config.get("tool_backend") or "docker"):
+        addTelemetryCounts(tool_fallbacks=1)
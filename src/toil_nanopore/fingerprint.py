@@ -0,0 +1,184 @@
+"""Stage fingerprints for incremental re-runs
+
+A stage's fingerprint is a hash of the content of its inputs (or the fingerprint of the stage that made
+them) and the config options that change its output. When a stage's outputs have been delivered its
+fingerprint is delivered next to them as `{sample}_{stage}.fingerprint`, on the next run any stage whose
+fingerprint in `output_dir` matches is skipped and its outputs are used as they are.
+"""
+from __future__ import print_function
+import os
+import uuid
+import hashlib
+from urlparse import urlparse
+
+# config options that change the output of each kind of stage
+STAGE_CONFIG_KEYS = {
+    "input"        : ["min_read_length", "min_mean_quality", "target_bases"],
+    "chained"      : ["chain", "output_format"],
+    "trainedmodel" : ["model_type", "max_sample_alignment_length", "em_iterations", "random_start", "em_seed",
+                      "set_Jukes_Cantor_emissions", "band_width", "band_trim", "gc_content",
+                      "train_emissions", "max_alignment_length_per_job"],
+    "realigned"    : ["EM", "output_format", "gap_gamma", "match_gamma", "band_width", "band_trim",
+                      "split_alignments_to_this_many", "max_alignment_length_per_job", "max_alignments_per_job",
+                      "cut_batch_at_alignment_this_big", "realign_prefilter", "prefilter_min_length",
+                      "prefilter_min_mapq", "prefilter_min_identity"],
+    "calls"        : ["variant_threshold", "no_margin", "split_chromosome_this_length", "shard_by", "coverage_bin_size",
+                      "max_alignment_length_per_job", "max_alignments_per_job", "cut_batch_at_alignment_this_big", "stats",
+                      "stats_alignment_batch_size", "local_alignment", "max_depth", "downsample_seed"],
+    "stats"        : ["stats_alignment_batch_size", "local_alignment"],
+}
+# the summed expectations that the calls are made from, the threshold is only applied to them afterwards
+STAGE_CONFIG_KEYS["expectations"] = [key for key in STAGE_CONFIG_KEYS["calls"] if key != "variant_threshold"]
+
+
+def remoteMetadata(url):
+    """what identifies the content of an s3:// or http(s):// URL without downloading it: its size and ETag or
+    Last-Modified. None when those can't be had
+    """
+    parsed = urlparse(url)
+    try:
+        if parsed.scheme == "s3":
+            import boto
+            key = boto.connect_s3().get_bucket(parsed.netloc, validate=False).get_key(parsed.path.lstrip("/"))
+            return None if key is None else [str(key.size), key.etag or "", key.last_modified or ""]
+        if parsed.scheme in ("http", "https"):
+            import urllib2
+            request            = urllib2.Request(url)
+            request.get_method = lambda: "HEAD"
+            headers            = urllib2.urlopen(request, timeout=30).info()
+            metadata           = [headers.getheader(h) or "" for h in ("Content-Length", "ETag", "Last-Modified")]
+            return metadata if any(metadata[1:]) else None
+    except Exception:
+        return None
+    return None
+
+
+def inputDigest(url, block_size=(1 << 20)):
+    """hash of the content of a file:// URL, for s3:// and http(s):// URLs (which we can't read without
+    downloading) the URL and its remoteMetadata stand in for the content. an input with neither gets a digest
+    that won't match, so the stages that use it are always redone
+    """
+    if not url:
+        return ""
+    parsed = urlparse(url)
+    if parsed.scheme != "file" or not os.path.exists(parsed.path):
+        metadata = remoteMetadata(url)
+        if metadata is None:
+            return uuid.uuid4().hex
+        return hashlib.sha1("\0".join([url] + metadata)).hexdigest()
+    h = hashlib.sha1()
+    with open(parsed.path, "rb") as fH:
+        for block in iter(lambda: fH.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stageDigest(kind, config, upstream):
+    # type: (str, dict, list<str>) -> str
+    h = hashlib.sha1(kind)
+    for digest in upstream:
+        h.update("\0" + digest)
+    for key in STAGE_CONFIG_KEYS[kind]:
+        h.update("\0%s=%r" % (key, config.get(key)))
+    return h.hexdigest()
+
+
+def computeStageFingerprints(config, sample):
+    """fingerprints for the alignment stages of this sample, the variant calling fingerprints are derived
+    from these with `callsFingerprint`. all fingerprints are None when incremental re-runs are turned off
+    """
+    if not config["incremental"]:
+        return dict.fromkeys(["reference", "targets", "input", "chained", "trainedmodel", "realigned",
+                              "error_model"])
+
+    reference    = inputDigest(config["ref"])
+    input_hmm    = inputDigest(config["hmm_file"])
+    fingerprints = {"reference": reference, "targets": inputDigest(config["target_regions"])}
+
+    fingerprints["input"]        = stageDigest("input", config, [inputDigest(sample.URL), sample.file_type])
+    fingerprints["chained"]      = stageDigest("chained", config, [fingerprints["input"], reference])
+    aligned                      = fingerprints["chained"] if config["chain"] else fingerprints["input"]
+    fingerprints["trainedmodel"] = stageDigest("trainedmodel", config, [aligned, reference, input_hmm])
+    trained_model                = fingerprints["trainedmodel"] if config["EM"] else input_hmm
+    fingerprints["realigned"]    = stageDigest("realigned", config, [aligned, reference, trained_model,
+                                                                     fingerprints["targets"]])
+
+    if config["EM"] and config["realign"]:
+        fingerprints["error_model"] = fingerprints["trainedmodel"]
+    else:
+        fingerprints["error_model"] = inputDigest(config["error_model"])
+    return fingerprints
+
+
+def callsFingerprint(config, alignment, output_label, kind="calls"):
+    """fingerprint for calling variants (and collecting stats) on the `alignment` ("input", "chained" or
+    "realigned") with this config, use kind="stats" when only collecting stats and kind="expectations" for the
+    expectations the calls are made from
+    """
+    if not config["incremental"]:
+        return None
+    fingerprints = config["fingerprints"]
+    return stageDigest(kind, config, [fingerprints[alignment], fingerprints["reference"],
+                                         fingerprints["error_model"], fingerprints["targets"], output_label])
+
+
+def fingerprintFilename(sample_label, stage):
+    return "{sample}_{stage}.fingerprint".format(sample=sample_label, stage=stage)
+
+
+def downloadFromOutput(parent_job, config, filename):
+    """local path of `filename` in output_dir, None if it isn't there (yet)
+    """
+    from margin.toil.localFileManager import urlDownloadToLocalFile
+
+    url = config["output_dir"] + filename
+    if urlparse(url).scheme == "file":
+        path = urlparse(url).path
+        return path if os.path.exists(path) else None
+    local_file = urlDownloadToLocalFile(parent_job, parent_job.fileStore.getLocalTempDir(), url,
+                                        filename=filename, retry_count=1)
+    return local_file.fullpathGetter() if local_file is not None else None
+
+
+def stageComplete(parent_job, config, stage, fingerprint):
+    """True if the fingerprint delivered for `stage` in a previous run matches `fingerprint`
+    """
+    if fingerprint is None:
+        return False
+    local_path = downloadFromOutput(parent_job, config, fingerprintFilename(config["sample_label"], stage))
+    if local_path is None:
+        return False
+    with open(local_path, "r") as fH:
+        complete = fH.readline().strip() == fingerprint
+    if complete:
+        parent_job.fileStore.logToMaster("[stageComplete]Outputs for {stage} are up to date, skipping it"
+                                         "".format(stage=stage))
+    return complete
+
+
+def deliverStageFingerprint(parent_job, config, stage, fingerprint):
+    """call this after a stage's outputs have been delivered
+    """
+    from margin.toil.localFileManager import LocalFile, deliverOutput
+
+    if fingerprint is None:
+        return
+    fingerprint_file = LocalFile(workdir=parent_job.fileStore.getLocalTempDir(),
+                                 filename=fingerprintFilename(config["sample_label"], stage))
+    with open(fingerprint_file.fullpathGetter(), "w") as fH:
+        fH.write(fingerprint + "\n")
+    deliverOutput(parent_job, fingerprint_file, config["output_dir"])
+
+
+def fingerprintedStageJobFunction(job, config, stage, fingerprint, job_function, args, resources=None):
+    """runs `job_function(*args)` as a child and delivers the stage's fingerprint once the child and all of
+    its successors have finished
+    """
+    stage_job = job.addChildJobFn(job_function, *args, **(resources or {}))
+    if fingerprint is not None:
+        job.addFollowOnJobFn(deliverStageFingerprintJobFunction, config, stage, fingerprint)
+    return stage_job.rv()
+
+
+def deliverStageFingerprintJobFunction(job, config, stage, fingerprint):
+    deliverStageFingerprint(job, config, stage, fingerprint)
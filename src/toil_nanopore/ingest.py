@@ -0,0 +1,159 @@
+"""Filtering the reads as they're put in the job store
+
+Nanopore read sets have a long tail of very short and very low quality reads that cost BWA, chaining and
+HMM time but rarely support a call. With the ingestion filter on, the reads of a FASTQ sample are streamed
+into the job store through it, dropping the reads shorter than `min_read_length` and those with a mean base
+quality below `min_mean_quality`. With `target_bases` set only the best of the remaining reads are kept,
+ranked by mean quality, until they add up to about that many bases, which takes a first pass over the reads
+to histogram the qualities. The mean quality is that of the mean error probability of the read's bases
+(as basecallers and Filtlong report it) rather than the mean of the Phred scores, which overstates it.
+The reads and bases dropped by each test are in the `ingest` telemetry counts. BAM samples come with their
+alignment, which needs all of its reads, so they aren't filtered.
+"""
+from __future__ import print_function
+import math
+import gzip
+from itertools import islice
+
+from telemetry import instrumentJobFunction, addTelemetryCounts
+
+PHRED_OFFSET    = 33
+QUALITY_BINS    = 100  # bins per unit of Phred quality in the target_bases histogram
+ERROR_BY_SYMBOL = [10 ** (-(i - PHRED_OFFSET) / 10.0) if i >= PHRED_OFFSET else 1.0 for i in xrange(256)]
+
+
+def ingestFilterOn(config):
+    return bool(config.get("min_read_length") or config.get("min_mean_quality") or config.get("target_bases"))
+
+
+def fastqRecords(handle):
+    """(header, sequence, separator, qualities) for each read in a FASTQ, without the newlines
+    """
+    while True:
+        record = [line.rstrip("\n") for line in islice(handle, 4)]
+        if not record:
+            return
+        if len(record) < 4 or not record[0].startswith("@"):
+            raise RuntimeError("[fastqRecords]Truncated or invalid FASTQ record {}".format(record[:1]))
+        yield record
+
+
+def meanQuality(qualities):
+    """the Phred quality of the mean error probability of the bases
+    """
+    if not qualities:
+        return 0.0
+    mean_error = sum(ERROR_BY_SYMBOL[ord(q)] for q in qualities) / len(qualities)
+    return -10 * math.log10(mean_error) if mean_error > 0 else 100.0
+
+
+class ReadFilter(object):
+    def __init__(self, min_length, min_quality, target_bases):
+        self.min_length   = int(min_length or 0)
+        self.min_quality  = float(min_quality or 0)
+        self.target_bases = int(target_bases or 0)
+        self.histogram    = None   # quality bin -> bases, from the first pass when there's a target
+        self.threshold    = None   # reads in bins above this are kept, in it while there's budget left
+        self.budget       = 0      # bases left to keep from the threshold bin
+        self.counts       = {"ingested_reads": 0, "ingested_bases": 0,
+                             "dropped_short_reads": 0, "dropped_short_bases": 0,
+                             "dropped_quality_reads": 0, "dropped_quality_bases": 0,
+                             "dropped_target_reads": 0, "dropped_target_bases": 0}
+
+    @staticmethod
+    def fromConfig(config):
+        return ReadFilter(config.get("min_read_length"), config.get("min_mean_quality"), config.get("target_bases"))
+
+    def _bin(self, quality):
+        return int(quality * QUALITY_BINS)
+
+    def _test(self, sequence, qualities):
+        """"short" or "quality" for the reads that fail those tests, otherwise the read's quality bin
+        """
+        if len(sequence) < self.min_length:
+            return "short"
+        quality = meanQuality(qualities) if (self.min_quality or self.target_bases) else 0.0
+        if quality < self.min_quality:
+            return "quality"
+        return self._bin(quality)
+
+    def plan(self, records):
+        """the first pass for `target_bases`: finds the quality bin where the best reads add up to the target
+        """
+        if not self.target_bases:
+            return
+        self.histogram = {}
+        for _, sequence, _, qualities in records:
+            result = self._test(sequence, qualities)
+            if not isinstance(result, str):
+                self.histogram[result] = self.histogram.get(result, 0) + len(sequence)
+        total = 0
+        for quality_bin in sorted(self.histogram, reverse=True):
+            if total + self.histogram[quality_bin] >= self.target_bases:
+                self.threshold, self.budget = quality_bin, self.target_bases - total
+                return
+            total += self.histogram[quality_bin]
+        # the reads that pass the other tests don't reach the target, keep them all
+
+    def keep(self, sequence, qualities):
+        result = self._test(sequence, qualities)
+        if result in ("short", "quality"):
+            outcome = result
+        elif self.threshold is None or result > self.threshold:
+            outcome = "ingested"
+        elif result == self.threshold and self.budget > 0:
+            self.budget -= len(sequence)
+            outcome      = "ingested"
+        else:
+            outcome = "target"
+        prefix = "ingested" if outcome == "ingested" else "dropped_" + outcome
+        self.counts[prefix + "_reads"] += 1
+        self.counts[prefix + "_bases"] += len(sequence)
+        return outcome == "ingested"
+
+
+def _openReads(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "r")
+
+
+def filterReads(job, read_filter, path):
+    """streams the reads at `path` through `read_filter` and puts the ones it keeps in the job store, returns
+    the FileStoreID. they're written locally first, the later jobs size their disk requests from the file's
+    size in the job store
+    """
+    if read_filter.target_bases:
+        with _openReads(path) as fH:
+            read_filter.plan(fastqRecords(fH))
+    filtered_path = job.fileStore.getLocalTempFile()
+    with _openReads(path) as fH, open(filtered_path, "w") as out:
+        for record in fastqRecords(fH):
+            if read_filter.keep(record[1], record[3]):
+                out.write("\n".join(record) + "\n")
+    fid = job.fileStore.writeGlobalFile(filtered_path)
+    addTelemetryCounts(**read_filter.counts)
+    job.fileStore.logToMaster("[filterReads]Kept {kept} reads ({bases} bases), dropped {short} short, {quality} "
+                              "low quality and {target} over target_bases"
+                              "".format(kept=read_filter.counts["ingested_reads"],
+                                        bases=read_filter.counts["ingested_bases"],
+                                        short=read_filter.counts["dropped_short_reads"],
+                                        quality=read_filter.counts["dropped_quality_reads"],
+                                        target=read_filter.counts["dropped_target_reads"]))
+    return fid
+
+
+@instrumentJobFunction("ingest")
+def ingestReadsJobFunction(job, read_filter, sample):
+    """puts the reads of a FASTQ sample in the job store through `read_filter` (a ReadFilter), local (file://)
+    samples are read in place, others are downloaded first
+    """
+    from urlparse import urlparse
+    from margin.toil.localFileManager import LocalFile, urlDownload
+
+    parsed = urlparse(sample.URL)
+    if parsed.scheme == "file":
+        path = parsed.path
+    else:
+        local_reads = LocalFile(workdir=job.fileStore.getLocalTempDir(), filename=parsed.path.split("/")[-1])
+        urlDownload(parent_job=job, source_url=sample.URL, destination_file=local_reads)
+        path = local_reads.fullpathGetter()
+    return filterReads(job, read_filter, path)
@@ -0,0 +1,238 @@
+"""Live runs, aligning and calling FASTQ chunks as the sequencer writes them
+
+`toil-nanopore watch` polls a directory for new FASTQ chunks and runs the pipeline on each new chunk (as its
+own sample, `{label}_{chunk}`). Instead of calling variants on each chunk alone the posterior expectations
+of each chunk's final alignment are added to running totals in `output_dir`, kept per block of
+LIVE_BLOCK_LENGTH bases of a contig (`{label}_live_{contig}_{block}.expectations`) so that a chunk only
+reads and rewrites the totals of the blocks its reads cover, however long the contig. The calls of those
+blocks are remade from their totals and `{label}_live.vcf` from the calls of every block seen so far, so
+there are calls from all of the reads so far after each chunk. Each block's totals list the chunks that are
+in them, so a retried job or a chunk that's run again isn't counted twice.
+"""
+from __future__ import print_function
+import os
+import re
+import time
+import hashlib
+import cPickle
+
+from telemetry import instrumentJobFunction, addTelemetryCounts
+from reference import referenceSliceConfig
+from release import releaseFiles
+from resources import predictedResources
+from fingerprint import downloadFromOutput
+
+WATCH_STATE_FILE  = ".toil-nanopore-watch"
+FASTQ_SUFFIXES    = (".fq", ".fastq")
+LIVE_BLOCK_LENGTH = 1000000  # bases of a contig whose running totals (and calls) are kept in one file
+CHUNK_ATTEMPTS    = 3        # times a failed chunk is run before it's left until `watch` is restarted
+
+
+def newChunks(watch_dir, seen, settle_seconds):
+    # type: (str, set<str>, int) -> list<str>
+    """FASTQs in `watch_dir` that haven't been processed and haven't been written to for `settle_seconds`
+    (so we don't pick up a chunk that's still being written), oldest first
+    """
+    now    = time.time()
+    chunks = []
+    for filename in os.listdir(watch_dir):
+        path = os.path.join(watch_dir, filename)
+        if filename in seen or not filename.endswith(FASTQ_SUFFIXES) or not os.path.isfile(path):
+            continue
+        if now - os.path.getmtime(path) >= settle_seconds:
+            chunks.append((os.path.getmtime(path), filename))
+    return [filename for _, filename in sorted(chunks)]
+
+
+def loadWatchState(watch_dir):
+    path = os.path.join(watch_dir, WATCH_STATE_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r") as fH:
+        return set(line.strip() for line in fH if line.strip())
+
+
+def recordChunk(watch_dir, filename):
+    with open(os.path.join(watch_dir, WATCH_STATE_FILE), "a") as fH:
+        fH.write(filename + "\n")
+
+
+def chunkLabel(live_label, filename):
+    stem = filename
+    for suffix in FASTQ_SUFFIXES:
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+    return "{label}_{chunk}".format(label=live_label, chunk=stem)
+
+
+def liveConfig(config, live_label):
+    """the config for a chunk, only the final alignment is made (stats and per-chunk calls are skipped)
+    and its posteriors are added to the running totals. EM is off, training a model per chunk isn't useful
+    """
+    live_config = dict(**config)
+    live_config["live_label"] = live_label
+    live_config["EM"]         = False
+    live_config["stats"]      = False
+    return live_config
+
+
+def contigFilename(contig):
+    """`contig` made safe to use in a filename, a name that had to be changed gets a digest of the original
+    so that two contigs can't end up sharing files
+    """
+    safe = re.sub(r"[^A-Za-z0-9._-]", "_", contig)
+    if safe == contig:
+        return contig
+    return "{safe}-{digest}".format(safe=safe, digest=hashlib.sha1(contig).hexdigest()[:8])
+
+
+def liveBlockFilename(live_label, contig, block, suffix):
+    return "{label}_live_{contig}_{block}.{suffix}".format(label=live_label, contig=contigFilename(contig),
+                                                           block=block, suffix=suffix)
+
+
+def finalAlignmentLabel(config):
+    """label of the chunk's last delivered alignment, the realigned or chained one. None when neither is
+    made, then the input alignment is used
+    """
+    if config["realign"]:
+        return "realigned"
+    if config["chain"]:
+        return "chained"
+    return None
+
+
+@instrumentJobFunction("live_calls")
+def liveCallsJobFunction(job, config, alignment_fid, sharded_alignments):
+    """computes the expectations of each region of the chunk's alignment, then adds them to the totals
+    """
+    from margin.toil.hmm import downloadHmm
+    from marginCallerToil import callerShardJobFunction, alignedPairsJobFunction, marginalizeExpectationsJobFunction
+
+    hidden_markov_model = downloadHmm(job, config)
+    expectation_fids    = []
+    for contig, contig_alns in sharded_alignments:
+        shard_config   = referenceSliceConfig(config, contig)
+        reference_size = shard_config["reference_FileStoreID"].size
+        for aln in contig_alns:
+            disk = alignment_fid.size + reference_size
+            expectation_fids.append(job.addChildJobFn(callerShardJobFunction,
+                                                      shard_config, aln, hidden_markov_model,
+                                                      alignedPairsJobFunction,
+                                                      marginalizeExpectationsJobFunction,
+                                                      batch_disk=disk,
+                                                      followOn_disk=(2 * reference_size),
+                                                      followOn_mem=(6 * aln.FileStoreID.size),
+                                                      **predictedResources(config, "caller_shard",
+                                                                           (shard_config, aln), disk=disk,
+                                                                           memory=(6 * alignment_fid.size))).rv())
+    addTelemetryCounts(issued_caller_shard=len(expectation_fids))
+    job.addFollowOnJobFn(accumulateExpectationsJobFunction, config, expectation_fids)
+
+
+def splitIntoBlocks(positional_expectations, blocks):
+    """adds a shard's {contig: {position: [A, C, G, T]}} to `blocks`, {(contig, block): {position: [...]}}
+    """
+    for contig, expectations in positional_expectations.iteritems():
+        for position, probs in expectations.iteritems():  # the shards' regions don't overlap
+            blocks.setdefault((contig, position // LIVE_BLOCK_LENGTH), {})[position] = probs
+    return blocks
+
+
+def addChunkTotals(block_totals, chunk_label, expectations):
+    """adds a chunk's expectations to a block's running totals ({"chunks": the labels of the chunks in them,
+    "totals": {position: [A, C, G, T]}}), unless they're in them already (a retried job or a re-run chunk).
+    returns True if the totals were changed
+    """
+    if chunk_label in block_totals["chunks"]:
+        return False
+    for position, probs in expectations.iteritems():
+        position_totals = block_totals["totals"].setdefault(position, [0.0, 0.0, 0.0, 0.0])
+        for i, p in enumerate(probs):
+            position_totals[i] += p
+    block_totals["chunks"].add(chunk_label)
+    return True
+
+
+@instrumentJobFunction("live_accumulate")
+def accumulateExpectationsJobFunction(job, config, expectation_fids):
+    """adds the chunk's expectations to the running totals of each block it covers, re-calls those blocks and
+    remakes {label}_live.vcf from the calls for every block seen so far
+    """
+    from margin.toil.localFileManager import LocalFile, deliverOutput
+    from margin.toil.variantCall import makeVcfFromVariantCallsJobFunction2
+    from margin.utils import getFastaDictionary
+    from marginCallerToil import VariantThresholder
+
+    live_label  = config["live_label"]
+    workdir     = job.fileStore.getLocalTempDir()
+    thresholder = VariantThresholder(job, config)
+    index_name  = "{}_live_blocks.txt".format(live_label)
+
+    def deliver(filename, write):
+        local_file = LocalFile(workdir=workdir, filename=filename)
+        with open(local_file.fullpathGetter(), "w") as fH:
+            write(fH)
+        deliverOutput(job, local_file, config["output_dir"])
+        return local_file.fullpathGetter()
+
+    # this chunk's expectations, by (contig, block)
+    chunk_expectations = {}
+    for fid in expectation_fids:
+        with open(job.fileStore.readGlobalFile(fid), "r") as fH:
+            splitIntoBlocks(cPickle.load(fH), chunk_expectations)
+
+    index_path  = downloadFromOutput(job, config, index_name)
+    live_blocks = set()  # {(contig, block)...}
+    if index_path is not None:
+        with open(index_path, "r") as fH:
+            for line in fH:
+                if line.strip():
+                    contig, block = line.rstrip("\n").split("\t")
+                    live_blocks.add((contig, int(block)))
+
+    calls_paths = {}
+    seq_contig  = None  # the contig of contig_seq, the blocks are done in contig order so each is read once
+    contig_seq  = None
+    for (contig, block), expectations in sorted(chunk_expectations.iteritems()):
+        totals_filename = liveBlockFilename(live_label, contig, block, "expectations")
+        totals_path     = downloadFromOutput(job, config, totals_filename)
+        block_totals    = {"chunks": set(), "totals": {}}
+        if totals_path is not None:
+            with open(totals_path, "r") as fH:
+                block_totals = cPickle.load(fH)
+        totals = block_totals["totals"]
+        if addChunkTotals(block_totals, config["sample_label"], expectations):
+            deliver(totals_filename, lambda fH: cPickle.dump(block_totals, fH, cPickle.HIGHEST_PROTOCOL))
+        else:
+            job.fileStore.logToMaster("[accumulateExpectationsJobFunction]Block {b} of {c} already has this "
+                                      "chunk's expectations".format(b=block, c=contig))
+
+        if contig != seq_contig:
+            seq_contig = contig
+            contig_seq = getFastaDictionary(
+                job.fileStore.readGlobalFile(referenceSliceConfig(config, contig)["reference_FileStoreID"]))[contig]
+
+        calls_paths[(contig, block)] = deliver(liveBlockFilename(live_label, contig, block, "calls"),
+                                               lambda fH: thresholder.writeCalls(fH, contig, contig_seq, totals))
+        live_blocks.add((contig, block))
+
+    deliver(index_name, lambda fH: fH.write("".join("{c}\t{b}\n".format(c=contig, b=block)
+                                                    for contig, block in sorted(live_blocks))))
+
+    # the VCF is made from the calls for all of the blocks seen so far, not just this chunk's
+    calls_fids = []
+    for contig, block in sorted(live_blocks):
+        calls_path = calls_paths.get((contig, block)) or \
+            downloadFromOutput(job, config, liveBlockFilename(live_label, contig, block, "calls"))
+        if calls_path is not None and os.path.getsize(calls_path) > 0:
+            calls_fids.append(job.fileStore.writeGlobalFile(calls_path))
+    job.fileStore.logToMaster("[accumulateExpectationsJobFunction]Updated {n} blocks, {t} blocks have calls"
+                              "".format(n=len(chunk_expectations), t=len(calls_fids)))
+    addTelemetryCounts(live_blocks_updated=len(chunk_expectations))
+    if calls_fids:
+        vcf_config                 = dict(**config)
+        vcf_config["sample_label"] = live_label
+        makeVcfFromVariantCallsJobFunction2(job, vcf_config, calls_fids, "live")
+    # only now, a retry of this job reads them again
+    releaseFiles(job, expectation_fids)
@@ -3,15 +3,15 @@
 """
 from __future__ import print_function
 import os
-from argparse import ArgumentParser
-from toil.job import Job
-from toil.common import Toil
+import uuid
 
-from margin.toil.bwa import bwa_docker_alignment_root
-from margin.toil.realign import realignSamFileJobFunction
-from margin.toil.chainAlignment import chainSamFile
-from margin.toil.localFileManager import LocalFile, deliverOutput
-from margin.toil.expectationMaximisation import performBaumWelchOnSamJobFunction
+# n.b. the marginAlign modules are imported in the job functions that use them, keeps worker startup fast
+from telemetry import instrumentJobFunction
+from fingerprint import stageComplete, deliverStageFingerprint, fingerprintedStageJobFunction
+from release import releaseFiles, releaseAfter
+from execution import runTool
+
+BWA_INDEX_SUFFIXES = [".amb", ".ann", ".bwt", ".pac", ".sa"]
 
 
 def baseDirectoryPath():
@@ -25,16 +25,82 @@ def getDefaultHmm():
     return default_model
 
 
+def statsNeedReads(config):
+    """the reads are used by BWA, chaining and stats. stats are collected on the chained alignment whenever
+    it's variant called, as well as when they're asked for
+    """
+    return bool(config["stats"] or (config["caller"] and config["chain"]))
+
+
+@instrumentJobFunction("bwa")
 def bwaAlignJobFunction(job, config):
     # type: (toil.job.Job, dict<string, (string and bool))>
     """Generates a SAM file, chains it (optionally), and realignes with cPecan HMM
     """
-    bwa_alignment_job = job.addChildJobFn(bwa_docker_alignment_root, config)
+    reference_size    = config["reference_FileStoreID"].size
+    bwa_index_job     = job.addChildJobFn(bwaIndexJobFunction, config, disk=(3 * reference_size))
+    bwa_alignment_job = bwa_index_job.addFollowOnJobFn(bwaMemJobFunction, config, bwa_index_job.rv(),
+                                                       disk=(config["sample_FileStoreID"].size +
+                                                             3 * reference_size))
+
+    job.addFollowOnJobFn(chainSamFileJobFunction, config, bwa_alignment_job.rv(), release_input=True)
+
+
+@instrumentJobFunction("bwa_index")
+def bwaIndexJobFunction(job, config, bwa_image="quay.io/ucsc_cgl/bwa"):
+    """indexes the reference, returns {suffix: FileStoreID} for the index files
+    """
+    from margin.toil.localFileManager import LocalFile
+
+    workdir   = job.fileStore.getLocalTempDir()
+    reference = LocalFile(workdir=workdir, filename="ref{}.fa".format(uuid.uuid4().hex))
+    job.fileStore.readGlobalFile(config["reference_FileStoreID"], userPath=reference.fullpathGetter())
+    runTool(job, config, bwa_image, parameters=["index", "/data/{}".format(reference.filenameGetter())],
+            work_dir=(workdir + "/"))
+    return {suffix: job.fileStore.writeGlobalFile(reference.fullpathGetter() + suffix)
+            for suffix in BWA_INDEX_SUFFIXES}
 
-    job.addFollowOnJobFn(chainSamFileJobFunction, config, bwa_alignment_job.rv())
 
+@instrumentJobFunction("bwa_mem")
+def bwaMemJobFunction(job, config, index_fids, bwa_image="quay.io/ucsc_cgl/bwa"):
+    """aligns the reads with `bwa mem -x ont2d`, returns an AlignmentStruct for the SAM. the index files
+    are deleted from the job store afterwards
+    """
+    from toil_lib import require
+    from margin.toil.localFileManager import LocalFile
+    from margin.toil.alignment import AlignmentStruct, AlignmentFormat
+
+    uid       = uuid.uuid4().hex
+    workdir   = job.fileStore.getLocalTempDir()
+    reference = LocalFile(workdir=workdir, filename="ref{}.fa".format(uid))
+    reads     = LocalFile(workdir=workdir, filename="reads{}.fq".format(uid))
+    output    = LocalFile(workdir=workdir, filename="aln{}.sam".format(uid))
+    job.fileStore.readGlobalFile(config["reference_FileStoreID"], userPath=reference.fullpathGetter())
+    job.fileStore.readGlobalFile(config["sample_FileStoreID"], userPath=reads.fullpathGetter())
+    for suffix, fid in index_fids.items():
+        job.fileStore.readGlobalFile(fid, userPath=(reference.fullpathGetter() + suffix))
+
+    with open(output.fullpathGetter(), "w") as fH:
+        runTool(job, config, bwa_image,
+                parameters=["mem", "-x", "ont2d", "/data/{}".format(reference.filenameGetter()),
+                            "/data/{}".format(reads.filenameGetter())],
+                work_dir=(workdir + "/"), outfile=fH)
+    require(os.path.exists(output.fullpathGetter()), "[bwaMemJobFunction]BWA didn't make an alignment")
+    alignment_fid = job.fileStore.writeGlobalFile(output.fullpathGetter())
+    releaseFiles(job, index_fids.values())
+    return AlignmentStruct(alignment_fid, AlignmentFormat.SAM)
+
+
+@instrumentJobFunction("chain")
+def chainSamFileJobFunction(job, config, aln_struct, release_input=False):
+    """chains the alignment and passes it on to realignment. with `release_input` the input alignment (from
+    BWA, nothing else uses it) is deleted from the job store once it's been chained or realigned. the reads
+    are deleted here too unless stats need them
+    """
+    from margin.toil.chainAlignment import chainSamFile
+    from margin.toil.localFileManager import LocalFile
+    from alignment_format import deliverAlignment
 
-def chainSamFileJobFunction(job, config, aln_struct):
     # Cull the files from the job store that we want
     if config["chain"] is None and config["realign"] is None:
         job.fileStore.logToMaster("[chainSamFileJobFunction]Nothing to do.")
@@ -58,19 +124,37 @@ def chainSamFileJobFunction(job, config, aln_struct):
                      referenceFastaFile=reference)
 
         chainedSamFileId = job.fileStore.writeGlobalFile(output_sam.fullpathGetter())
-        deliverOutput(job, output_sam, config["output_dir"])
-        job.addFollowOnJobFn(realignmentRootJobFunction, config, chainedSamFileId)
+        deliverAlignment(job, config, output_sam)
+        deliverStageFingerprint(job, config, "chained", config["fingerprints"]["chained"])
+        if release_input:
+            releaseFiles(job, aln_struct.FileStoreID())
+        # the chained alignment in the job store is used by EM, realignment and calling
+        releaseAfter(job, chainedSamFileId).addChildJobFn(realignmentRootJobFunction, config, chainedSamFileId)
 
     else:
         job.fileStore.logToMaster("[chainSamFileJobFunction]Not chaining SAM, passing alignment "
                                   "on to realignment")
-        job.addFollowOnJobFn(realignmentRootJobFunction, config, aln_struct.FileStoreID())
+        if release_input:
+            releaseAfter(job, aln_struct.FileStoreID()).addChildJobFn(realignmentRootJobFunction, config,
+                                                                      aln_struct.FileStoreID())
+        else:
+            job.addFollowOnJobFn(realignmentRootJobFunction, config, aln_struct.FileStoreID())
+
+    if not statsNeedReads(config):
+        releaseFiles(job, config["sample_FileStoreID"])
 
 
+@instrumentJobFunction("realign_root")
 def realignmentRootJobFunction(job, config, input_samfile_fid):
-    if config["realign"] is None:  # the chained SAM has already been delivered
-        return
-    if config["EM"]:
+    from em import performBaumWelchOnSamJobFunction
+    from realign import realignSamFileJobFunction
+    from marginCallerToil import chainedCallsAlongsideRealignment, chainedCallsJobFunction, addChainedStats
+
+    fingerprints    = config["fingerprints"]
+    realign_pending = config["realign"] is not None and not config["realign_complete"]
+    em_pending      = realign_pending and config["EM"] and \
+        not stageComplete(job, config, "trainedmodel", fingerprints["trainedmodel"])
+    if em_pending:
         # make a child job to perform the EM and generate and import the new model
         job.fileStore.logToMaster("[realignJobFunction]Queueing EM training "
                                   "with SAM file {sam}, read fastq {reads} and reference "
@@ -78,8 +162,24 @@ def realignmentRootJobFunction(job, config, input_samfile_fid):
                                       sam=input_samfile_fid,
                                       reads=config["sample_label"],
                                       reference=config["reference_label"]))
-        job.addChildJobFn(performBaumWelchOnSamJobFunction, config, input_samfile_fid)
+        job.addChildJobFn(fingerprintedStageJobFunction, config, "trainedmodel", fingerprints["trainedmodel"],
+                          performBaumWelchOnSamJobFunction, (config, input_samfile_fid))
+
+    if chainedCallsAlongsideRealignment(config):
+        # the input is the chained alignment. calling it only waits for the error model, which is the
+        # trained one with EM, so it runs alongside realignment. its stats don't wait at all
+        addChainedStats(job, config, lambda: input_samfile_fid)
+        if em_pending:
+            job.addFollowOnJobFn(chainedCallsJobFunction, config, input_samfile_fid)
+        else:
+            job.addChildJobFn(chainedCallsJobFunction, config, input_samfile_fid)
+
+    if config["realign"] is None:  # the chained SAM has already been delivered
+        return
+    if config["realign_complete"]:  # the realigned SAM from a previous run is up to date
+        return
 
     job.fileStore.logToMaster("[realignJobFunction]Queueing up HMM realignment")
     realign_label = "realigned" if config["chain"] else "noChain_realigned"
-    return job.addFollowOnJobFn(realignSamFileJobFunction, config, input_samfile_fid, realign_label).rv()
+    return job.addFollowOnJobFn(fingerprintedStageJobFunction, config, realign_label, fingerprints["realigned"],
+                                realignSamFileJobFunction, (config, input_samfile_fid, realign_label)).rv()
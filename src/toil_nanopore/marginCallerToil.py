@@ -1,42 +1,441 @@
 """JobWrappingJobFunctions for marginCaller
 """
 from __future__ import print_function
+import cPickle
+from collections import OrderedDict
 
-from itertools import chain
+# n.b. the marginAlign modules are imported in the job functions that use them, keeps worker startup fast
+from telemetry import instrumentJobFunction, addTelemetryCounts
+from reference import referenceSliceConfig
+from downsample import downsampleAlignmentShard
+from pool import pooledShardsJobFunction, jobGroups, flattenResults
+from posterior_cache import PosteriorCache, digest, hmmDigest, readKeys
+from release import releaseFiles, releaseAfter
+from alignment_format import intermediateWriteMode
+from resources import predictedResources
+from fingerprint import downloadFromOutput
 
-from margin.toil.shardAlignment import shardSamJobFunction
-from margin.toil.variantCaller import\
-    calculateAlignedPairsJobFunction,\
-    marginalizePosteriorProbsJobFunction
-from margin.toil.variantCall import makeVcfFromVariantCallsJobFunction2
-from margin.toil.stats import collectAlignmentStatsJobFunction
-from margin.toil.hmm import downloadHmm
+BASES = "ACGT"
 
 
-def marginCallerJobFunction(job, config, input_samfile_fid, smaller_alns, output_label):
-    smaller_alns        = chain(*smaller_alns)  # flattens the list of AlignmentShards
-    all_variant_calls   = []
-    hidden_markov_model = downloadHmm(job, config)
+@instrumentJobFunction("caller_shard", job_function_name="shardSamJobFunction")
+def callerShardJobFunction(job, config, alignment_shard, *args, **kwargs):
+    """shardSamJobFunction wrapped so that it's measured (and profiled if requested) like our own jobs, the
+    shard is downsampled to `max_depth` first when that's set
+    """
+    from margin.toil.shardAlignment import shardSamJobFunction
+
+    addTelemetryCounts(shards=1)
+    if not config["max_depth"]:
+        return shardSamJobFunction(job, config, alignment_shard, *args, **kwargs)
+    downsampled = downsampleAlignmentShard(job, alignment_shard, config["max_depth"], config["downsample_seed"],
+                                           intermediateWriteMode(config))
+    result      = shardSamJobFunction(job, config, downsampled, *args, **kwargs)
+    if downsampled is not alignment_shard:  # the batches have been made from it, it isn't read again
+        releaseFiles(job, downsampled.FileStoreID)
+    return result
+
+
+@instrumentJobFunction("caller_batch", job_function_name="calculateAlignedPairsJobFunction")
+def alignedPairsJobFunction(job, global_config, job_config, hmm, batch_number):
+    """calculateAlignedPairsJobFunction, using the posterior cache when `posterior_cache` is on. cPecan sums
+    the posteriors over the batch so a batch is cached as a whole, keyed by all of its reads
+    """
+    from margin.toil.variantCaller import calculateAlignedPairsJobFunction
+
+    addTelemetryCounts(reads=len(job_config["query_sequences"]),
+                       bases=sum(len(seq) for seq in job_config["query_sequences"]))
+    cache = PosteriorCache.fromConfig(global_config)
+    if cache is None:
+        return calculateAlignedPairsJobFunction(job, global_config, job_config, hmm, batch_number)
+
+    key   = digest("aligned_pairs", hmmDigest(job, hmm), global_config["no_margin"], *sorted(readKeys(job_config)))
+    entry = cache.get(key)
+    addTelemetryCounts(posterior_cache_hits=int(entry is not None), posterior_cache_misses=int(entry is None))
+    if entry is not None:
+        posteriors_file = job.fileStore.getLocalTempFile()
+        with open(posteriors_file, "wb") as fH:
+            fH.write(entry)
+        return job.fileStore.writeGlobalFile(posteriors_file)
+
+    posteriors_fid = calculateAlignedPairsJobFunction(job, global_config, job_config, hmm, batch_number)
+    if posteriors_fid is not None:
+        with open(job.fileStore.readGlobalFile(posteriors_fid), "rb") as fH:
+            cache.put(key, fH.read())
+    return posteriors_fid
+
+
+def marginalizeExpectations(job, alignment_shard, cPecan_alignedPairs_fids):
+    """the first half of marginAlign's marginalizePosteriorProbsJobFunction: sums the expectations at each
+    position in the shard's region, returns {contig: {position: [A, C, G, T]}}
+    """
+    positional_expectations = {}
+    for aP_fid in [fid for fid, _ in cPecan_alignedPairs_fids if fid is not None]:
+        with open(job.fileStore.readGlobalFile(aP_fid), "r") as fH:
+            expectations = cPickle.load(fH)
+        for contig in expectations:
+            contig_expectations = positional_expectations.setdefault(contig, {})
+            for position, probs in expectations[contig].iteritems():
+                if alignment_shard.start <= position < alignment_shard.end:
+                    totals = contig_expectations.setdefault(position, [0.0, 0.0, 0.0, 0.0])
+                    for i, p in enumerate(probs):
+                        totals[i] += p
+    releaseFiles(job, [fid for fid, _ in cPecan_alignedPairs_fids])
+    return positional_expectations
+
+
+def writeExpectations(job, positional_expectations):
+    expectations_file = job.fileStore.getLocalTempFile()
+    with open(expectations_file, "w") as fH:
+        cPickle.dump(positional_expectations, fH, cPickle.HIGHEST_PROTOCOL)
+    return job.fileStore.writeGlobalFile(expectations_file)
+
+
+def marginalizeExpectationsJobFunction(job, config, alignment_shard, cPecan_alignedPairs_fids):
+    """returns the FileStoreID of the shard's summed expectations, see marginalizeExpectations
+    """
+    return writeExpectations(job, marginalizeExpectations(job, alignment_shard, cPecan_alignedPairs_fids))
+
+
+class VariantThresholder(object):
+    """the second half of marginalizePosteriorProbsJobFunction: calls the bases whose posterior, given the
+    summed expectations at a position, is at least `variant_threshold`
+    """
+    def __init__(self, job, config):
+        from margin.marginCallerLib import loadHmmSubstitutionMatrix, getNullSubstitutionMatrix
+
+        self.threshold   = config["variant_threshold"]
+        self.error_model = loadHmmSubstitutionMatrix(job.fileStore.readGlobalFile(config["error_model_FileStoreID"]))
+        self.evo_sub_mat = getNullSubstitutionMatrix()
+
+    def writeCalls(self, fH, contig, contig_seq, expectations):
+        from margin.marginCallerLib import calcBasePosteriorProbs
+
+        for position in sorted(expectations):
+            ref_base   = contig_seq[position]
+            total_prob = sum(expectations[position])
+            if total_prob <= 0:
+                continue
+            posterior_probs = calcBasePosteriorProbs(dict(zip(BASES, [float(x) / total_prob
+                                                                      for x in expectations[position]])),
+                                                     ref_base, self.evo_sub_mat, self.error_model)
+            for b in BASES:
+                if b != ref_base.upper() and posterior_probs[b] >= self.threshold:
+                    fH.write("%s\t%s\t%s\t%s\t%s\n" % (contig, position, ref_base, b, posterior_probs[b]))
+
+
+def callsFromExpectations(job, config, positional_expectations):
+    """FileStoreID of the calls file for a shard's expectations, `config` has the shard's reference slice
+    """
+    from margin.utils import getFastaDictionary
+
+    calls_file = job.fileStore.getLocalTempFile()
+    with open(calls_file, "w") as fH:
+        if positional_expectations:
+            thresholder = VariantThresholder(job, config)
+            contig_seqs = getFastaDictionary(job.fileStore.readGlobalFile(config["reference_FileStoreID"]))
+            for contig, expectations in positional_expectations.iteritems():
+                thresholder.writeCalls(fH, contig, contig_seqs[contig], expectations)
+    return job.fileStore.writeGlobalFile(calls_file)
+
+
+def marginalizePosteriorsJobFunction(job, config, alignment_shard, cPecan_alignedPairs_fids):
+    """marginAlign's marginalizePosteriorProbsJobFunction in its two halves, then the batches' posteriors are
+    deleted. returns (FileStoreID of the calls, FileStoreID of the expectations), the expectations are only
+    kept (for makeVcfJobFunction to deliver) when incremental re-runs are on, otherwise they're None
+    """
+    positional_expectations = marginalizeExpectations(job, alignment_shard, cPecan_alignedPairs_fids)
+    calls_fid               = callsFromExpectations(job, config, positional_expectations)
+    if config["expectations_fingerprint"] is None:
+        return calls_fid, None
+    return calls_fid, writeExpectations(job, positional_expectations)
+
+
+def expectationsIndexFilename(config, output_label):
+    return "{sample}_{label}.expectations".format(sample=config["sample_label"], label=output_label)
+
+
+def thresholdExpectationsJobFunction(job, config, output_label):
+    """remakes the calls and the VCF from the expectations delivered by a previous run, for when only
+    `variant_threshold` has changed
+    """
+    from toil_lib import require
+
+    index_path = downloadFromOutput(job, config, expectationsIndexFilename(config, output_label))
+    require(index_path is not None, "[thresholdExpectationsJobFunction]Expectations for {} have not been "
+                                    "delivered".format(output_label))
+    with open(index_path, "r") as fH:
+        filenames = [line.strip() for line in fH if line.strip()]
+    job.fileStore.logToMaster("[thresholdExpectationsJobFunction]Calling {label} from the expectations of {n} "
+                              "shards".format(label=output_label, n=len(filenames)))
+    all_variant_calls = [job.addChildJobFn(thresholdShardJobFunction, config, filename).rv()
+                         for filename in filenames]
+    job.addFollowOnJobFn(makeVcfJobFunction, config, all_variant_calls, output_label)
+
+
+def thresholdShardJobFunction(job, config, filename):
+    from toil_lib import require
+
+    expectations_path = downloadFromOutput(job, config, filename)
+    require(expectations_path is not None, "[thresholdShardJobFunction]Missing {}".format(filename))
+    with open(expectations_path, "r") as fH:
+        positional_expectations = cPickle.load(fH)
+    # a shard is on one contig
+    shard_config = referenceSliceConfig(config, next(iter(positional_expectations))) if positional_expectations \
+        else config
+    return callsFromExpectations(job, shard_config, positional_expectations), None
+
+
+def errorModelUrl(config):
+    """the error model that the variants are called with, the one trained by EM when it's been done
+    """
+    from toil_lib import require
+    from margin.toil.hmm import Hmm
+
+    if config["EM"] is not None and config["realign"] is not None:
+        return Hmm.modelFilename(global_config=config, get_url=True)
+    require(config["error_model"], "[errorModelUrl]Need to provide a error model if not performing EM")
+    return config["error_model"]
+
+
+def realignedCallConfigs(config):
+    """the (config, label)s that the realigned alignment is variant called with, with marginalization and
+    without it
+    """
+    em_label                      = "em" if config["EM"] else ""
+    realign_em_label              = em_label + "Realign" if config["chain"] else em_label + "RealignNoChain"
+    realign_noMargin_label        = em_label + ("RealignNoMargin" if config["chain"] else "RealignNoMarginNoChain")
+    no_margin_config              = dict(**config)
+    no_margin_config["no_margin"] = True
+    no_margin_config["stats"]     = False  # don't need to redo stats
+    return [(config, realign_em_label), (no_margin_config, realign_noMargin_label)]
+
+
+def pendingCalls(job, alignment, labelled_configs):
+    """the (config, label, fingerprint)s of `labelled_configs` whose calls on the `alignment` ("input",
+    "chained" or "realigned") aren't up to date. each config is a copy with the fingerprint of the label's
+    expectations, `expectations_complete` is set when those are up to date (only `variant_threshold` has
+    changed) and the calls can be made by thresholdExpectationsJobFunction, see callsStage
+    """
+    from fingerprint import callsFingerprint, stageComplete
+
+    pending = []
+    for label_config, label in labelled_configs:
+        fingerprint = callsFingerprint(label_config, alignment, label)
+        if stageComplete(job, label_config, "calls_" + label, fingerprint):
+            continue
+        label_config                             = dict(**label_config)
+        label_config["expectations_fingerprint"] = callsFingerprint(label_config, alignment, label,
+                                                                    kind="expectations")
+        label_config["expectations_complete"]    = stageComplete(job, label_config, "expectations_" + label,
+                                                                 label_config["expectations_fingerprint"])
+        pending.append((label_config, label, fingerprint))
+    return pending
+
+
+def callsStage(label_config, label, alignment_fid, sharded_alignments):
+    """the (job function, args) that make the calls for `label`, from the expectations delivered by a previous
+    run when they're up to date
+    """
+    if label_config["expectations_complete"]:
+        return thresholdExpectationsJobFunction, (label_config, label)
+    return marginCallerJobFunction, (label_config, alignment_fid, sharded_alignments, label)
+
+
+def pendingRealignedCalls(job, config):
+    """the (config, label, fingerprint)s of realignedCallConfigs whose calls aren't already up to date, for
+    calling each contig as soon as it's been realigned. none when variants aren't being called, or are
+    called live
+    """
+    if not config["caller"] or config.get("live_label"):
+        return []
+    return pendingCalls(job, "realigned", realignedCallConfigs(config))
+
+
+def chainedCallConfig(config):
+    """the config the chained alignment is variant called with, without marginalization. its stats are
+    collected by their own stage, see addChainedStats
+    """
+    chained_config              = dict(**config)  # copy constructor
+    chained_config["no_margin"] = True
+    chained_config["stats"]     = False
+    return chained_config
+
+
+def addChainedStats(job, config, get_alignment_fid):
+    """adds a child job that collects the stats of the chained alignment (from `get_alignment_fid()`, only
+    called when they aren't up to date), they're collected whenever it's variant called. they don't need the
+    error model, so they don't wait for EM like the calls do
+    """
+    from fingerprint import callsFingerprint, stageComplete, fingerprintedStageJobFunction
+    from stats import collectAlignmentStatsJobFunction
+
+    stats_config          = dict(**config)
+    stats_config["stats"] = True
+    fingerprint           = callsFingerprint(stats_config, "chained", "chained", kind="stats")
+    if stageComplete(job, stats_config, "stats_chained", fingerprint):
+        return
+    chained_samfile_fid = get_alignment_fid()
+    job.addChildJobFn(fingerprintedStageJobFunction, stats_config, "stats_chained", fingerprint,
+                      collectAlignmentStatsJobFunction, (stats_config, chained_samfile_fid, "chained"),
+                      {"memory": chained_samfile_fid.size})
+
+
+def chainedCallsAlongsideRealignment(config):
+    """True when the chained alignment is called by chainedCallsJobFunction, alongside EM and realignment,
+    that's whenever chaining or realignment is done in this run. otherwise (and for live chunks, which aren't
+    called this way) callVariantsAndGetStatsJobFunction calls it
+    """
+    if not (config["chain"] and config["caller"]) or config.get("live_label"):
+        return False
+    return not config["chain_complete"] or bool(config["realign"] and not config["realign_complete"])
+
+
+@instrumentJobFunction("chained_calls")
+def chainedCallsJobFunction(job, config, chained_samfile_fid):
+    """calls variants on the chained alignment straight from the job store, rather than waiting for
+    realignment and importing the delivered copy
+    """
+    from margin.toil.localFileManager import importToJobstore
+    from fingerprint import fingerprintedStageJobFunction
+    from sharding import shardAlignmentByRegionJobFunction
+
+    pending = pendingCalls(job, "chained", [(chainedCallConfig(config), "chained")])
+    if not pending:
+        return
+    chained_config, _, fingerprint            = pending[0]
+    chained_config["error_model_FileStoreID"] = importToJobstore(job, errorModelUrl(config))
+    if chained_config["expectations_complete"]:
+        job.addChildJobFn(fingerprintedStageJobFunction, chained_config, "calls_chained", fingerprint,
+                          *callsStage(chained_config, "chained", None, None))
+        return
+    sharded_alignments = job.addChildJobFn(shardAlignmentByRegionJobFunction, config, chained_samfile_fid).rv()
+    releaseAfter(job, sharded_alignments).addChildJobFn(fingerprintedStageJobFunction, chained_config,
+                                                        "calls_chained", fingerprint,
+                                                        *callsStage(chained_config, "chained", chained_samfile_fid,
+                                                                    sharded_alignments))
+
+
+def issueCallerShards(job, config, input_samfile_fid, smaller_alns, hidden_markov_model):
+    """adds a child job to call variants on each of the shards (or groups of them), returns the promises of
+    their calls
+    """
+    # smaller_alns is [(contig, [AlignmentShard...])...], the shards for a contig only need its reference slice
+    all_variant_calls = []
     # this loop runs through the smaller alignments and sets a child job to get the aligned pairs for 
     # each one. then it marginalizes over the columns in the alignment and adds a promise of a dict containing
     # the posteriors to the list `all_variant_calls`
-    count = 0
-    for aln in smaller_alns:
-        disk          = input_samfile_fid.size + config["reference_FileStoreID"].size
-        memory        = (6 * input_samfile_fid.size)
-        variant_calls = job.addChildJobFn(shardSamJobFunction,
-                                          config, aln, hidden_markov_model,
-                                          calculateAlignedPairsJobFunction,
-                                          marginalizePosteriorProbsJobFunction,
-                                          batch_disk=disk,
-                                          followOn_disk=(2 * config["reference_FileStoreID"].size),
-                                          followOn_mem=(6 * aln.FileStoreID.size),
-                                          disk=disk, memory=memory).rv()
-        all_variant_calls.append(variant_calls)
-        count += 1
+    count     = 0
+    grouped   = 0  # of the `count` shards, the ones in groups
+    by_contig = OrderedDict()  # a contig's shards come in several lists, coalescing works over all of them
+    for contig, contig_alns in smaller_alns:
+        by_contig.setdefault(contig, []).extend(contig_alns)
+    for contig, contig_alns in by_contig.items():
+        shard_config   = referenceSliceConfig(config, contig)
+        reference_size = shard_config["reference_FileStoreID"].size
+        groups         = jobGroups(config, "caller", contig_alns, [aln.FileStoreID.size for aln in contig_alns])
+        if groups is not None:  # groups of shards, each processed by one (multi-core) job
+            for group in groups:
+                variant_calls = job.addChildJobFn(pooledShardsJobFunction,
+                                                  shard_config, group, hidden_markov_model,
+                                                  alignedPairsJobFunction,
+                                                  marginalizePosteriorsJobFunction,
+                                                  downsample=True,
+                                                  cores=config["cores_per_shard_job"],
+                                                  **predictedResources(
+                                                      config, "shard_group", (shard_config, group),
+                                                      disk=(sum(aln.FileStoreID.size for aln in group) +
+                                                            2 * reference_size),
+                                                      memory=(6 * input_samfile_fid.size))).rv()
+                all_variant_calls.append(variant_calls)
+                count   += len(group)
+                grouped += len(group)
+            continue
+        for aln in contig_alns:
+            disk          = input_samfile_fid.size + reference_size
+            memory        = (6 * input_samfile_fid.size)
+            variant_calls = job.addChildJobFn(callerShardJobFunction,
+                                              shard_config, aln, hidden_markov_model,
+                                              alignedPairsJobFunction,
+                                              marginalizePosteriorsJobFunction,
+                                              batch_disk=disk,
+                                              followOn_disk=(2 * reference_size),
+                                              followOn_mem=(6 * aln.FileStoreID.size),
+                                              **predictedResources(config, "caller_shard", (shard_config, aln),
+                                                                   disk=disk, memory=memory)).rv()
+            all_variant_calls.append(variant_calls)
+            count += 1
     job.fileStore.logToMaster("[marginCallerJobFunction]Issued variant calling for %s smaller alignments" % count)
-    job.addFollowOnJobFn(makeVcfFromVariantCallsJobFunction2, config, all_variant_calls, output_label)
+    addTelemetryCounts(issued_shard_group=grouped, issued_caller_shard=(count - grouped))
+    return all_variant_calls
+
+
+def finishCalls(job, config, all_variant_calls, input_samfile_fid, output_label):
+    """the follow-ons that write the VCF from the calls and, when they're asked for, the alignment's stats
+    """
+    from stats import collectAlignmentStatsJobFunction
 
+    job.addFollowOnJobFn(makeVcfJobFunction, config, all_variant_calls, output_label)
     if config["stats"]:
         job.addFollowOnJobFn(collectAlignmentStatsJobFunction, config, input_samfile_fid, output_label,
                              memory=input_samfile_fid.size)
+
+
+@instrumentJobFunction("caller")
+def marginCallerJobFunction(job, config, input_samfile_fid, smaller_alns, output_label):
+    from margin.toil.hmm import downloadHmm
+
+    all_variant_calls = issueCallerShards(job, config, input_samfile_fid, smaller_alns, downloadHmm(job, config))
+    finishCalls(job, config, all_variant_calls, input_samfile_fid, output_label)
+
+
+@instrumentJobFunction("caller")
+def contigCallerJobFunction(job, config, contig_samfile_fid, smaller_alns, hidden_markov_model):
+    """marginCallerJobFunction for the alignment of one contig, returns the promises of its calls, the VCF is
+    written from all of the contigs' calls by contigCallsJobFunction
+    """
+    return issueCallerShards(job, config, contig_samfile_fid, smaller_alns, hidden_markov_model)
+
+
+def contigCallsJobFunction(job, config, contig_calls, input_samfile_fid, output_label):
+    """writes the VCF (and the stats) for the calls that contigCallerJobFunction made on each contig
+    """
+    finishCalls(job, config, [calls for variant_calls in contig_calls for calls in variant_calls],
+                input_samfile_fid, output_label)
+
+
+def makeVcfJobFunction(job, config, variant_calls, output_label):
+    """flattens the calls from the pooled shard jobs and hands them to marginAlign's VCF writer, then delivers
+    the shards' expectations (when they're kept) so that a change to `variant_threshold` only has to redo this
+    """
+    from margin.toil.variantCall import makeVcfFromVariantCallsJobFunction2
+
+    results    = flattenResults(variant_calls)
+    calls_fids = [calls_fid for calls_fid, _ in results]
+    makeVcfFromVariantCallsJobFunction2(job, config, calls_fids, output_label)
+    releaseFiles(job, calls_fids)
+    expectation_fids = [fid for _, fid in results if fid is not None]
+    if config["expectations_fingerprint"] is not None and not config["expectations_complete"]:
+        deliverExpectations(job, config, expectation_fids, output_label)
+    releaseFiles(job, expectation_fids)
+
+
+def deliverExpectations(job, config, expectation_fids, output_label):
+    """delivers each shard's expectations, then the index of them and the fingerprint, so that the index only
+    lists a complete set
+    """
+    from margin.toil.localFileManager import LocalFile, deliverOutput
+    from fingerprint import deliverStageFingerprint
+
+    index_filename = expectationsIndexFilename(config, output_label)
+    filenames      = []
+    for n, fid in enumerate(expectation_fids):
+        filenames.append("{index}.{n}".format(index=index_filename, n=n))
+        shard_file = LocalFile(workdir=job.fileStore.getLocalTempDir(), filename=filenames[-1])
+        job.fileStore.readGlobalFile(fid, userPath=shard_file.fullpathGetter())
+        deliverOutput(job, shard_file, config["output_dir"])
+    index_file = LocalFile(workdir=job.fileStore.getLocalTempDir(), filename=index_filename)
+    with open(index_file.fullpathGetter(), "w") as fH:
+        fH.write("".join(filename + "\n" for filename in filenames))
+    deliverOutput(job, index_file, config["output_dir"])
+    deliverStageFingerprint(job, config, "expectations_" + output_label, config["expectations_fingerprint"])
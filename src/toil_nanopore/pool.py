@@ -0,0 +1,199 @@
+"""Processing a group of shards in one multi-core job
+
+marginAlign's shardSamJobFunction issues a child job for every batch of alignments in a shard and a
+follow-on to collect them, each of those pays the full Toil job overhead and downloads the reference and the
+HMM. With `cores_per_shard_job` > 1 a single job takes a group of shards, downloads the reference and HMM
+once and runs the batches on a pool of `cores_per_shard_job` workers. The batch work is done by cPecan in a
+container so the workers are threads, they spend their time waiting on docker.
+"""
+from __future__ import print_function
+import threading
+from functools import wraps
+
+from telemetry import instrumentJobFunction, addTelemetryCounts
+from downsample import downsampleAlignmentShard
+from release import releaseFiles
+from alignment_format import intermediateWriteMode
+
+
+class _LockedFileStore(object):
+    """serializes calls into the job's file store, it isn't safe to use from more than one thread
+    """
+    def __init__(self, file_store):
+        self._file_store = file_store
+        self._lock       = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._file_store, name)
+        if not callable(attribute):
+            return attribute
+
+        @wraps(attribute)
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+        return locked
+
+
+class _PoolWorkerJob(object):
+    """stands in for the job in the batch and follow-on functions run by the pool
+    """
+    def __init__(self, job, file_store):
+        self._job      = job
+        self.fileStore = file_store
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+
+def alignmentBatches(config, sam, reference_map, exonerateCigarStringFn):
+    """the same batches shardSamJobFunction makes, yields the cPecan configs
+    """
+    from margin.utils import samIterator
+
+    def make_batch():
+        return {
+            "exonerate_cigars" : exonerate_cigars,
+            "query_sequences"  : query_seqs,
+            "query_labels"     : query_labs,
+            "contig_seq"       : reference_map[contig_name],
+            "contig_name"      : contig_name,
+        }
+
+    exonerate_cigars = []
+    query_seqs       = []
+    query_labs       = []
+    contig_name      = None
+    total_seq_len    = 0
+    for aligned_segment in samIterator(sam):
+        if exonerate_cigars and (total_seq_len > config["max_alignment_length_per_job"] or
+                                 contig_name != sam.getrname(aligned_segment.reference_id) or
+                                 len(exonerate_cigars) >= config["max_alignments_per_job"] or
+                                 len(aligned_segment.query_sequence) >= config["cut_batch_at_alignment_this_big"]):
+            yield make_batch()
+            exonerate_cigars = []
+            query_seqs       = []
+            query_labs       = []
+            total_seq_len    = 0
+
+        exonerate_cigar, ok = exonerateCigarStringFn(aligned_segment, sam)
+        if not ok:
+            continue
+        exonerate_cigars.append(exonerate_cigar + "\n")
+        query_seqs.append(aligned_segment.query_sequence + "\n")
+        query_labs.append(aligned_segment.query_name + "\n")
+        total_seq_len += len(aligned_segment.query_sequence)
+        contig_name    = sam.getrname(aligned_segment.reference_id)
+    if exonerate_cigars:
+        yield make_batch()
+
+
+@instrumentJobFunction("shard_group")
+def pooledShardsJobFunction(job, config, alignment_shards, hmm, batch_job_function, followOn_job_function,
+                            downsample=False):
+    """runs the batches of all of the `alignment_shards` on a pool of `cores_per_shard_job` threads, then
+    the `followOn_job_function` for each shard. returns the follow-on return values, in the same order as
+    the shards. with `downsample` the shards are capped at `max_depth` first, like callerShardJobFunction
+    """
+    import pysam
+    from multiprocessing.pool import ThreadPool
+    from margin.utils import getFastaDictionary, getExonerateCigarFormatStringWithCheck
+
+    downsampled = []  # the downsampled copies of the shards, deleted once their batches have been made
+    if downsample and config["max_depth"]:
+        capped           = [downsampleAlignmentShard(job, shard, config["max_depth"], config["downsample_seed"],
+                                                     intermediateWriteMode(config))
+                            for shard in alignment_shards]
+        downsampled      = [c for c, shard in zip(capped, alignment_shards) if c is not shard]
+        alignment_shards = capped
+
+    # the batch functions' telemetry is part of this job's, recording it per batch isn't thread safe
+    batch_function = getattr(batch_job_function, "uninstrumented", batch_job_function)
+    worker_job     = _PoolWorkerJob(job, _LockedFileStore(job.fileStore))
+    reference_map  = getFastaDictionary(job.fileStore.readGlobalFile(config["reference_FileStoreID"]))
+    pool           = ThreadPool(processes=config["cores_per_shard_job"])
+    results        = []
+    n_batches      = 0
+    try:
+        pending = []  # [(shard, [AsyncResult...])...]
+        for shard in alignment_shards:
+            sam     = pysam.Samfile(job.fileStore.readGlobalFile(shard.FileStoreID), 'r')
+            batches = [pool.apply_async(batch_function, (worker_job, config, cPecan_config, hmm, batch_number))
+                       for batch_number, cPecan_config in
+                       enumerate(alignmentBatches(config, sam, reference_map, getExonerateCigarFormatStringWithCheck))]
+            sam.close()
+            pending.append((shard, batches))
+        releaseFiles(job, downsampled)
+
+        for shard, batches in pending:
+            batch_results = [(batch.get(), batch_number) for batch_number, batch in enumerate(batches)]
+            results.append(followOn_job_function(job, config, shard, batch_results))
+            n_batches += len(batches)
+    finally:
+        pool.close()
+        pool.join()
+
+    job.fileStore.logToMaster("[pooledShardsJobFunction]Ran {b} batches from {s} shards on {c} cores"
+                              "".format(b=n_batches, s=len(alignment_shards), c=config["cores_per_shard_job"]))
+    addTelemetryCounts(shards=len(alignment_shards), batches=n_batches)
+    return results
+
+
+def shardGroups(alignment_shards, group_size):
+    return [alignment_shards[i : i + group_size] for i in xrange(0, len(alignment_shards), group_size)]
+
+
+def coalesceUnits(units, unit_seconds, min_job_seconds):
+    # type: (list, list<float>, float) -> list<list>
+    """groups consecutive work units until each group's estimated runtime reaches `min_job_seconds`, the
+    remainder is folded into the last group rather than being left as a tiny job
+    """
+    groups    = []
+    group     = []
+    estimated = 0.0
+    for unit, seconds in zip(units, unit_seconds):
+        group.append(unit)
+        estimated += seconds
+        if estimated >= min_job_seconds:
+            groups.append(group)
+            group     = []
+            estimated = 0.0
+    if group:
+        if groups:
+            groups[-1].extend(group)
+        else:
+            groups.append(group)
+    return groups
+
+
+def jobGroups(config, stage, units, unit_bytes):
+    """how the work units for `stage` ("realign", "caller" or "stats") are split into jobs. with
+    `min_job_seconds` set the units are coalesced until each job has an estimated `min_job_seconds` of work
+    per core (estimated from the units' sizes and `job_seconds_per_mb`), otherwise with `cores_per_shard_job`
+    > 1 each job gets that many units. returns None when each unit should be its own job, as before
+    """
+    cores           = config["cores_per_shard_job"]
+    min_job_seconds = config["min_job_seconds"]
+    if min_job_seconds:
+        seconds_per_mb = config["job_seconds_per_mb"][stage]
+        groups         = coalesceUnits(units, [seconds_per_mb * b / float(1 << 20) for b in unit_bytes],
+                                       min_job_seconds * cores)
+    elif cores > 1:
+        groups = shardGroups(units, cores)
+    else:
+        return None
+    addTelemetryCounts(work_units=len(units), jobs_issued=len(groups),
+                       estimated_overhead_saved=((len(units) - len(groups)) * config["job_overhead_seconds"]))
+    return groups
+
+
+def flattenResults(grouped_results):
+    """the follow-on return values from the pooled jobs (lists) and the single shard jobs (values) as one list
+    """
+    flat = []
+    for result in grouped_results:
+        if isinstance(result, list):
+            flat.extend(result)
+        else:
+            flat.append(result)
+    return flat
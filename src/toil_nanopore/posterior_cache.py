@@ -0,0 +1,139 @@
+"""Persistent cache of HMM results, shared between runs
+
+Re-running realignment or calling on mostly the same reads (re-basecalls, added flowcells, threshold sweeps)
+recomputes the same cPecan results. With `posterior_cache` set to a directory (on a filesystem the workers
+and the leader share) the results are kept there, keyed by a hash of everything that goes into them: the
+read sequence, the guide alignment, the reference window it covers, the HMM and the cPecan parameters.
+Realignments are cached per read, the posteriors for calling are cPecan's per batch sums so they're cached
+per batch (keyed by all of the batch's reads), marginAlign cuts the batches in alignment order so those only
+hit for shards whose reads haven't changed. Hits refresh an entry's mtime and the leader evicts the
+least recently used entries after each run until the cache is under `posterior_cache_size`.
+"""
+from __future__ import print_function
+import os
+import uuid
+import errno
+import hashlib
+
+_CACHE_SUFFIX = ".entry"
+
+
+def digest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update("\0%s" % (part,))
+    return h.hexdigest()
+
+
+def hmmDigest(job, hmm):
+    """hash of the model as it's given to cPecan
+    """
+    path = job.fileStore.getLocalTempFile()
+    hmm.write(path)
+    with open(path, "r") as fH:
+        return digest(fH.read())
+
+
+def readKeys(job_config):
+    """one key per read in a cPecan batch config: the read sequence, the guide alignment (without the read's
+    name, which is a uid that changes every run) and the reference window the guide alignment covers
+    """
+    contig_seq = job_config["contig_seq"]
+    keys       = []
+    for cigar, sequence in zip(job_config["exonerate_cigars"], job_config["query_sequences"]):
+        # cigar: <query> <qstart> <qend> + <contig> <tstart> <tend> + 1 <ops...>
+        fields       = cigar.split()
+        guide        = " ".join(fields[2:])
+        tstart, tend = int(fields[6]), int(fields[7])
+        keys.append(digest(sequence.strip(), guide, contig_seq[tstart:tend]))
+    return keys
+
+
+class PosteriorCache(object):
+    """a directory of cache entries, one file per key. entries are written to a temporary file and renamed
+    into place so readers never see a partial entry, and concurrent writers of the same key are harmless
+    (they write the same content)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def fromConfig(config):
+        """the cache for this run, None when caching is off
+        """
+        if not config.get("posterior_cache"):
+            return None
+        return PosteriorCache(config["posterior_cache"])
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + _CACHE_SUFFIX)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fH:
+                data = fH.read()
+        except IOError:
+            return None
+        try:
+            os.utime(path, None)  # mark it as recently used
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = "{path}.{uid}.tmp".format(path=path, uid=uuid.uuid4().hex)
+        with open(tmp_path, "wb") as fH:
+            fH.write(data)
+        os.rename(tmp_path, path)
+
+    def evict(self, max_bytes):
+        # type: (int) -> (int, int)
+        """removes the least recently used entries until the cache is at most `max_bytes`, returns the
+        number of entries and bytes removed
+        """
+        entries = []
+        total   = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(_CACHE_SUFFIX):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        removed, removed_bytes = 0, 0
+        for _, size, path in entries:
+            if total - removed_bytes <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed       += 1
+            removed_bytes += size
+        return removed, removed_bytes
+
+
+def evictPosteriorCache(config):
+    """run on the leader after a run, trims the cache to `posterior_cache_size`
+    """
+    from bd2k.util.humanize import human2bytes, bytes2human
+
+    cache = PosteriorCache.fromConfig(config)
+    if cache is None or not os.path.isdir(cache.directory):
+        return
+    removed, removed_bytes = cache.evict(human2bytes(str(config["posterior_cache_size"])))
+    if removed:
+        print("[toil-nanopore]Evicted {n} entries ({b}) from the posterior cache"
+              "".format(n=removed, b=bytes2human(removed_bytes)))
@@ -0,0 +1,141 @@
+"""Progress of the runs in progress, for `toil-nanopore status`
+
+The leader keeps `progress_file` up to date from the telemetry records the jobs send it as they finish. For
+each sample and stage it has the jobs that are done, the shards that are done (from the `shards` counts of the
+jobs that process them) and that have been issued (from the issued_<stage> counts of the jobs that issue them),
+and the reads and bases the cPecan batches have processed. `toil-nanopore status` reads it and shows the
+throughput of each stage and an estimate of when it'll be done, a stage that's stopped making progress shows
+up as a growing `idle` time.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+
+ISSUED_PREFIX = "issued_"
+
+
+def _loadProgress(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "r") as fH:
+        try:
+            return json.load(fH)
+        except ValueError:  # being rewritten, shouldn't happen with the rename but don't fall over
+            return {}
+
+
+class ProgressTracker(object):
+    """follows a TelemetryCollector and writes the progress of `sample_label` to `path`, at most every
+    `flush_seconds`. the progress of the other samples in the file is kept
+    """
+    def __init__(self, path, sample_label, flush_seconds=5):
+        self.path          = path
+        self.sample_label  = sample_label
+        self.flush_seconds = flush_seconds
+        self.last_flush    = 0
+        self.sample        = {"started": time.time(), "updated": time.time(), "finished": None, "stages": {}}
+
+    def follow(self, collector):
+        collector.listeners.append(self.update)
+        return self
+
+    def _stage(self, stage):
+        return self.sample["stages"].setdefault(stage, {"jobs": 0, "failed": 0, "shards_done": 0,
+                                                        "shards_issued": 0, "reads": 0, "bases": 0,
+                                                        "first_start": None, "last_finish": None})
+
+    def update(self, record):
+        now   = time.time()
+        stage = self._stage(record["stage"])
+        start = now - record["wall_time"]
+        stage["jobs"]         += 1
+        stage["failed"]       += int(bool(record["failed"]))
+        stage["shards_done"]  += record["counts"].get("shards", 0)
+        stage["reads"]        += record["counts"].get("reads", 0)
+        stage["bases"]        += record["counts"].get("bases", 0)
+        stage["first_start"]   = start if stage["first_start"] is None else min(stage["first_start"], start)
+        stage["last_finish"]   = now
+        for key, value in record["counts"].items():
+            if key.startswith(ISSUED_PREFIX):
+                self._stage(key[len(ISSUED_PREFIX):])["shards_issued"] += value
+        self.sample["updated"] = now
+        if now - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self, finished=False):
+        if not self.path:
+            return
+        if finished:
+            self.sample["finished"] = time.time()
+        self.last_flush = time.time()
+        try:
+            progress = _loadProgress(self.path)
+            progress[self.sample_label] = self.sample
+            tmp_path = "{path}.{pid}.tmp".format(path=self.path, pid=os.getpid())
+            with open(tmp_path, "w") as fH:
+                json.dump(progress, fH, sort_keys=True, indent=1)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:  # called from the leader's logging, don't take the run down
+            print("[ProgressTracker]Couldn't write progress to {path}: {e}".format(path=self.path, e=e),
+                  file=sys.stderr)
+
+
+def stageRates(stage, now):
+    """(reads per second, bases per second, shards per second, seconds to go or None) for a stage's progress
+    """
+    if stage["first_start"] is None:
+        return 0.0, 0.0, 0.0, None
+    elapsed = max(now - stage["first_start"], 1e-6)
+    shards  = stage["shards_done"] / elapsed
+    eta     = None
+    if stage["shards_issued"] and shards > 0:
+        eta = max(0, stage["shards_issued"] - stage["shards_done"]) / shards
+    return stage["reads"] / elapsed, stage["bases"] / elapsed, shards, eta
+
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    return "{h}:{m:02d}:{s:02d}".format(h=seconds // 3600, m=(seconds % 3600) // 60, s=seconds % 60)
+
+
+def formatStatus(progress, sample_labels=None, now=None):
+    """the table that `toil-nanopore status` prints, one line per sample and stage
+    """
+    now   = time.time() if now is None else now
+    lines = ["\t".join(["sample", "stage", "shards", "jobs", "failed", "reads/s", "bases/s", "eta", "idle"])]
+    for sample_label in sorted(progress):
+        if sample_labels and sample_label not in sample_labels:
+            continue
+        sample = progress[sample_label]
+        state  = "finished" if sample["finished"] else "running"
+        lines.append("{sample}\t{state}, updated {ago} ago".format(sample=sample_label, state=state,
+                                                                  ago=_duration(now - sample["updated"])))
+        end = sample["finished"] or now
+        for name, stage in sorted(sample["stages"].items(), key=lambda s: (s[1]["first_start"] or end, s[0])):
+            reads_rate, bases_rate, _, eta = stageRates(stage, end)
+            issued = stage["shards_issued"] or "?"
+            idle   = None if stage["last_finish"] is None else end - stage["last_finish"]
+            lines.append("\t".join([sample_label, name, "{done}/{issued}".format(done=stage["shards_done"],
+                                                                                issued=issued),
+                                    str(stage["jobs"]), str(stage["failed"]),
+                                    "%.1f" % reads_rate, "%.0f" % bases_rate, _duration(eta), _duration(idle)]))
+    return "\n".join(lines)
+
+
+def printStatus(path, sample_labels=None, interval=None):
+    """prints the status from the progress file, every `interval` seconds until interrupted when it's given
+    """
+    from toil_lib import require
+
+    require(os.path.exists(path), "[printStatus]No progress file at {}, is progress_file set in the config "
+                                  "of the run?".format(path))
+    while True:
+        print(formatStatus(_loadProgress(path), sample_labels))
+        if not interval:
+            return
+        print("")
+        time.sleep(interval)
@@ -0,0 +1,387 @@
+"""HMM realignment of a SAM/BAM, sharded by contig
+
+Uses marginAlign's cPecan batch jobs and SAM rebuilding, but the alignment is split so that each shard
+aligns to one contig and only needs that contig's slice of the reference. Alignments that don't need to be
+realigned (off-target ones when `target_regions` is set, and confident ones when `realign_prefilter` is on)
+are passed through to the output unchanged. Each contig's alignments are put back together (sorted) as soon
+as its shards are realigned, and when the realigned alignment is being variant called the contig's calling
+starts then too, rather than once the whole realigned BAM has been delivered and imported again. The
+delivered BAM is the contigs' alignments in reference order.
+"""
+from __future__ import print_function
+import os
+
+from telemetry import instrumentJobFunction, addTelemetryCounts
+from reference import referenceSliceConfig
+from sharding import splitAlignmentByContig, shardAlignmentByRegionJobFunction
+from targets import overlapsTargets
+from pool import pooledShardsJobFunction, jobGroups, flattenResults
+from posterior_cache import PosteriorCache, digest, hmmDigest, readKeys
+from release import releaseFiles, releaseAfter, consumerScopeJobFunction
+from fingerprint import fingerprintedStageJobFunction
+from alignment_format import deliverAlignment, intermediateWriteMode
+from resources import predictedResources
+from execution import runTool
+
+# CIGAR operations (pysam codes) that make alignment columns
+_ALIGNED_OPS = (0, 7, 8)  # M, =, X
+_GAP_OPS     = (1, 2)     # I, D
+_MATCH_OP    = 7
+_MISMATCH_OP = 8
+
+
+def alignmentIdentity(alignment):
+    """fraction of the alignment columns that are matches, from the NM tag (or =/X CIGAR operations when
+    there isn't one). None if it can't be worked out
+    """
+    cigar   = alignment.cigartuples or []
+    columns = sum(length for op, length in cigar if op in _ALIGNED_OPS or op in _GAP_OPS)
+    if columns == 0:
+        return None
+    if alignment.has_tag("NM"):
+        edits = alignment.get_tag("NM")
+    elif any(op in (_MATCH_OP, _MISMATCH_OP) for op, _ in cigar):
+        edits = sum(length for op, length in cigar if op == _MISMATCH_OP or op in _GAP_OPS)
+    else:
+        return None
+    return 1.0 - (float(edits) / columns)
+
+
+def needsRealignment(config, alignment):
+    """False for alignments that we're confident in already: long enough, mapped uniquely and with high
+    identity. the HMM is unlikely to change these
+    """
+    if alignment.query_alignment_length < config["prefilter_min_length"]:
+        return True
+    if alignment.mapping_quality < config["prefilter_min_mapq"]:
+        return True
+    identity = alignmentIdentity(alignment)
+    return identity is None or identity < config["prefilter_min_identity"]
+
+
+def cPecanBandParameters(config):
+    """cPecan is anchored on the guide (chained) alignment, `band_width` is how many diagonals either side
+    of the guide alignment path the HMM is allowed to use. with a band the cost per read is about linear in
+    the read length. no parameters (cPecan's own defaults) when it isn't set
+    """
+    if not config["band_width"]:
+        return []
+    return ["--diagonal_expansion={}".format(config["band_width"]),
+            "--constraint_diagonal_trim={}".format(config["band_trim"])]
+
+
+_band_usage = {}  # cPecan image -> its usage text, it's only asked once per worker
+
+
+def requireBandSupport(job, config, cPecan_image):
+    """fails the job when `band_width` is set but `cPecan_image` doesn't list the band options in its usage,
+    an image without them would otherwise fail (or ignore them) batch after batch
+    """
+    import subprocess
+    from toil_lib import require
+
+    flags = [parameter.split("=", 1)[0] for parameter in cPecanBandParameters(config)]
+    if not flags:
+        return
+    if cPecan_image not in _band_usage:
+        work_dir   = job.fileStore.getLocalTempDir()
+        usage_path = os.path.join(work_dir, "cPecan.usage")
+        with open(usage_path, "w") as fH:
+            try:
+                runTool(job, config, cPecan_image, parameters=["--help"], work_dir=(work_dir + "/"), outfile=fH)
+            except subprocess.CalledProcessError:
+                pass  # some argument parsers exit non-zero after printing the usage
+        with open(usage_path, "r") as fH:
+            _band_usage[cPecan_image] = fH.read()
+    missing = [flag for flag in flags if flag not in _band_usage[cPecan_image]]
+    require(not missing, "[requireBandSupport]band_width is set but {image} doesn't take {flags}, use an image "
+            "with banding or leave band_width blank".format(image=cPecan_image, flags=", ".join(missing)))
+
+
+def realignCacheKeys(global_config, job_config, hmm_digest):
+    """{query label: posterior cache key} for the reads in a cPecan batch, the key covers the read (see
+    readKeys), the HMM and the parameters cPecan realigns with
+    """
+    params = digest("realign", hmm_digest, global_config["gap_gamma"], global_config["match_gamma"],
+                    *cPecanBandParameters(global_config))
+    labels = [label.strip() for label in job_config["query_labels"]]
+    return dict(zip(labels, [digest(params, read_key) for read_key in readKeys(job_config)]))
+
+
+@instrumentJobFunction("realign_batch")
+def cPecanRealignJobFunction(job, global_config, job_config, hmm, batch_number,
+                             cPecan_image="quay.io/artrand/cpecanrealign"):
+    """marginAlign's cPecanRealignJobFunction with the band parameters. with `posterior_cache` on only the
+    reads that aren't in the cache are realigned
+    """
+    import cPickle
+    import subprocess
+    from toil_lib import require
+    from margin.toil.realign import setupLocalFiles, DOCKER_DIR
+
+    requireBandSupport(job, global_config, cPecan_image)
+    addTelemetryCounts(reads=len(job_config["query_sequences"]),
+                       bases=sum(len(seq) for seq in job_config["query_sequences"]))
+    cache = PosteriorCache.fromConfig(global_config)
+    if cache is not None:
+        labels       = [label.strip() for label in job_config["query_labels"]]
+        key_by_label = realignCacheKeys(global_config, job_config, hmmDigest(job, hmm))
+        cached       = {}  # query label -> its cached realignment
+        for label in labels:
+            entry = cache.get(key_by_label[label])
+            if entry is not None:
+                cached[label] = entry
+        addTelemetryCounts(posterior_cache_hits=len(cached), posterior_cache_misses=(len(labels) - len(cached)))
+        if cached:
+            missing    = [i for i, label in enumerate(labels) if label not in cached]
+            job_config = dict(job_config, **{field: [job_config[field][i] for i in missing]
+                                             for field in ("exonerate_cigars", "query_sequences", "query_labels")})
+
+    workdir, local_hmm, local_output, local_input_obj = setupLocalFiles(job, global_config, hmm)
+    realigned = False
+    if job_config["query_labels"]:
+        # pickle the job_config, that contains the reference sequence, the query sequences, and
+        # the pairwise alignments in exonerate format
+        with open(local_input_obj.fullpathGetter(), "w") as fH:
+            cPickle.dump(job_config, fH)
+
+        cPecan_parameters = [
+            "--input={}".format(DOCKER_DIR + local_input_obj.filenameGetter()),
+            "--hmm_file={}".format(DOCKER_DIR + local_hmm.filenameGetter()),
+            "--gap_gamma={}".format(global_config["gap_gamma"]),
+            "--match_gamma={}".format(global_config["match_gamma"]),
+            "--output_alignment_file={}".format(DOCKER_DIR + local_output.filenameGetter()),
+        ] + cPecanBandParameters(global_config)
+        # marginAlign drops a failed batch and its reads go missing from the realigned BAM, here the job fails
+        # (and is retried) instead
+        try:
+            runTool(job, global_config, cPecan_image, parameters=cPecan_parameters, work_dir=(workdir + "/"))
+        except subprocess.CalledProcessError:
+            addTelemetryCounts(failed_batches=1)
+            job.fileStore.logToMaster("[cPecanRealignJobFunction]cPecan failed on batch {}".format(batch_number))
+            raise
+        require(os.path.exists(local_output.fullpathGetter()), "[cPecanRealignJobFunction]cPecan didn't write "
+                "the realignments for batch {}".format(batch_number))
+        realigned = True
+
+    if cache is None:
+        return job.fileStore.writeGlobalFile(local_output.fullpathGetter()) if realigned else None
+
+    # cache the new realignments, one cigar line per read. the read's label (a uid that's different every
+    # run) is swapped for a placeholder in the cached line
+    lines = []
+    if realigned:
+        with open(local_output.fullpathGetter(), "r") as fH:
+            for line in fH:
+                tokens = line.split()
+                label  = next((t for t in tokens if t in key_by_label), None)
+                if not line.startswith("cigar:") or label is None:
+                    continue
+                cache.put(key_by_label[label], "\0".join(line.split(label, 1)))
+                lines.append(line.rstrip("\n") + "\n")
+    lines.extend(entry.replace("\0", label).rstrip("\n") + "\n" for label, entry in cached.items())
+    if not lines:
+        return None
+    with open(local_output.fullpathGetter(), "w") as fH:
+        fH.writelines(lines)
+    return job.fileStore.writeGlobalFile(local_output.fullpathGetter())
+
+
+def realignmentFilter(config):
+    """returns the `keep(contig, alignment)` for splitAlignmentByContig, None when every alignment is realigned
+    """
+    targets = config["targets"]
+    if targets is None and not config["realign_prefilter"]:
+        return None
+
+    def keep(contig, alignment):
+        if targets is not None and \
+                not overlapsTargets(targets, contig, alignment.reference_start, alignment.reference_end):
+            return False
+        return not config["realign_prefilter"] or needsRealignment(config, alignment)
+    return keep
+
+
+@instrumentJobFunction("realign_shard", job_function_name="shardSamJobFunction")
+def realignShardJobFunction(job, *args, **kwargs):
+    """shardSamJobFunction wrapped so that it's measured (and profiled if requested) like our own jobs
+    """
+    from margin.toil.shardAlignment import shardSamJobFunction
+
+    addTelemetryCounts(shards=1)
+    return shardSamJobFunction(job, *args, **kwargs)
+
+
+def rebuildShardJobFunction(job, config, alignment_shard, cPecan_cigar_fids):
+    """marginAlign's rebuildSamJobFunction, then the shard and the batches' realignments are deleted, the
+    rebuilt alignment is all that's needed from here on
+    """
+    from margin.toil.realign import rebuildSamJobFunction
+
+    rebuilt_fid = rebuildSamJobFunction(job, config, alignment_shard, cPecan_cigar_fids)
+    releaseFiles(job, [alignment_shard.FileStoreID] + [fid for fid, _ in cPecan_cigar_fids])
+    return rebuilt_fid
+
+
+def issueRealignment(parent_job, config, contig, contig_alns, hidden_markov_model, input_size):
+    """adds a child of `parent_job` to realign each of the contig's shards (or groups of them), returns the
+    promises of the realigned alignments and the number of shards in groups
+    """
+    shard_config   = referenceSliceConfig(config, contig)
+    reference_size = shard_config["reference_FileStoreID"].size
+    groups         = jobGroups(config, "realign", contig_alns, [aln.FileStoreID.size for aln in contig_alns])
+    if groups is not None:  # groups of shards from the same contig, each realigned by one (multi-core) job
+        return [parent_job.addChildJobFn(pooledShardsJobFunction, shard_config, group,
+                                         hidden_markov_model,
+                                         cPecanRealignJobFunction,
+                                         rebuildShardJobFunction,
+                                         cores=config["cores_per_shard_job"],
+                                         **predictedResources(
+                                             config, "shard_group", (shard_config, group),
+                                             disk=(sum(aln.FileStoreID.size for aln in group) +
+                                                   2 * reference_size),
+                                             memory=(6 * input_size))).rv()
+                for group in groups], len(contig_alns)
+
+    realigned_fids = []
+    for aln in contig_alns:
+        disk   = input_size + reference_size
+        memory = (6 * input_size)
+        realigned_fids.append(parent_job.addChildJobFn(realignShardJobFunction, shard_config, aln,
+                                                       hidden_markov_model,
+                                                       cPecanRealignJobFunction,
+                                                       rebuildShardJobFunction,
+                                                       batch_disk=disk,
+                                                       followOn_disk=(2 * reference_size),
+                                                       followOn_mem=(6 * aln.FileStoreID.size),
+                                                       **predictedResources(config, "realign_shard",
+                                                                            (shard_config, aln),
+                                                                            disk=disk, memory=memory)).rv())
+    return realigned_fids, 0
+
+
+@instrumentJobFunction("realign")
+def realignSamFileJobFunction(job, config, input_samfile_fid, output_label):
+    """realigns each contig's shards under a scope job whose follow-on puts the contig's alignments back
+    together, and calls variants on them (when the realigned alignment is being variant called) without
+    waiting for the other contigs
+    """
+    from margin.toil.hmm import downloadHmm
+    from margin.toil.localFileManager import importToJobstore
+    from marginCallerToil import pendingRealignedCalls, errorModelUrl
+
+    smaller_alns, uid_to_read, passthrough_fids = splitAlignmentByContig(job, config["split_alignments_to_this_many"],
+                                                                         input_samfile_fid, realignmentFilter(config),
+                                                                         intermediateWriteMode(config))
+    hidden_markov_model = downloadHmm(job, config)
+    calls               = pendingRealignedCalls(job, config)
+    if calls:  # realignment comes after EM, so the trained model is there already
+        error_model_fid = importToJobstore(job, errorModelUrl(config))
+        calls           = [(dict(label_config, error_model_FileStoreID=error_model_fid), label, fingerprint)
+                           for label_config, label, fingerprint in calls]
+        job.fileStore.logToMaster("[realignSamFileJobFunction]Calling {labels} on each contig as it's realigned"
+                                  "".format(labels=", ".join(label for _, label, _ in calls)))
+
+    by_contig = {}
+    for contig, aln in smaller_alns:
+        by_contig.setdefault(contig, []).append(aln)
+    contig_results = []
+    grouped        = 0
+    for contig in sorted(set(by_contig) | set(passthrough_fids)):
+        contig_alns       = by_contig.get(contig, [])
+        scope             = job.addChildJobFn(consumerScopeJobFunction, cores=1, memory="32M", disk="1M")
+        realigned_fids, n = issueRealignment(scope, config, contig, contig_alns, hidden_markov_model,
+                                             input_samfile_fid.size) if contig_alns else ([], 0)
+        contig_bytes      = sum(aln.FileStoreID.size for aln in contig_alns) + \
+            sum(fid.size for fid in passthrough_fids.get(contig, []))
+        grouped          += n
+        contig_results.append(scope.addFollowOnJobFn(contigRealignedJobFunction, config, contig, realigned_fids,
+                                                     passthrough_fids.get(contig, []), uid_to_read.get(contig, {}),
+                                                     hidden_markov_model, calls,
+                                                     disk=(3 * contig_bytes)).rv())
+
+    addTelemetryCounts(issued_shard_group=grouped, issued_realign_shard=(len(smaller_alns) - grouped))
+    job.addFollowOnJobFn(combineRealignedSamfilesJobFunction, config, input_samfile_fid, contig_results,
+                         output_label, calls)
+
+
+@instrumentJobFunction("realign_contig")
+def contigRealignedJobFunction(job, config, contig, realigned_fids, passthrough_fids, uid_to_read,
+                               hidden_markov_model, calls):
+    """puts a contig's realigned and pass-through alignments into one sorted BAM in the job store, and starts
+    calling variants on it for each of `calls`. returns (contig, FileStoreID of the BAM, {label: the promises
+    of its calls}), the FileStoreID is None if nothing on the contig was realigned or passed through
+    """
+    import pysam
+    from marginCallerToil import contigCallerJobFunction
+
+    inputs = [(fid, "rb", True) for fid in flattenResults(realigned_fids) if fid is not None] + \
+             [(fid, "r", False) for fid in passthrough_fids]
+    if not inputs:
+        return contig, None, {}
+    unsorted_bam = job.fileStore.getLocalTempFileName()
+    output_sam   = None
+    for fid, mode, realigned in inputs:
+        samfile = pysam.Samfile(job.fileStore.readGlobalFile(fid), mode)
+        if output_sam is None:  # the shards all have the input alignment's header
+            output_sam = pysam.Samfile(unsorted_bam, "wb", template=samfile)
+        for alignment in samfile:
+            if realigned:
+                alignment.query_name = uid_to_read[alignment.query_name]
+            output_sam.write(alignment)
+        samfile.close()
+    output_sam.close()
+    releaseFiles(job, [fid for fid, _, _ in inputs])
+
+    sorted_prefix = job.fileStore.getLocalTempFileName()
+    pysam.sort(unsorted_bam, sorted_prefix)
+    contig_fid = job.fileStore.writeGlobalFile(sorted_prefix + ".bam")
+    if not calls:
+        return contig, contig_fid, {}
+
+    sharded_alignments = job.addChildJobFn(shardAlignmentByRegionJobFunction, config, contig_fid).rv()
+    consumers          = releaseAfter(job, sharded_alignments)
+    contig_calls       = {label: consumers.addChildJobFn(contigCallerJobFunction, label_config, contig_fid,
+                                                         sharded_alignments, hidden_markov_model).rv()
+                          for label_config, label, _ in calls}
+    job.fileStore.logToMaster("[contigRealignedJobFunction]{contig} is realigned, calling variants on it"
+                              "".format(contig=contig))
+    return contig, contig_fid, contig_calls
+
+
+def combineRealignedSamfilesJobFunction(job, config, input_samfile_fid, contig_results, output_label, calls):
+    """concatenates the contigs' alignments (in the order of the reference in the header) into the realigned
+    BAM and delivers it, then writes the VCFs for `calls` from the contigs' calls
+    """
+    import pysam
+    from margin.toil.localFileManager import LocalFile
+    from marginCallerToil import contigCallsJobFunction
+
+    sam               = pysam.Samfile(job.fileStore.readGlobalFile(input_samfile_fid), "r")
+    contig_results    = sorted((r for r in contig_results if r[1] is not None), key=lambda r: sam.gettid(r[0]))
+    filename          = "{sample}_{out_label}.bam".format(sample=config["sample_label"], out_label=output_label)
+    output_sam        = LocalFile(workdir=job.fileStore.getLocalTempDir(), filename=filename)
+    output_sam_handle = pysam.Samfile(output_sam.fullpathGetter(), "wb", template=sam)
+    sam.close()
+
+    for _, fid, _ in contig_results:
+        samfile = pysam.Samfile(job.fileStore.readGlobalFile(fid), "rb")
+        for alignment in samfile:
+            output_sam_handle.write(alignment)
+        samfile.close()
+    output_sam_handle.close()
+    releaseFiles(job, [fid for _, fid, _ in contig_results])
+    deliverAlignment(job, config, output_sam)
+
+    if not calls:
+        return
+    # the stats are collected on the whole realigned alignment
+    realigned_fid = None
+    consumers     = job
+    if any(label_config["stats"] for label_config, _, _ in calls):
+        realigned_fid = job.fileStore.writeGlobalFile(output_sam.fullpathGetter())
+        consumers     = releaseAfter(job, realigned_fid)
+    for label_config, label, fingerprint in calls:
+        contig_calls = [variant_calls[label] for _, _, variant_calls in contig_results]
+        consumers.addChildJobFn(fingerprintedStageJobFunction, label_config, "calls_" + label, fingerprint,
+                                contigCallsJobFunction, (label_config, contig_calls, realigned_fid, label))
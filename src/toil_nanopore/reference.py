@@ -0,0 +1,40 @@
+"""Per-contig slices of the reference
+
+Realignment and calling shards only ever align against one contig, so instead of each of them downloading
+the whole reference from the job store they get a config whose `reference_FileStoreID` is a FASTA with just
+that contig. Coordinates are unchanged because the slice is the whole contig.
+"""
+from __future__ import print_function
+from collections import namedtuple
+
+ContigSlice = namedtuple("ContigSlice", ["FileStoreID", "length"])
+
+
+def sliceReferenceJobFunction(job, reference_fid):
+    """writes each contig of the reference to the job store as its own FASTA, returns a dict of
+    contig name to ContigSlice. contig names are the first word of the FASTA header (like getFastaDictionary)
+    """
+    from sonLib.bioio import fastaRead, fastaWrite
+
+    reference_slices = {}
+    with open(job.fileStore.readGlobalFile(reference_fid), "r") as reference_handle:
+        for header, sequence in fastaRead(reference_handle):
+            contig = header.split()[0]
+            assert(contig not in reference_slices), "[sliceReferenceJobFunction]Duplicate contig %s" % contig
+            contig_fasta = job.fileStore.getLocalTempFile()
+            with open(contig_fasta, "w") as fH:
+                fastaWrite(fH, contig, sequence)
+            reference_slices[contig] = ContigSlice(FileStoreID=job.fileStore.writeGlobalFile(contig_fasta),
+                                                   length=len(sequence))
+            job.fileStore.deleteLocalFile(reference_slices[contig].FileStoreID)
+    job.fileStore.logToMaster("[sliceReferenceJobFunction]Sliced reference into {} contigs"
+                              "".format(len(reference_slices)))
+    return reference_slices
+
+
+def referenceSliceConfig(config, contig):
+    """copy of the config whose reference is the slice containing only `contig`
+    """
+    slice_config = dict(**config)
+    slice_config["reference_FileStoreID"] = config["reference_slices"][contig].FileStoreID
+    return slice_config
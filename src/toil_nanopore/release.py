@@ -0,0 +1,60 @@
+"""Deleting intermediate files from the job store as soon as their consumers are done with them
+
+Without this the shard alignments, extracted reads, chained alignment, cPecan results and per-shard calls
+stay in the job store until the workflow ends. A file with one consumer is deleted by that consumer once
+it's read it (`releaseFiles`). Files with several consumers are given a scope (`releaseAfter`): the
+consumers are added to the scope as children, and once the last of them (and everything they spawn) has
+finished the scope's follow-on deletes the files.
+"""
+from __future__ import print_function
+
+from telemetry import instrumentJobFunction, addTelemetryCounts
+
+
+def fileStoreIds(files):
+    """the FileStoreIDs in `files`, which can be a FileStoreID or (nested) lists, tuples and dicts of them,
+    e.g. the [(contig, [AlignmentShard...])...] from sharding. None and other values are skipped
+    """
+    from toil.fileStore import FileStoreID
+
+    if isinstance(files, FileStoreID):
+        return [files]
+    if isinstance(files, dict):
+        files = files.values()
+    if isinstance(files, (list, tuple)):  # includes AlignmentShard and the other namedtuples
+        return [fid for f in files for fid in fileStoreIds(f)]
+    return []
+
+
+def releaseFiles(job, files):
+    """deletes the files from the job store, returns the number of bytes freed
+    """
+    freed = 0
+    fids  = fileStoreIds(files)
+    for fid in fids:
+        job.fileStore.deleteGlobalFile(fid)
+        freed += getattr(fid, "size", 0) or 0
+    addTelemetryCounts(released_files=len(fids), released_bytes=freed)
+    return freed
+
+
+def consumerScopeJobFunction(job):
+    """does nothing, its children are the consumers of the files released by its follow-on
+    """
+    pass
+
+
+@instrumentJobFunction("release")
+def releaseFilesJobFunction(job, files):
+    freed = releaseFiles(job, files)
+    job.fileStore.logToMaster("[releaseFilesJobFunction]Deleted {n} intermediate files, {b} bytes"
+                              "".format(n=len(fileStoreIds(files)), b=freed))
+
+
+def releaseAfter(parent_job, files):
+    """returns a follow-on of `parent_job` to add the consumers of `files` to as children, the files are
+    deleted when they've all finished
+    """
+    scope = parent_job.addFollowOnJobFn(consumerScopeJobFunction, cores=1, memory="32M", disk="1M")
+    scope.addFollowOnJobFn(releaseFilesJobFunction, files, cores=1, memory="256M", disk="1M")
+    return scope
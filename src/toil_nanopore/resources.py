@@ -0,0 +1,135 @@
+"""Memory and disk requests learned from the telemetry of previous runs
+
+After each run the leader adds the peak RSS and local disk use of every instrumented job, with the job's
+input size, to `resource_history` (a JSON-lines file on the leader). Before a run a line is fitted for each
+stage that has at least `resource_min_observations` jobs in the history, shifted up so it's above the
+`resource_quantile` fraction of them, and jobs of that stage request `resource_safety_margin` times the line
+at their input size instead of the built-in estimates (the fixed multiples of the input size). Jobs that ran
+out of memory count as needing twice what they were given: a MemoryError, a tool killed with SIGKILL or a job
+whose whole worker was killed (the leader sees those, see telemetry.TelemetryCollector). Only peaks measured for the job
+itself (see telemetry.PeakRssMonitor) are used for memory, a worker's lifetime peak includes earlier jobs.
+"""
+from __future__ import print_function
+import os
+import json
+import math
+
+from telemetry import describeJobInputs, jobUnitName
+
+HISTORY_PER_STAGE = 500                # only the most recent observations of each stage are kept
+RESOURCE_FLOORS   = {"memory": 64 << 20, "disk": 16 << 20}
+
+
+def observations(record):
+    """the (input_bytes, {"memory": bytes, "disk": bytes}) from a telemetry record, memory is None when the
+    record only has the worker's lifetime peak
+    """
+    memory = record["peak_rss"] if record.get("peak_rss_scope") == "job" else None
+    if record.get("counts", {}).get("oom"):
+        memory = 2 * max(memory or 0, record.get("requested_memory") or 0)
+    disk = max(record["bytes_read"] + record["bytes_written"], record.get("local_disk") or 0)
+    if record.get("killed"):  # it didn't get far enough to say what disk it needed
+        disk = None
+    return record["input_bytes"], {"memory": memory, "disk": disk}
+
+
+def _leastSquares(points):
+    # the slope is kept non-negative, a job never needs less for more input
+    n      = float(len(points))
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x  = sum((x - mean_x) ** 2 for x, _ in points)
+    slope  = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x) if var_x > 0 else 0.0
+    return mean_y - slope * mean_x, slope
+
+
+def fitEnvelope(points, quantile):
+    # type: (list<(int, int)>, float) -> (float, float)
+    """a line through the (x, y) points moved up so that it's at or above the `quantile` fraction of them. it's
+    fitted (least squares) again without the points above that, so that a few outliers don't pull it up
+    """
+    def residuals(line):
+        return [y - (line[0] + line[1] * x) for x, y in points]
+
+    keep             = max(1, int(math.ceil(quantile * len(points))))
+    first            = _leastSquares(points)
+    ranked           = [p for _, p in sorted(zip(residuals(first), points))]
+    intercept, slope = _leastSquares(ranked[:keep])
+    intercept       += max(0.0, sorted(residuals((intercept, slope)))[keep - 1])
+    return intercept, slope
+
+
+def loadHistory(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, "r") as fH:
+        return [json.loads(line) for line in fH if line.strip()]
+
+
+def _usable(entry, resource):
+    # the memory of entries from before peak_rss_scope was recorded is the worker's lifetime peak
+    if resource == "memory" and "peak_rss_scope" not in entry:
+        return False
+    return entry.get(resource) is not None
+
+
+def fitResourceModel(config):
+    """{stage: {"memory": (intercept, slope), "disk": (intercept, slope)}} for the stages with enough history,
+    run on the leader and put in the config as `resource_model`
+    """
+    by_stage = {}
+    for entry in loadHistory(config.get("resource_history")):
+        by_stage.setdefault(entry["stage"], []).append(entry)
+    model = {}
+    for stage, entries in by_stage.iteritems():
+        for resource in ("memory", "disk"):
+            points = [(e["input_bytes"], e[resource]) for e in entries if _usable(e, resource)]
+            if len(points) >= config["resource_min_observations"]:
+                model.setdefault(stage, {})[resource] = fitEnvelope(points, config["resource_quantile"])
+    return model
+
+
+def appendResourceHistory(config, records):
+    """adds the observations from this run's telemetry records to the history, dropping the oldest ones of
+    each stage beyond HISTORY_PER_STAGE
+    """
+    path = config.get("resource_history")
+    if not path or not records:
+        return
+    history = loadHistory(path)
+    for record in records:
+        if record.get("failed") and not record.get("counts", {}).get("oom"):
+            continue
+        if record["input_bytes"] is None:  # a killed job that wasn't named with its input size
+            continue
+        input_bytes, observed = observations(record)
+        history.append(dict(stage=record["stage"], input_bytes=input_bytes,
+                            peak_rss_scope=record.get("peak_rss_scope"), **observed))
+    kept, per_stage = [], {}
+    for entry in reversed(history):
+        per_stage[entry["stage"]] = per_stage.get(entry["stage"], 0) + 1
+        if per_stage[entry["stage"]] <= HISTORY_PER_STAGE:
+            kept.append(entry)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fH:
+        for entry in reversed(kept):
+            fH.write(json.dumps(entry, sort_keys=True) + "\n")
+    os.rename(tmp_path, path)
+
+
+def predictedResources(config, stage, args, **defaults):
+    """the memory and disk to request for a `stage` job with arguments `args` (its input size is worked out
+    the same way the telemetry does). `defaults` are the built-in estimates, e.g. memory=(6 * fid.size), they're
+    used for the stages that the model doesn't cover. returns the kwargs for addChildJobFn/addFollowOnJobFn,
+    the job is named with its stage and input size so that the leader can tell what it was if it's killed
+    """
+    _, _, input_bytes, _ = describeJobInputs(args)
+    fitted               = (config.get("resource_model") or {}).get(stage)
+    requested            = dict((k, v) for k, v in defaults.items() if v is not None)
+    requested["name"]    = jobUnitName(stage, input_bytes)
+    if fitted is None:
+        return requested
+    for resource, (intercept, slope) in fitted.items():
+        requested[resource] = max(RESOURCE_FLOORS[resource],
+                                  int(config["resource_safety_margin"] * (intercept + slope * input_bytes)))
+    return requested
@@ -0,0 +1,215 @@
+"""Sharding alignments by reference region and by contig
+"""
+from __future__ import print_function
+import uuid
+
+from telemetry import instrumentJobFunction, addTelemetryCounts
+from targets import targetRanges
+from execution import runTool
+
+
+def contigsWithAlignments(parent_job, config, alignment, workdir, samtools_image="quay.io/ucsc_cgl/samtools"):
+    # type: (toil.job.Job, dict, LocalFile, str, str) -> list<str>
+    """runs samtools idxstats on the (indexed) alignment and returns the contigs that have reads mapped to them
+    """
+    from margin.toil.localFileManager import LocalFile
+
+    stats = LocalFile(workdir=workdir, filename="{}.idxstats".format(uuid.uuid4().hex))
+    with open(stats.fullpathGetter(), "w") as fH:
+        runTool(parent_job, config, samtools_image,
+                parameters=["idxstats", "/data/{}".format(alignment.filenameGetter())],
+                work_dir=(workdir + "/"), outfile=fH)
+    contigs = []
+    with open(stats.fullpathGetter(), "r") as fH:
+        for line in fH:
+            contig, _, n_mapped, _ = line.rstrip("\n").split("\t")
+            if contig != "*" and int(n_mapped) > 0:
+                contigs.append(contig)
+    return contigs
+
+
+def coverageHistogram(alignment_path, contig_lengths, bin_size):
+    # type: (str, dict<str, int>, int) -> dict<str, list<int>>
+    """one pass over the alignment, returns the number of aligned (M/=/X) bases falling in each `bin_size`
+    bin of each contig that has alignments
+    """
+    import pysam
+
+    histograms = {}
+    sam        = pysam.Samfile(alignment_path, "rb")
+    for aln in sam.fetch(until_eof=True):
+        if aln.is_unmapped or aln.is_secondary:
+            continue
+        contig    = sam.getrname(aln.reference_id)
+        histogram = histograms.get(contig)
+        if histogram is None:
+            histogram = histograms[contig] = [0] * ((contig_lengths[contig] // bin_size) + 1)
+        for start, end in aln.get_blocks():
+            while start < end:
+                b             = start // bin_size
+                bin_end       = min(end, (b + 1) * bin_size)
+                histogram[b] += bin_end - start
+                start         = bin_end
+    sam.close()
+    return histograms
+
+
+def intervalBins(start, end, bin_size):
+    return xrange(start // bin_size, ((end - 1) // bin_size) + 1)
+
+
+def coverageBalancedRanges(histogram, intervals, bin_size, target_bases):
+    # type: (list<int>, list<(int, int)>, int, int) -> list<(int, int)>
+    """cuts the intervals at bin boundaries so that each range has about `target_bases` aligned bases in it,
+    the ranges cover the intervals
+    """
+    ranges = []
+    for start, end in intervals:
+        running = 0
+        for b in intervalBins(start, end, bin_size):
+            running += histogram[b]
+            cut      = (b + 1) * bin_size
+            if running >= target_bases and cut < end:
+                ranges.append((start, cut))
+                start   = cut
+                running = 0
+        ranges.append((start, end))
+    return ranges
+
+
+def batchRanges(ranges, batch=10):
+    # same batching as margin's get_ranges, each makeRangedAlignmentJobFunction cuts this many ranges
+    return [ranges[i : i + batch] for i in xrange(0, len(ranges), batch)]
+
+
+@instrumentJobFunction("shard_by_region")
+def shardAlignmentByRegionJobFunction(job, config, input_alignment_fid):
+    """splits the alignment into regions of each contig (or of each target interval, when `target_regions`
+    is given). with `shard_by: length` the regions are `split_chromosome_this_length` long, with
+    `shard_by: coverage` the boundaries are chosen from a coverage histogram so each region has about the
+    same number of aligned bases (the same number of regions are made in both modes). the contig lengths
+    come from the reference slices so the reference itself isn't downloaded.
+    returns [(contig, [AlignmentShard...])...]
+    """
+    from toil_lib import require
+    from margin.toil.localFileManager import LocalFile
+    from margin.toil.alignment import make_bai, makeRangedAlignmentJobFunction
+
+    require(config["shard_by"] in ("length", "coverage"),
+            "[shardAlignmentByRegionJobFunction]shard_by must be 'length' or 'coverage', got %s" % config["shard_by"])
+
+    workdir        = job.fileStore.getLocalTempDir()
+    full_alignment = LocalFile(workdir=workdir, filename="full{}.bam".format(uuid.uuid4().hex))
+    contig_lengths = dict((contig, s.length) for contig, s in config["reference_slices"].iteritems())
+    split_len      = config["split_chromosome_this_length"]
+    accumulator    = []
+
+    def contig_intervals(contig):
+        if config["targets"] is None:
+            return [(0, contig_lengths[contig])]
+        return [(start, min(end, contig_lengths[contig])) for start, end in config["targets"].get(contig, [])
+                if start < contig_lengths[contig]]
+
+    job.fileStore.readGlobalFile(input_alignment_fid, userPath=full_alignment.fullpathGetter())
+    make_bai(job, full_alignment, workdir)
+
+    if config["shard_by"] == "coverage":
+        bin_size      = config["coverage_bin_size"]
+        histograms    = coverageHistogram(full_alignment.fullpathGetter(), contig_lengths, bin_size)
+        aligned_bases = dict((c, sum(histograms[c][b] for start, end in contig_intervals(c)
+                                     for b in intervalBins(start, end, bin_size)))
+                             for c in histograms)
+        contigs       = sorted(c for c, bases in aligned_bases.iteritems() if bases > 0)
+        n_regions     = sum(len(targetRanges(contig_intervals(c), contig_lengths[c], split_len)) for c in contigs)
+        total_aligned = sum(aligned_bases[c] for c in contigs)
+        target_bases  = max(1, total_aligned // max(1, n_regions))
+        job.fileStore.logToMaster("[shardAlignmentByRegionJobFunction]Balancing {bases} aligned bases over about "
+                                  "{n} regions".format(bases=total_aligned, n=n_regions))
+        contig_ranges = dict((c, batchRanges(coverageBalancedRanges(histograms[c], contig_intervals(c), bin_size,
+                                                                    target_bases)))
+                             for c in contigs)
+    else:
+        contigs       = [c for c in contigsWithAlignments(job, config, full_alignment, workdir) if contig_intervals(c)]
+        contig_ranges = dict((c, batchRanges(targetRanges(contig_intervals(c), contig_lengths[c], split_len)))
+                             for c in contigs)
+
+    for contig in contigs:
+        job.fileStore.logToMaster("[shardAlignmentByRegionJobFunction] %s contains alignments, sharding" % contig)
+        accumulator.extend([(contig, job.addChildJobFn(makeRangedAlignmentJobFunction,
+                                                       contig, input_alignment_fid, batch).rv())
+                            for batch in contig_ranges[contig]])
+    addTelemetryCounts(region_batches=len(accumulator),
+                       regions=sum(len(batch) for batches in contig_ranges.values() for batch in batches))
+    return accumulator
+
+
+def splitAlignmentByContig(parent_job, split_alignments_to_this_many, input_sam_fid, keep=None, write_mode="wh"):
+    """like marginAlign's splitLargeAlignment, but each of the smaller alignments only has alignments to one
+    contig. when `keep(contig, AlignedSegment)` is given the alignments it returns False for aren't put in the
+    smaller alignments, they're written (with their read names) to separate alignments to be passed through,
+    also one contig per file. the smaller alignments and the pass-through alignments are written with the
+    pysam `write_mode`.
+    returns
+    [(contig, AlignmentShard)...], {contig: the map from the uids given to its alignments back to the read
+    names} and {contig: [FileStoreID of a pass-through alignment...]} (only contigs that have some)
+    """
+    import pysam
+    from margin.toil.alignment import AlignmentShard
+    from margin.utils import samIterator
+
+    def write_file(batch):
+        temp_sam  = parent_job.fileStore.getLocalTempFileName()
+        small_sam = pysam.Samfile(temp_sam, write_mode, template=sam)
+        for aln in batch:
+            small_sam.write(aln)
+        small_sam.close()
+        return parent_job.fileStore.writeGlobalFile(temp_sam)
+
+    def write_batch(contig, batch):
+        contig_uids = uid_to_read.setdefault(contig, {})
+        for aln in batch:
+            # make a UID for each alignment so we can look them up uniquely later
+            uid              = uuid.uuid4().hex
+            contig_uids[uid] = aln.query_name
+            aln.query_name   = uid
+        small_alignments.append((contig, AlignmentShard(start=None, end=None, FileStoreID=write_file(batch))))
+
+    sam                 = pysam.Samfile(parent_job.fileStore.readGlobalFile(input_sam_fid), 'r')
+    small_alignments    = []
+    uid_to_read         = {}
+    passthrough_fids    = {}
+    batches             = {}  # contig: [AlignedSegment...], the input isn't necessarily sorted
+    passthrough_batches = {}  # same, for the pass-through alignments
+    total_alns          = 0
+    passed_through      = 0
+    for alignment in samIterator(sam):
+        contig = sam.getrname(alignment.reference_id)
+        total_alns += 1
+        if keep is not None and not keep(contig, alignment):
+            passed_through += 1
+            batch = passthrough_batches.setdefault(contig, [])
+            batch.append(alignment)
+            if len(batch) >= split_alignments_to_this_many:
+                passthrough_fids.setdefault(contig, []).append(write_file(batch))
+                passthrough_batches[contig] = []
+            continue
+        batch = batches.setdefault(contig, [])
+        batch.append(alignment)
+        if len(batch) >= split_alignments_to_this_many:
+            write_batch(contig, batch)
+            batches[contig] = []
+    for contig, batch in batches.items():
+        if batch:
+            write_batch(contig, batch)
+    for contig, batch in passthrough_batches.items():
+        if batch:
+            passthrough_fids.setdefault(contig, []).append(write_file(batch))
+    sam.close()
+
+    addTelemetryCounts(split_alignments=(total_alns - passed_through), passthrough_alignments=passed_through)
+    parent_job.fileStore.logToMaster("[splitAlignmentByContig]Input alignment has {N} alignments in it "
+                                     "split {f:.1%} of them into {n} smaller files, passing {p} through"
+                                     "".format(N=total_alns, n=len(small_alignments), p=passed_through,
+                                               f=(float(total_alns - passed_through) / total_alns
+                                                  if total_alns else 0.0)))
+    return small_alignments, uid_to_read, passthrough_fids
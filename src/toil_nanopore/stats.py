@@ -0,0 +1,50 @@
+"""marginStats, with the per-batch jobs coalesced
+
+Uses marginAlign's per-batch stats and delivery, but with `min_job_seconds` set the batches are grouped so
+each job has a useful amount of work (see pool.jobGroups).
+"""
+from __future__ import print_function
+
+from telemetry import instrumentJobFunction
+from pool import jobGroups, flattenResults
+from release import releaseFiles
+
+
+@instrumentJobFunction("stats")
+def collectAlignmentStatsJobFunction(job, config, full_alignment_fid, output_label):
+    from margin.toil.alignment import splitLargeAlignment
+    from margin.toil.stats import marginStatsJobFunction
+
+    smaller_alns, uid_to_read = splitLargeAlignment(job, config["stats_alignment_batch_size"], full_alignment_fid)
+    disk   = 2 * config["reference_FileStoreID"].size
+    groups = jobGroups(config, "stats", smaller_alns, [aln.FileStoreID.size for aln in smaller_alns])
+    if groups is None:
+        stat_shards = [job.addChildJobFn(marginStatsJobFunction, alignment.FileStoreID, uid_to_read,
+                                         config["reference_FileStoreID"], config["sample_FileStoreID"],
+                                         config["local_alignment"]).rv()
+                       for alignment in smaller_alns]
+    else:
+        stat_shards = [job.addChildJobFn(marginStatsGroupJobFunction, [aln.FileStoreID for aln in group],
+                                         uid_to_read, config["reference_FileStoreID"], config["sample_FileStoreID"],
+                                         config["local_alignment"]).rv()
+                       for group in groups]
+    job.addFollowOnJobFn(deliverAlignmentStatsJobFunction, config, stat_shards, output_label,
+                         [aln.FileStoreID for aln in smaller_alns], disk=disk)
+
+
+@instrumentJobFunction("stats_group")
+def marginStatsGroupJobFunction(job, alignment_fids, uid_to_read, reference_fid, fastq_fid, local_alignment):
+    """marginStatsJobFunction for each of the alignments, in this job. returns the stats FileStoreIDs
+    """
+    from margin.toil.stats import marginStatsJobFunction
+
+    return [marginStatsJobFunction(job, fid, uid_to_read, reference_fid, fastq_fid, local_alignment)
+            for fid in alignment_fids]
+
+
+def deliverAlignmentStatsJobFunction(job, config, stat_shards, output_label, split_alignment_fids):
+    from margin.toil.stats import deliverAlignmentStats
+
+    stats_fids = flattenResults(stat_shards)
+    deliverAlignmentStats(job, config, stats_fids, output_label)
+    releaseFiles(job, stats_fids + split_alignment_fids)
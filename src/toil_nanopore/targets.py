@@ -0,0 +1,75 @@
+"""Target regions (BED) for panel and adaptive-sampling runs
+
+When `target_regions` is set only the reads that overlap a target are realigned (the rest are passed through
+unchanged) and variants are only called in the target intervals.
+"""
+from __future__ import print_function
+from bisect import bisect_right
+
+
+def parseBed(bed_handle):
+    # type: (file) -> dict<str, list<(int, int)>>
+    """returns {contig: [(start, end)...]} with the intervals sorted and overlapping ones merged. BED
+    coordinates are 0-based half-open, which is what the sharding uses too
+    """
+    from toil_lib import require
+
+    intervals = {}
+    for line in bed_handle:
+        if not line.strip() or line.startswith(("#", "track", "browser")):
+            continue
+        fields = line.split()
+        require(len(fields) >= 3, "[parseBed]Invalid BED line {}".format(line))
+        contig, start, end = fields[0], int(fields[1]), int(fields[2])
+        require(start < end, "[parseBed]Invalid interval {}".format(line))
+        intervals.setdefault(contig, []).append((start, end))
+
+    merged = {}
+    for contig, contig_intervals in intervals.iteritems():
+        contig_intervals.sort()
+        merged[contig] = [contig_intervals[0]]
+        for start, end in contig_intervals[1:]:
+            last_start, last_end = merged[contig][-1]
+            if start <= last_end:
+                merged[contig][-1] = (last_start, max(last_end, end))
+            else:
+                merged[contig].append((start, end))
+    return merged
+
+
+def overlapsTargets(targets, contig, start, end):
+    # type: (dict<str, list<(int, int)>>, str, int, int) -> bool
+    intervals = targets.get(contig)
+    if not intervals:
+        return False
+    # the last interval starting before `end` is the only one that can overlap, they don't overlap each other
+    i = bisect_right(intervals, (end, -1)) - 1
+    return i >= 0 and intervals[i][1] > start
+
+
+def targetRanges(intervals, contig_length, split_len):
+    # type: (list<(int, int)>, int, int) -> list<(int, int)>
+    """the target intervals on a contig cut into pieces at most `split_len` long
+    """
+    ranges = []
+    for start, end in intervals:
+        end = min(end, contig_length)
+        while start < end:
+            ranges.append((start, min(start + split_len, end)))
+            start += split_len
+    return ranges
+
+
+def loadTargetsJobFunction(job, target_regions):
+    """downloads and parses the `target_regions` BED, the parsed intervals are small enough to go in the config
+    """
+    from toil_lib import require
+    from margin.toil.localFileManager import urlDownloadToLocalFile
+
+    bed = urlDownloadToLocalFile(job, job.fileStore.getLocalTempDir(), target_regions)
+    require(bed is not None, "[loadTargetsJobFunction]Couldn't download {}".format(target_regions))
+    with open(bed.fullpathGetter(), "r") as fH:
+        targets = parseBed(fH)
+    job.fileStore.logToMaster("[loadTargetsJobFunction]Restricting to {n} intervals on {c} contigs"
+                              "".format(n=sum(len(i) for i in targets.values()), c=len(targets)))
+    return targets
@@ -0,0 +1,586 @@
+"""Per-job telemetry for toil-nanopore job functions
+
+Every instrumented job function emits one structured record (stage, sample, shard, input bytes, wall time,
+CPU time, peak RSS and bytes moved through the file store) to the leader with `logToMaster`. The peak RSS is
+the job's own: Toil runs several jobs one after another in a worker, so the worker's lifetime peak isn't
+used unless there's no /proc to measure the job with (`peak_rss_scope` is then "process"). The leader
+collects the records with a `TelemetryCollector` and delivers a TSV and a JSON report to `output_dir`.
+Job functions (or stages) listed in the `profile_jobs` config option are also run under cProfile, the
+profiles of the `profile_top_n` slowest jobs in each stage are delivered next to the report. The peak size
+of the job store during the run is measured on the leader (for file job stores) and added to the report.
+"""
+from __future__ import print_function
+import os
+import glob
+import json
+import time
+import cProfile
+import sys
+import uuid
+import shutil
+import logging
+import tempfile
+import numbers
+import resource
+import threading
+from functools import wraps
+
+TELEMETRY_TAG    = "[toil-nanopore-telemetry]"
+TELEMETRY_FIELDS = ["stage", "sample", "shard", "job_function", "input_bytes", "wall_time", "cpu_time",
+                    "peak_rss", "bytes_read", "bytes_written", "failed"]
+
+KILLED_EXIT_CODES  = (-9, 137)  # SIGKILL, from popen and from docker: the OOM killer or the batch system's limit
+TOIL_JOB_FAILED    = "Job failed with exit value %i: %s"  # Toil's leader logs this with the exit value and JobNode
+
+RSS_SAMPLE_SECONDS = 1.0
+RSS_SCAN_SECONDS   = 10.0  # how often all of /proc is scanned for a job's processes, without the children files
+PAGE_SIZE          = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+_active_records = []  # stack of records for the job functions running in this process
+_counts_lock    = threading.Lock()
+
+
+def _cpuTime():
+    own      = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _processPeakRss():
+    # ru_maxrss is in kilobytes on Linux, it is the high-water mark over the worker's whole life (or that of
+    # its biggest waited-for child), which includes the jobs Toil ran in the worker before this one
+    own      = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return 1024 * max(own, children)
+
+
+def _processRss(pid):
+    """resident bytes of a process, 0 if it's gone
+    """
+    try:
+        with open("/proc/{}/statm".format(pid), "r") as fH:
+            return int(fH.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+
+def _childrenFilesExist(pid):
+    # /proc/<pid>/task/<tid>/children needs a kernel with CONFIG_PROC_CHILDREN
+    return os.path.exists("/proc/{pid}/task/{pid}/children".format(pid=pid))
+
+
+def _descendants(pid):
+    """the pids of the processes started by `pid` (and by them), e.g. the native tools a job runs, found by
+    following the children files of each process's threads from `pid` down
+    """
+    found, stack = [], [pid]
+    while stack:
+        parent = stack.pop()
+        for children_path in glob.glob("/proc/{}/task/*/children".format(parent)):
+            try:
+                with open(children_path, "r") as fH:
+                    children = [int(child) for child in fH.read().split()]
+            except (IOError, OSError, ValueError):  # the process or thread has gone
+                continue
+            found.extend(children)
+            stack.extend(children)
+    return found
+
+
+def _scanDescendants(pid):
+    """the same as _descendants for kernels without the children files, from the parent pid of every process.
+    it reads all of /proc so it's done every RSS_SCAN_SECONDS rather than every sample
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry), "r") as fH:
+                ppid = int(fH.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    found, stack = [], list(children.get(pid, []))
+    while stack:
+        child = stack.pop()
+        found.append(child)
+        stack.extend(children.get(child, []))
+    return found
+
+
+def _highWaterMark():
+    """VmHWM of this process in bytes, the peak since it was last reset through clear_refs
+    """
+    with open("/proc/self/status", "r") as fH:
+        for line in fH:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class PeakRssMonitor(object):
+    """the peak resident memory of one job: the worker's own peak since the job started (its high-water mark
+    is reset at the start, for the outermost instrumented job) or, when that can't be reset, the peak of the
+    RSS sampled every RSS_SAMPLE_SECONDS, plus the RSS of the processes the job starts (found from the job's
+    process down, or by a scan of /proc every RSS_SCAN_SECONDS where the kernel doesn't list the children of a
+    process). without /proc it falls back to the worker's lifetime peak, and `scope` says so
+    """
+    def __init__(self, reset_high_water_mark):
+        self.reset     = reset_high_water_mark
+        self.hwm_reset = False
+        self.peak      = 0
+        self.scope     = "job" if os.path.exists("/proc/self/statm") else "process"
+        self._pid      = os.getpid()
+        self._stop     = threading.Event()
+        self._thread   = None
+
+    def _sample(self):
+        walk        = _childrenFilesExist(self._pid)
+        descendants = []
+        last_scan   = None
+        while True:
+            if walk:
+                descendants = _descendants(self._pid)
+            elif last_scan is None or time.time() - last_scan >= RSS_SCAN_SECONDS:
+                descendants = _scanDescendants(self._pid)
+                last_scan   = time.time()
+            rss       = _processRss(self._pid) + sum(_processRss(pid) for pid in descendants)
+            self.peak = max(self.peak, rss)
+            if self._stop.wait(RSS_SAMPLE_SECONDS):
+                return
+
+    def start(self):
+        if self.scope != "job":
+            return self
+        if self.reset:
+            try:
+                with open("/proc/self/clear_refs", "w") as fH:
+                    fH.write("5")  # resets VmHWM to the current RSS
+                self.hwm_reset = True
+            except (IOError, OSError):
+                pass
+        self._thread        = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.scope != "job":
+            return _processPeakRss()
+        self._stop.set()
+        self._thread.join()
+        if self.hwm_reset:  # catches the short spikes between samples
+            self.peak = max(self.peak, _highWaterMark())
+        return self.peak
+
+
+def _fileSize(file_store_id, local_path=None):
+    size = getattr(file_store_id, "size", None)
+    if isinstance(size, numbers.Integral):
+        return size
+    if local_path is not None and os.path.exists(local_path):
+        return os.path.getsize(local_path)
+    return 0
+
+
+def _directorySize(path):
+    total = 0
+    if path is None:
+        return total
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+def describeJobInputs(args):
+    """finds the sample label, shard description, input bytes and the config in the arguments to a
+    job function, lists of shards and FileStoreIDs (e.g. a group of shards) count towards the input bytes
+    """
+    sample      = ""
+    shard       = ""
+    input_bytes = 0
+    config      = None
+    for arg in args:
+        if isinstance(arg, dict):
+            if config is None and "output_dir" in arg:
+                config = arg
+            if not sample and isinstance(arg.get("sample_label"), str):
+                sample = arg["sample_label"]
+        elif hasattr(arg, "label") and hasattr(arg, "file_size"):  # a Sample
+            sample       = sample or arg.label
+            input_bytes += arg.file_size
+        elif hasattr(arg, "start") and hasattr(arg, "FileStoreID"):  # an AlignmentShard
+            contig       = getattr(arg, "contig", None)
+            region       = "{start}-{end}".format(start=arg.start, end=arg.end)
+            shard        = region if contig is None else "{contig}:{region}".format(contig=contig, region=region)
+            input_bytes += _fileSize(arg.FileStoreID)
+        elif isinstance(arg, list):
+            input_bytes += describeJobInputs(arg)[2]
+        else:
+            input_bytes += _fileSize(arg)
+    return sample, shard, input_bytes, config
+
+
+def _profileRequested(config, stage, job_function_name):
+    if config is None:
+        return False
+    profile_jobs = config.get("profile_jobs") or []
+    return job_function_name in profile_jobs or stage in profile_jobs
+
+
+class JobTelemetry(object):
+    """Measures one job function and reports a telemetry record to the leader when it finishes. While it's
+    active the file store's global file reads and writes are counted. When profiling is requested the
+    cProfile stats are written to the job store and their FileStoreID is put in the record.
+    """
+    def __init__(self, job, stage, job_function_name, args):
+        sample, shard, input_bytes, config = describeJobInputs(args)
+        self.job      = job
+        self.config   = config
+        self.profiler = cProfile.Profile() if _profileRequested(config, stage, job_function_name) else None
+        self.saved    = {}
+        self.record = {
+            "record_id"       : uuid.uuid4().hex,
+            "stage"           : stage,
+            "sample"          : sample,
+            "shard"           : shard,
+            "job_function"    : job_function_name,
+            "input_bytes"     : input_bytes,
+            "requested_memory": getattr(job, "memory", None),
+            "requested_disk"  : getattr(job, "disk", None),
+            "bytes_read"      : 0,
+            "bytes_written"   : 0,
+            "failed"          : False,
+            "counts"          : {},
+            "profile_fid"     : None,
+        }
+
+    def _countFileStoreTraffic(self):
+        file_store = self.job.fileStore
+        self.saved = {m: vars(file_store)[m] for m in ("readGlobalFile", "writeGlobalFile")
+                      if m in vars(file_store)}
+        read       = file_store.readGlobalFile
+        write      = file_store.writeGlobalFile
+
+        def readGlobalFile(fileStoreID, *args, **kwargs):
+            local_path = read(fileStoreID, *args, **kwargs)
+            self.record["bytes_read"] += _fileSize(fileStoreID, local_path)
+            return local_path
+
+        def writeGlobalFile(localFileName, *args, **kwargs):
+            self.record["bytes_written"] += _fileSize(None, localFileName)
+            return write(localFileName, *args, **kwargs)
+
+        file_store.readGlobalFile  = readGlobalFile
+        file_store.writeGlobalFile = writeGlobalFile
+
+    def _restoreFileStore(self):
+        # put back whatever was there before, an enclosing JobTelemetry's counters or the class methods
+        for method in ("readGlobalFile", "writeGlobalFile"):
+            if method in self.saved:
+                setattr(self.job.fileStore, method, self.saved[method])
+            elif method in vars(self.job.fileStore):
+                delattr(self.job.fileStore, method)
+
+    def _uploadProfile(self):
+        stats_file = self.job.fileStore.getLocalTempFile()
+        self.profiler.dump_stats(stats_file)
+        self.record["profile_fid"] = self.job.fileStore.writeGlobalFile(stats_file)
+
+    def __enter__(self):
+        self._countFileStoreTraffic()
+        # a nested job function mustn't reset the high-water mark that the enclosing one is measured with
+        self.rss_monitor = PeakRssMonitor(reset_high_water_mark=(not _active_records)).start()
+        _active_records.append(self.record)
+        self.start_wall = time.time()
+        self.start_cpu  = _cpuTime()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.record["wall_time"]  = time.time() - self.start_wall
+        self.record["cpu_time"]   = _cpuTime() - self.start_cpu
+        self.record["peak_rss"]       = self.rss_monitor.stop()
+        self.record["peak_rss_scope"] = self.rss_monitor.scope
+        self.record["local_disk"] = _directorySize(getattr(self.job.fileStore, "localTempDir", None))
+        self.record["failed"]     = exc_type is not None
+        _active_records.pop()
+        self._restoreFileStore()
+        if self.profiler is not None:
+            self._uploadProfile()
+        self.job.fileStore.logToMaster(TELEMETRY_TAG + json.dumps(self.record, default=str))
+        return False
+
+
+def addTelemetryCounts(**counts):
+    """adds named counts (e.g. dropped reads) to the record of the job function that's currently running,
+    does nothing when called outside of an instrumented job function. safe to call from a job's threads
+    """
+    if not _active_records:
+        return
+    with _counts_lock:
+        record_counts = _active_records[-1]["counts"]
+        for key, value in counts.items():
+            record_counts[key] = record_counts.get(key, 0) + value
+
+
+def instrumentJobFunction(stage, job_function_name=None):
+    """decorator for job functions, records telemetry for each invocation under `stage`. use
+    `job_function_name` to report a wrapper under the name of the job function it wraps. the undecorated
+    function is kept as `uninstrumented`, for calling from threads (the recording isn't thread safe)
+    """
+    def decorator(job_function):
+        name = job_function_name or job_function.__name__
+
+        @wraps(job_function)
+        def wrapper(job, *args, **kwargs):
+            with JobTelemetry(job, stage, name, args + tuple(kwargs.values())) as telemetry:
+                try:
+                    return job_function(job, *args, **kwargs)
+                except Exception as e:
+                    retry_memory = _oomRetryMemory(job, telemetry.config) if _outOfMemory(e) else None
+                    if retry_memory is None:
+                        raise
+                    addTelemetryCounts(oom=1)
+                    job.fileStore.logToMaster("[{fn}]Out of memory with {m} bytes, retrying with {r}"
+                                              "".format(fn=name, m=job.memory, r=retry_memory))
+                    return job.addChildJobFn(wrapper, *args, memory=retry_memory, disk=job.disk, cores=job.cores,
+                                             **kwargs).rv()
+        wrapper.uninstrumented = job_function
+        return wrapper
+    return decorator
+
+
+def _outOfMemory(error):
+    # a tool that was killed (by the OOM killer, or by the batch system for going over the job's memory) raises
+    # a CalledProcessError with the signal's exit code, from docker_call and from runTool alike
+    return isinstance(error, MemoryError) or getattr(error, "returncode", None) in KILLED_EXIT_CODES
+
+
+def jobUnitName(stage, input_bytes):
+    """the name (Toil's unitName) of the jobs issued with resources.predictedResources. a job whose worker is
+    killed never sends its record, the leader gets the job's stage and input size from its name instead
+    """
+    return "{stage}:{input_bytes}".format(stage=stage, input_bytes=input_bytes)
+
+
+def parseUnitName(unit_name):
+    """(stage, input bytes) from a jobUnitName, (None, None) for jobs that weren't named by it
+    """
+    stage, _, input_bytes = (unit_name or "").rpartition(":")
+    if not stage or not input_bytes.isdigit():
+        return None, None
+    return stage, int(input_bytes)
+
+
+def _oomRetryMemory(job, config):
+    """the memory to retry a job that ran out of memory with, twice what it had up to `resource_max_memory`.
+    None if it can't be retried: it's at the limit already, or it had added successors before it failed
+    (they'd be added twice)
+    """
+    from bd2k.util.humanize import human2bytes
+
+    if config is None or not config.get("resource_max_memory"):
+        return None
+    if getattr(job, "_children", None) or getattr(job, "_followOns", None):
+        return None
+    max_memory = human2bytes(str(config["resource_max_memory"]))
+    if job.memory >= max_memory:
+        return None
+    return min(2 * job.memory, max_memory)
+
+
+class TelemetryCollector(logging.Handler):
+    """Logging handler for the leader that picks the telemetry records out of the messages the jobs
+    log to the master
+    """
+    def __init__(self):
+        logging.Handler.__init__(self, level=logging.DEBUG)
+        self.records             = []
+        self.record_ids          = set()
+        self.listeners           = []    # called with each new record, e.g. progress.ProgressTracker.update
+        self.peak_jobstore_bytes = None  # from a JobStoreUsageMonitor, when the job store could be measured
+
+    def attach(self):
+        logging.getLogger().addHandler(self)
+        return self
+
+    def detach(self):
+        logging.getLogger().removeHandler(self)
+
+    def emit(self, log_record):
+        if log_record.msg == TOIL_JOB_FAILED and len(log_record.args or ()) == 2:
+            self._jobFailed(*log_record.args)
+            return
+        message = log_record.getMessage()
+        i = message.find(TELEMETRY_TAG)
+        if i < 0:
+            return
+        try:
+            record = json.loads(message[i + len(TELEMETRY_TAG):])
+        except ValueError:
+            return
+        if record["record_id"] in self.record_ids:  # same message logged twice
+            return
+        self.record_ids.add(record["record_id"])
+        self.records.append(record)
+        for listener in self.listeners:
+            listener(record)
+
+    def _jobFailed(self, exit_value, job_node):
+        """a job that was killed sends no record, one is made for it from its JobNode (counted as out of memory,
+        so that the resource model learns from it) and listed in the report. its stage is its job function's
+        name and its input size is unknown unless it was named by jobUnitName
+        """
+        if exit_value not in KILLED_EXIT_CODES:
+            return
+        stage, input_bytes = parseUnitName(getattr(job_node, "unitName", None))
+        job_name           = getattr(job_node, "jobName", str(job_node))
+        self.records.append({
+            "record_id"       : uuid.uuid4().hex,
+            "stage"           : stage or job_name,
+            "sample"          : "",
+            "shard"           : "",
+            "job_function"    : job_name,
+            "job_store_id"    : getattr(job_node, "jobStoreID", None),
+            "input_bytes"     : input_bytes,
+            "requested_memory": getattr(job_node, "memory", None),
+            "requested_disk"  : getattr(job_node, "disk", None),
+            "wall_time"       : 0.0,
+            "cpu_time"        : 0.0,
+            "peak_rss"        : 0,
+            "peak_rss_scope"  : None,
+            "bytes_read"      : 0,
+            "bytes_written"   : 0,
+            "local_disk"      : None,
+            "failed"          : True,
+            "killed"          : True,
+            "counts"          : {"oom": 1, "killed": 1},
+            "profile_fid"     : None,
+        })
+
+    def killedJobs(self):
+        return [{"job_function": r["job_function"], "job_store_id": r["job_store_id"],
+                 "requested_memory": r["requested_memory"]} for r in self.records if r.get("killed")]
+
+    def stageSummary(self):
+        summary = {}
+        for record in self.records:
+            stage = summary.setdefault(record["stage"], {"jobs": 0, "wall_time": 0.0, "cpu_time": 0.0,
+                                                         "max_peak_rss": 0, "input_bytes": 0,
+                                                         "bytes_read": 0, "bytes_written": 0, "counts": {}})
+            stage["jobs"]         += 1
+            stage["wall_time"]    += record["wall_time"]
+            stage["cpu_time"]     += record["cpu_time"]
+            stage["max_peak_rss"]  = max(stage["max_peak_rss"], record["peak_rss"])
+            stage["input_bytes"]  += record["input_bytes"] or 0
+            stage["bytes_read"]   += record["bytes_read"]
+            stage["bytes_written"] += record["bytes_written"]
+            for key, value in record["counts"].items():
+                stage["counts"][key] = stage["counts"].get(key, 0) + value
+        for stage in summary.values():  # e.g. posterior_cache_hits and _misses make posterior_cache_hit_rate
+            counts = stage["counts"]
+            for key in [k for k in counts if k.endswith("_hits")]:
+                prefix  = key[:-len("_hits")]
+                lookups = counts[key] + counts.get(prefix + "_misses", 0)
+                if lookups:
+                    stage[prefix + "_hit_rate"] = float(counts[key]) / lookups
+            if counts.get("tool_calls"):  # from execution.runTool, compare the tool_backend choices
+                stage["tool_seconds_per_call"] = float(counts.get("tool_seconds", 0)) / counts["tool_calls"]
+        return summary
+
+    def writeReport(self, workdir, sample_label):
+        """writes {sample}_telemetry.tsv (one row per job) and {sample}_telemetry.json (records and a
+        per-stage summary) to `workdir`, returns the paths
+        """
+        tsv_path  = os.path.join(workdir, "{}_telemetry.tsv".format(sample_label))
+        json_path = os.path.join(workdir, "{}_telemetry.json".format(sample_label))
+        with open(tsv_path, "w") as fH:
+            fH.write("#" + "\t".join(TELEMETRY_FIELDS + ["counts"]) + "\n")
+            for record in sorted(self.records, key=lambda r: (r["stage"], -r["wall_time"])):
+                counts = ",".join("%s=%s" % (k, v) for k, v in sorted(record["counts"].items()))
+                fH.write("\t".join([str(record[f]) for f in TELEMETRY_FIELDS] + [counts]) + "\n")
+        with open(json_path, "w") as fH:
+            json.dump({"sample": sample_label, "stages": self.stageSummary(), "records": self.records,
+                       "killed_jobs": self.killedJobs(), "peak_jobstore_bytes": self.peak_jobstore_bytes},
+                      fH, indent=2, sort_keys=True)
+        return [tsv_path, json_path]
+
+    def slowestProfiles(self, top_n):
+        """returns the [(stage, rank, record)...] for the `top_n` slowest profiled jobs in each stage
+        """
+        by_stage = {}
+        for record in self.records:
+            if record.get("profile_fid") is not None:
+                by_stage.setdefault(record["stage"], []).append(record)
+        slowest = []
+        for stage, records in sorted(by_stage.items()):
+            records.sort(key=lambda r: r["wall_time"], reverse=True)
+            slowest.extend([(stage, rank, record) for rank, record in enumerate(records[:top_n])])
+        return slowest
+
+
+class JobStoreUsageMonitor(object):
+    """Samples the size of a file job store on the leader while the workflow runs and keeps the peak. other
+    job stores (e.g. aws:) can't be measured from the leader, the peak stays None for those
+    """
+    def __init__(self, job_store_locator, interval=10):
+        if job_store_locator.startswith("file:"):
+            job_store_locator = job_store_locator[len("file:"):]
+        self.path     = job_store_locator if ":" not in job_store_locator else None
+        self.interval = interval
+        self.peak     = None
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    def _sample(self):
+        while True:
+            if os.path.isdir(self.path):
+                self.peak = max(self.peak or 0, _directorySize(self.path))
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        if self.path is not None:
+            self._thread        = threading.Thread(target=self._sample)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        return self.peak
+
+
+def deliverTelemetryReport(toil, collector, config, sample_label):
+    """writes the report on the leader and exports it to `output_dir` through the job store, a failure
+    to deliver the report is reported but doesn't fail the run
+    """
+    if collector.peak_jobstore_bytes is not None:
+        print("[deliverTelemetryReport]Peak job store usage for {sample} was {n} bytes"
+              "".format(sample=sample_label, n=collector.peak_jobstore_bytes), file=sys.stderr)
+    if not collector.records:
+        return
+    workdir = tempfile.mkdtemp()
+    try:
+        for path in collector.writeReport(workdir, sample_label):
+            file_id = toil.importFile("file://" + path)
+            toil.exportFile(file_id, config["output_dir"] + os.path.basename(path))
+        for stage, rank, record in collector.slowestProfiles(config.get("profile_top_n", 3)):
+            profile_name = "{sample}_{stage}_{rank}_{fn}.pstats".format(sample=sample_label, stage=stage,
+                                                                       rank=rank, fn=record["job_function"])
+            toil.exportFile(record["profile_fid"], config["output_dir"] + profile_name)
+    except Exception as e:
+        print("[deliverTelemetryReport]Failed to deliver telemetry report: {}".format(e), file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir)
@@ -5,31 +5,43 @@ import sys
 import argparse
 import os
 import textwrap
-import yaml
 import uuid
 from urlparse import urlparse
 
-from bd2k.util.humanize import human2bytes
-
-from toil.common import Toil
-from toil.job import Job
+# n.b. toil, marginAlign (and with it pysam, numpy and pandas) are slow to import, they're imported in the
+# functions that use them so that `generate`, `--help` and Toil workers running light jobs start quickly
 from toil_lib import UserError, require
 from toil_lib.files import generate_file
-from toil_lib.programs import docker_call
-
-from margin.toil.localFileManager import LocalFile, urlDownload, urlDownlodJobFunction, importToJobstore
-from margin.toil.hmm import Hmm
-from margin.toil.alignment import AlignmentStruct, AlignmentFormat, shardAlignmentByRegionJobFunction
-from margin.toil.stats import collectAlignmentStatsJobFunction
 
 from sample import Sample
-from marginAlignToil import bwaAlignJobFunction, chainSamFileJobFunction
-from marginCallerToil import marginCallerJobFunction
+from telemetry import instrumentJobFunction, TelemetryCollector, JobStoreUsageMonitor, deliverTelemetryReport
+from fingerprint import computeStageFingerprints, callsFingerprint, stageComplete, fingerprintedStageJobFunction
+from reference import sliceReferenceJobFunction
+from sharding import shardAlignmentByRegionJobFunction
+from targets import loadTargetsJobFunction
+from posterior_cache import evictPosteriorCache
+from release import releaseAfter
+from execution import runTool
+from progress import ProgressTracker
+from ingest import ingestFilterOn, ingestReadsJobFunction, ReadFilter
+from resources import predictedResources, fitResourceModel, appendResourceHistory
+
+
+def configWithoutPromises(config):
+    """a copy of the config without the promises in it, for the root's children that run alongside the jobs
+    that fulfil them. a job's arguments can't hold promises of its siblings (or of the job itself)
+    """
+    from toil.job import Promise
 
+    return dict((key, value) for key, value in config.iteritems() if not isinstance(value, Promise))
 
-def getFastqFromBam(job, bam_sample, samtools_image="quay.io/ucsc_cgl/samtools"):
+
+@instrumentJobFunction("bam_to_fastq")
+def getFastqFromBam(job, config, bam_sample, samtools_image="quay.io/ucsc_cgl/samtools"):
     # n.b. this is NOT a jobFunctionWrappingJob, it just takes the parent job as 
     # an argument to have access to the job store
+    from margin.toil.localFileManager import LocalFile, urlDownload
+
     # download the BAM to the local directory, use a uid to aviod conflicts
     uid           = uuid.uuid4().hex
     work_dir      = job.fileStore.getLocalTempDir()
@@ -44,7 +56,7 @@ def getFastqFromBam(job, bam_sample, samtools_image="quay.io/ucsc_cgl/samtools")
     # TODO use DOCKER_DIR and clean this up. idea: make globls.py or something
     samtools_parameters = ["fastq", "/data/{}".format(local_bam.filenameGetter())]
     with open(fastq_reads.fullpathGetter(), 'w') as fH:
-        docker_call(job=job, tool=samtools_image, parameters=samtools_parameters, work_dir=work_dir, outfile=fH)
+        runTool(job, config, samtools_image, parameters=samtools_parameters, work_dir=work_dir, outfile=fH)
 
     require(os.path.exists(fastq_reads.fullpathGetter()), "[getFastqFromBam]didn't generate reads")
 
@@ -52,20 +64,62 @@ def getFastqFromBam(job, bam_sample, samtools_image="quay.io/ucsc_cgl/samtools")
     return job.fileStore.writeGlobalFile(fastq_reads.fullpathGetter())
 
 
+@instrumentJobFunction("root")
 def marginAlignRootJobFunction(job, config, sample):
+    from bd2k.util.humanize import human2bytes
+    from margin.toil.localFileManager import urlDownlodJobFunction
+    from marginAlignToil import statsNeedReads
+
     def cull_sample_files():
+        config["sample_FileStoreID"] = None
         if sample.file_type == "fq":
-            config["sample_FileStoreID"] = job.addChildJobFn(urlDownlodJobFunction, sample.URL, disk=sample.file_size).rv()
+            if need_reads and ingestFilterOn(config):
+                config["sample_FileStoreID"] = job.addChildJobFn(ingestReadsJobFunction,
+                                                                 ReadFilter.fromConfig(config), sample,
+                                                                 disk=(2 * sample.file_size)).rv()
+            elif need_reads:
+                config["sample_FileStoreID"] = job.addChildJobFn(urlDownlodJobFunction, sample.URL, disk=sample.file_size).rv()
             return None
         elif sample.file_type == "bam":
-            bwa_alignment_fid = job.addChildJobFn(urlDownlodJobFunction, sample.URL, disk=sample.file_size).rv()
-            config["sample_FileStoreID"] = job.addChildJobFn(getFastqFromBam, sample, disk=(2 * sample.file_size)).rv()
+            bwa_alignment_fid = None
+            if need_input_alignment or input_stats_pending or (config["chain"] is None and config["realign"] is None):
+                bwa_alignment_fid = job.addChildJobFn(urlDownlodJobFunction, sample.URL, disk=sample.file_size).rv()
+            if need_reads:
+                config["sample_FileStoreID"] = job.addChildJobFn(getFastqFromBam, configWithoutPromises(config), sample,
+                                                                 disk=(2 * sample.file_size)).rv()
             return bwa_alignment_fid
         else:
             raise RuntimeError("[marginAlignRootJobFunction]Unsupported sample file type %s" % sample.file_type)
 
-    # download/import the reference
-    config["reference_FileStoreID"] = job.addChildJobFn(urlDownlodJobFunction, config["ref"], disk=config["ref_size"]).rv()
+    config["sample_label"]    = sample.label
+    config["reference_label"] = config["ref"]
+
+    # find the stages whose outputs from a previous run are still valid, we don't need the input alignment
+    # or reads for those
+    config["fingerprints"]     = computeStageFingerprints(config, sample)
+    realign_label              = "realigned" if config["chain"] else "noChain_realigned"
+    config["chain_complete"]   = bool(config["chain"]) and \
+        stageComplete(job, config, "chained", config["fingerprints"]["chained"])
+    config["realign_complete"] = bool(config["realign"]) and \
+        stageComplete(job, config, realign_label, config["fingerprints"]["realigned"])
+    need_input_alignment       = (config["chain"] and not config["chain_complete"]) or \
+        (config["realign"] and not config["chain"] and not config["realign_complete"])
+    need_reads                 = need_input_alignment or config["stats"]
+    # without calling, the stats are collected on the input alignment (see marginAlignJobFunction)
+    input_stats_pending        = bool(config["stats"]) and not config["caller"] and \
+        not stageComplete(job, config, "stats", callsFingerprint(config, "input", "stats", kind="stats"))
+
+    # download/import the reference, then slice it by contig so that the realignment and calling shards
+    # only download the contig they align to
+    reference_job                   = job.addChildJobFn(urlDownlodJobFunction, config["ref"], disk=config["ref_size"])
+    config["reference_FileStoreID"] = reference_job.rv()
+    config["reference_slices"]      = reference_job.addFollowOnJobFn(sliceReferenceJobFunction, reference_job.rv(),
+                                                                     disk=(2 * human2bytes(config["ref_size"]))).rv()
+
+    # parse the target regions, if given, realignment and calling are restricted to them
+    # only the URL goes to the job, the config holds the promises of the root's other children
+    config["targets"] = job.addChildJobFn(loadTargetsJobFunction, config["target_regions"]).rv() \
+        if config["target_regions"] else None
 
     # cull the sample, which can be a fastq or a BAM this will be None if we are doing BWA alignment
     alignment_fid = cull_sample_files()
@@ -86,25 +140,42 @@ def marginAlignRootJobFunction(job, config, sample):
         if config["EM"]:
             config["normalized_trained_model_FileStoreID"] = None
 
-    config["sample_label"]    = sample.label
-    config["reference_label"] = config["ref"]
-
     job.fileStore.logToMaster("[run_tool]Processing sample:{}".format(config["sample_label"]))
     job.fileStore.logToMaster("[run_tool]Chaining   :{}".format(config["chain"]))
     job.fileStore.logToMaster("[run_tool]Realign    :{}".format(config["realign"]))
     job.fileStore.logToMaster("[run_tool]Caller     :{}".format(config["caller"]))
     job.fileStore.logToMaster("[run_tool]Stats      :{}".format(config["stats"]))
 
-    job.addFollowOnJobFn(marginAlignJobFunction, config, alignment_fid)
+    # when stats use the reads they're deleted from the job store after everything else, otherwise chaining
+    # deletes them
+    if statsNeedReads(config):
+        releaseAfter(job, config["sample_FileStoreID"]).addChildJobFn(marginAlignJobFunction, config, alignment_fid)
+    else:
+        job.addFollowOnJobFn(marginAlignJobFunction, config, alignment_fid)
 
 
+@instrumentJobFunction("align")
 def marginAlignJobFunction(job, config, input_alignment_fid):
-    if config["realign"] or config["chain"]:  # perform EM/Alignment/chaining
-        if input_alignment_fid is None:
+    from margin.toil.alignment import AlignmentStruct, AlignmentFormat
+    from alignment_format import importAlignment
+    from stats import collectAlignmentStatsJobFunction
+    from marginAlignToil import bwaAlignJobFunction, chainSamFileJobFunction, realignmentRootJobFunction
+
+    chain_pending   = config["chain"] and not config["chain_complete"]
+    realign_pending = config["realign"] and not config["realign_complete"]
+    if chain_pending or realign_pending:  # perform EM/Alignment/chaining
+        if config["chain"] and not chain_pending:  # realign the chained alignment from the previous run
+            chained_aln_fid = importAlignment(job, config, "chained")
+            releaseAfter(job, chained_aln_fid).addChildJobFn(realignmentRootJobFunction, config, chained_aln_fid)
+        elif input_alignment_fid is None:
             job.addChildJobFn(bwaAlignJobFunction, config)  # this passes on to the chainSam...
         else:
             aln_struct = AlignmentStruct(input_alignment_fid, AlignmentFormat.BAM)
-            job.addChildJobFn(chainSamFileJobFunction, config, aln_struct, memory=(6 * input_alignment_fid.size))
+            job.addChildJobFn(chainSamFileJobFunction, config, aln_struct,
+                              **predictedResources(config, "chain", (config, input_alignment_fid),
+                                                   memory=(6 * input_alignment_fid.size)))
+    elif config["realign"] or config["chain"]:
+        job.fileStore.logToMaster("[marginAlignJobFunction]Alignments are up to date")
 
     # TODO work out the logic here, we want to be able to get stats on an input alignment, but we don't want to
     # just get stats on the input if we're realigning...
@@ -112,77 +183,83 @@ def marginAlignJobFunction(job, config, input_alignment_fid):
         job.addFollowOnJobFn(callVariantsAndGetStatsJobFunction, config, input_alignment_fid)
         return
     if config["stats"]:
-        job.addFollowOnJobFn(collectAlignmentStatsJobFunction, config, input_alignment_fid, config["sample_label"])
+        stats_fingerprint = callsFingerprint(config, "input", "stats", kind="stats")
+        if not stageComplete(job, config, "stats", stats_fingerprint):
+            job.addFollowOnJobFn(fingerprintedStageJobFunction, config, "stats", stats_fingerprint,
+                                 collectAlignmentStatsJobFunction, (config, input_alignment_fid, config["sample_label"]))
 
 
+@instrumentJobFunction("call_and_stats")
 def callVariantsAndGetStatsJobFunction(job, config, input_alignment_fid):
+    from margin.toil.localFileManager import urlDownlodJobFunction
+    from alignment_format import importAlignment
+    from marginCallerToil import pendingCalls, callsStage, errorModelUrl, realignedCallConfigs, chainedCallConfig, \
+        chainedCallsAlongsideRealignment, addChainedStats
+
     # handle downloading the error model, use the EM trained model, if we did EM
     if config["EM"] is not None and config["realign"] is not None:
         job.fileStore.logToMaster("[callVariantsAndGetStatsJobFunction]Using EM trained error model")
-        config["error_model_FileStoreID"] = job.addChildJobFn(urlDownlodJobFunction,
-                                                              Hmm.modelFilename(global_config=config, get_url=True),
-                                                              disk="10M").rv()
     else:  # use the user provided one
-        require(config["error_model"],
-                "[callVariantsAndGetStatsJobFunction]Need to provide a error model if not performing EM")
         job.fileStore.logToMaster("[callVariantsAndGetStatsJobFunction]Using user-supplied error model "
                                   "from {}".format(config["error_model"]))
-        config["error_model_FileStoreID"] = job.addChildJobFn(urlDownlodJobFunction,
-                                                              config["error_model"],
-                                                              disk="10M").rv()
+    config["error_model_FileStoreID"] = job.addChildJobFn(urlDownlodJobFunction, errorModelUrl(config),
+                                                          disk="10M").rv()
+
+    if config.get("live_label"):  # a chunk from `watch`, add its posteriors to the running totals
+        from live import finalAlignmentLabel, liveCallsJobFunction
+        alignment_label    = finalAlignmentLabel(config)
+        require(alignment_label is not None or input_alignment_fid is not None,
+                "[callVariantsAndGetStatsJobFunction]Live calling needs chain or realign with FASTQ input")
+        alignment_fid      = importAlignment(job, config, alignment_label) if alignment_label \
+            else input_alignment_fid
+        sharded_alignments = job.addChildJobFn(shardAlignmentByRegionJobFunction, config, alignment_fid).rv()
+        releaseAfter(job, sharded_alignments).addChildJobFn(liveCallsJobFunction, config, alignment_fid,
+                                                            sharded_alignments)
+        return
+
+    def issue_calls(alignment, get_alignment_fid, labelled_configs, resources=None):
+        # shards the alignment once and calls variants on it with each (config, label) whose outputs aren't
+        # already up to date, returns the alignment's FileStoreID when it was needed
+        pending = pendingCalls(job, alignment, labelled_configs)
+        for label_config, label, fingerprint in pending:  # only the threshold has changed, no need to shard
+            if label_config["expectations_complete"]:
+                job.addChildJobFn(fingerprintedStageJobFunction, label_config, "calls_" + label, fingerprint,
+                                  *callsStage(label_config, label, None, None))
+        pending = [(label_config, label, fingerprint) for label_config, label, fingerprint in pending
+                   if not label_config["expectations_complete"]]
+        if not pending:
+            return None
+        alignment_fid      = get_alignment_fid()
+        sharded_alignments = job.addChildJobFn(shardAlignmentByRegionJobFunction, config, alignment_fid).rv()
+        # the shards are deleted once every label has been called
+        consumers          = releaseAfter(job, sharded_alignments)
+        for label_config, label, fingerprint in pending:
+            consumers.addChildJobFn(fingerprintedStageJobFunction, label_config, "calls_" + label, fingerprint,
+                                    *callsStage(label_config, label, alignment_fid, sharded_alignments),
+                                    resources=resources)
+        return alignment_fid
 
     # if we're just variant calling a supplied BAM go here with the downloaded model
     if config["chain"] is None and config["realign"] is None:
         margin_label = "noMargin" if config["no_margin"] else "margin"
         job.fileStore.logToMaster("[callVariantsAndGetStatsJobFunction]Calling variants with model {model} "
                                   "no margin is {margin}".format(model=config["error_model"], margin=config["no_margin"]))
-        sharded_alignments = job.addChildJobFn(shardAlignmentByRegionJobFunction,
-                                               config["reference_FileStoreID"],
-                                               input_alignment_fid,
-                                               config["split_chromosome_this_length"]).rv()
-        job.addFollowOnJobFn(marginCallerJobFunction, config, input_alignment_fid, sharded_alignments,
-                             margin_label, disk=(3 * input_alignment_fid.size))
+        issue_calls("input", lambda: input_alignment_fid, [(config, margin_label)],
+                    resources={"disk": (3 * input_alignment_fid.size)})
         return
 
-    if config["chain"]:  # variant call the chained alignment
-        chained_config              = dict(**config)  # copy constructor
-        chained_config["no_margin"] = True
-        chained_config["stats"]     = True
-        chained_aln_url             = config["output_dir"] + "{}_chained.bam".format(config["sample_label"])
-        chained_alignment_fid       = importToJobstore(job, chained_aln_url)
-        sharded_chained_alignments  = job.addChildJobFn(shardAlignmentByRegionJobFunction,
-                                                        config["reference_FileStoreID"],
-                                                        chained_alignment_fid,
-                                                        config["split_chromosome_this_length"]).rv()
-        job.addFollowOnJobFn(marginCallerJobFunction, chained_config, chained_alignment_fid,
-                             sharded_chained_alignments, "chained")
+    if config["chain"]:  # variant call the chained alignment and collect its stats, unless they were done
+        chained_config = chainedCallConfig(config)  # alongside realignment
+        if not chainedCallsAlongsideRealignment(config):
+            chained_fid = issue_calls("chained", lambda: importAlignment(job, config, "chained"),
+                                      [(chained_config, "chained")])
+            addChainedStats(job, config, lambda: chained_fid or importAlignment(job, config, "chained"))
     else:  # variant call the input alignment
-        sharded_alignments = job.addChildJobFn(shardAlignmentByRegionJobFunction,
-                                               config["reference_FileStoreID"],
-                                               input_alignment_fid,
-                                               config["split_chromosome_this_length"]).rv()
-        job.addFollowOnJobFn(marginCallerJobFunction, chained_config, input_alignment_fid, sharded_alignments, "")
-
-    if config["realign"]:
-        realigned_alignment_url      = config["output_dir"] + "{}_realigned.bam".format(config["sample_label"])
-        realigned_alignment_fid      = importToJobstore(job, realigned_alignment_url)
-        sharded_realigned_alignments = job.addChildJobFn(shardAlignmentByRegionJobFunction,
-                                                         config["reference_FileStoreID"],
-                                                         realigned_alignment_fid,
-                                                         config["split_chromosome_this_length"]).rv()
-        em_label         = "em" if config["EM"] else ""
-        realign_em_label = em_label + "Realign" if config["chain"] else em_label + "RealignNoChain"
-        job.addFollowOnJobFn(marginCallerJobFunction, config, realigned_alignment_fid, sharded_realigned_alignments,
-                             realign_em_label)
-
-        # handle the same alignment without marginalization
-        no_margin_config              = dict(**config)
-        no_margin_config["no_margin"] = True
-        no_margin_config["stats"]     = False  # don't need to redo stats
-
-        realign_noMargin_label = em_label + "RealignNoMargin" if config["chain"] else em_label + "RealignNoMarginNoChain"
-        job.addFollowOnJobFn(marginCallerJobFunction, no_margin_config, realigned_alignment_fid,
-                             sharded_realigned_alignments, realign_noMargin_label)
+        issue_calls("input", lambda: input_alignment_fid, [(chained_config, "")])
+
+    # when the realignment was done in this run each contig was called as soon as it had been realigned
+    if config["realign"] and config["realign_complete"]:
+        issue_calls("realigned", lambda: importAlignment(job, config, "realigned"), realignedCallConfigs(config))
 
 
 def print_help():
@@ -216,12 +293,24 @@ def generateConfig():
         # Warning: S3 buckets must exist prior to upload or it will fail.
         output_dir: s3://arand-sandbox/
 
+        # Optional: skip stages whose outputs in output_dir are up to date. each stage delivers a
+        # {sample}_{stage}.fingerprint (hash of its inputs and the options it uses) next to its outputs and a
+        # re-run only does the stages whose fingerprint changed. the summed expectations the variants are called
+        # from are delivered too ({sample}_{label}.expectations.*), so changing variant_threshold only redoes the
+        # thresholding and the VCF. set to False to redo everything
+        incremental: True
+
         # Required:
         #   ref:      URL for reference FASTA
         #   ref_size: the approx size of the input FASTA (used for resource allocation)
         ref:      s3://arand-sandbox/references.fa
         ref_size: 10M
 
+        # Optional: URL for a BED of target regions (for panel or adaptive-sampling runs). only alignments that
+        # overlap a target are realigned (the others are passed through unchanged) and variants are only called
+        # in the targets. leave blank to use the whole reference
+        target_regions:
+
 
         ##---------------------------##
         ## batching/sharding options ##
@@ -231,6 +320,12 @@ def generateConfig():
         #   split_chromosome_this_length:  used by: marginCaller, devides the alignment into pieces that align to
         #                                  regions of the chromosome that are this long, the smaller this length the
         #                                  faster variant calling will be, but there will be more I/O to get there
+        #   shard_by:                      used by: marginCaller, `length` cuts each chromosome into regions
+        #                                  `split_chromosome_this_length` long. `coverage` makes the same number
+        #                                  of regions but picks the boundaries so each region has about the same
+        #                                  number of aligned bases, so high-coverage regions don't hold up calling
+        #   coverage_bin_size:             used by: marginCaller when shard_by is `coverage`, resolution (in bases)
+        #                                  of the coverage histogram the region boundaries are picked from
         #   split_alignments_to_this_many: used by: marginAlign, shards the input alignment into
         #                                  smaller alignments that have this many AlignedSegments in them
         #   stats_alignment_batch_size:    used by: marginStats. same as `split_alignments_to_this_many` but
@@ -242,13 +337,31 @@ def generateConfig():
         #   max_alignments_per_job:          used by marginAlign and marginCaller, same as max_alignment_length_per_job,
         #                                    but for number of AlignedSegments
         #   cut_batch_at_alignment_this_big: makes a new batch then it reaches an AlignedSegment that is >= this length
+        #   cores_per_shard_job:             used by marginAlign and marginCaller, when > 1 each job takes this many
+        #                                    shards and runs their batches on this many cores, sharing one copy of
+        #                                    the reference and HMM, instead of a job per batch. use on big nodes
+        #
+        #   --# These options coalesce small pieces of work into fewer jobs, used by all of the subprograms #---
+        #   min_job_seconds:      when set, shards (or stats batches) are grouped into jobs until each job has about this
+        #                         many seconds of work per core, so the leader isn't swamped with sub-second jobs
+        #   job_seconds_per_mb:   estimated seconds of work per MB of alignment for each stage, used to size the groups
+        #   job_overhead_seconds: estimated scheduling overhead of one job, the overhead saved is in the telemetry
 
         split_alignments_to_this_many:   1000
         split_chromosome_this_length:    1000000
+        shard_by:                        length
+        coverage_bin_size:               1000
         stats_alignment_batch_size:      100
         max_alignment_length_per_job:    700000
         max_alignments_per_job:          300
         cut_batch_at_alignment_this_big: 20000
+        cores_per_shard_job:             1
+        min_job_seconds:                 0
+        job_seconds_per_mb:
+            realign: 120
+            caller:  60
+            stats:   10
+        job_overhead_seconds:            5
 
 
 
@@ -259,6 +372,74 @@ def generateConfig():
         gap_gamma:   0.5
         match_gamma: 0.0
 
+        # Optional: band the HMM around the guide (chained) alignment, for realignment and EM. band_width is the
+        # number of diagonals either side of the guide alignment's path the HMM can use, with a band the time
+        # per read is about linear in its length which makes ultra-long reads practical. band_trim is how many
+        # bases are trimmed off the ends of each anchoring gapless block. leave band_width blank for cPecan's
+        # default anchoring
+        band_width:
+        band_trim:  14
+
+        # Optional: only HMM realign the alignments that are likely to change, the others are passed through to
+        # the realigned BAM unchanged. an alignment is passed through when it's at least prefilter_min_length
+        # aligned bases long, has mapping quality of at least prefilter_min_mapq and identity (from the NM tag)
+        # of at least prefilter_min_identity. the fraction that was realigned is in the log and the telemetry
+        realign_prefilter:      False
+        prefilter_min_length:   1000
+        prefilter_min_mapq:     30
+        prefilter_min_identity: 0.95
+
+        # Optional: keep the HMM results (realignments and the posteriors for calling) in this directory and
+        # reuse them in later runs on the same reads, e.g. after adding a flowcell or when sweeping thresholds.
+        # it has to be on a filesystem the workers and the leader share. the least recently used results are
+        # removed after each run to keep it under posterior_cache_size, the hit rates are in the telemetry
+        # report. realignments are cached per read, but the posteriors for calling are cached per batch of a
+        # shard's reads (marginAlign's batches, cut in alignment order) so adding or removing reads changes the
+        # batches after them and only the calling of shards whose reads are unchanged hits. leave blank to disable
+        posterior_cache:
+        posterior_cache_size: 20G
+
+        # Optional: formats of the alignments. output_format is for the alignments delivered to output_dir,
+        # bam or cram (compressed against the reference, much smaller). intermediate_format is for the
+        # alignment shards that only live in the job store: sam, ubam (uncompressed BAM, cheapest to write and
+        # read) or bam. see tests/compressionBenchmark.py to compare them on your data
+        output_format:       bam
+        intermediate_format: ubam
+
+        # Optional: learn the memory and disk to request for the shard, chaining and EM batch-prep jobs from
+        # the telemetry of previous runs. after each run the peak memory and disk of each job and its input
+        # size are added to resource_history (on the leader), once a stage has resource_min_observations jobs
+        # in it its jobs ask for resource_safety_margin times the fitted amount instead of the fixed estimates.
+        # the fitted line is above the resource_quantile fraction of the jobs, so a few outliers don't raise
+        # every request. a job that raises a MemoryError or whose tool is killed (SIGKILL, e.g. by the OOM killer)
+        # is retried in the same run with twice the memory, up to resource_max_memory. a job whose whole worker
+        # is killed can't retry itself, it's listed in the telemetry report and counted as needing twice its
+        # memory the next time the model is fitted. leave resource_history blank to always use the fixed estimates
+        resource_history:          toil-nanopore-resources.jsonl
+        resource_min_observations: 10
+        resource_quantile:         0.95
+        resource_safety_margin:    1.5
+        resource_max_memory:       64G
+
+        # Optional: how samtools, bwa and cPecan are run. docker starts a container for every call. native
+        # uses samtools and bwa from the PATH of the workers (the others still go through docker). container
+        # keeps one container per tool on each node and runs every call in it. it mounts tool_mount_root, set
+        # that to Toil's --workDir if you give one (blank is the system temp dir), and it exits after
+        # tool_container_idle seconds unused. tool_seconds_per_call in the telemetry report and
+        # tests/toolBackendBenchmark.py show the per-call overhead
+        tool_backend:        docker
+        tool_mount_root:
+        tool_container_idle: 600
+
+        # Optional: filter the reads of FASTQ samples as they're put in the job store. reads shorter than
+        # min_read_length or with a mean base quality under min_mean_quality are dropped, and with
+        # target_bases (a number of bases) only the highest quality reads adding up to about that many bases
+        # are kept. BAM samples aren't filtered. the dropped reads and bases are in the telemetry report,
+        # leave all three blank to put all of the reads in
+        min_read_length:
+        min_mean_quality:
+        target_bases:
+
         # Optional: Alignment Model, n.b. this is REQUIRED if you do not perform EM
         hmm_file: s3://arand-sandbox/last_hmm_20.txt
 
@@ -270,19 +451,23 @@ def generateConfig():
         #                    model_type: if no input model is set, make this kind of model
         #                                choices: fiveState, fiveStateAsymmetric, threeState,
         #                                       threeStateAsymmetric
-        #   max_sample_alignment_length: randomly sample this amount of bases for EM
+        #   max_sample_alignment_length: randomly sample this amount of bases for EM, alignments are sampled in one pass
+        #                                weighted by their aligned length
+        #                       em_seed: seed for the sample (and the random starting models), the same seed picks the
+        #                                same sample from the same alignment
         #                 em_iterations: number of full cycles to train on the given sample amount
-        #       n.b random start with searching for best model is not *quite* implemented yet
+        #                  random_start: when no input model is given, train this many randomly initialised models in
+        #                                parallel (on the same sampled alignments) and keep the one with the best
+        #                                final likelihood. False trains one model from equal transitions
 
         model_type: fiveState
         max_sample_alignment_length: 50000
         em_iterations: 5
         random_start:  False
+        em_seed:       0
 
         # set_Jukes_Cantor_emissions is of type Float or blank (None)
         set_Jukes_Cantor_emissions:
-        # update the band NOT IMPLEMENTED
-        update_band:     False
         gc_content:      0.5
         train_emissions: True
 
@@ -297,6 +482,13 @@ def generateConfig():
         no_margin: False
         variant_threshold: 0.3
 
+        # Optional: cap the read depth the caller sees, regions deeper than max_depth are downsampled (by a hash
+        # of the read names, so the same reads are picked every run) before posteriors are calculated. leave
+        # blank to use all of the reads
+        #   downsample_seed: change this to pick a different set of reads
+        max_depth:
+        downsample_seed: 0
+
         ##---------------------##
         ## MarginStats Options ##
         ##---------------------##
@@ -305,9 +497,42 @@ def generateConfig():
 
         # Optional: Debug increasing logging
         debug: True
+
+        ##-----------##
+        ## Profiling ##
+        ##-----------##
+        # Optional: run job functions under cProfile, list job function names or telemetry stages
+        # e.g. [shardSamJobFunction, chainSamFileJobFunction, getFastqFromBam] or [caller_shard]. leave
+        # blank to disable profiling
+        #   profile_top_n: deliver the profiles of this many of the slowest jobs in each stage to output_dir
+        profile_jobs:
+        profile_top_n: 3
+
+        # Optional: the leader keeps the progress of each stage (shards done out of issued, reads and bases a
+        # second, an estimate of the time left) in this file on the machine it runs on, `toil-nanopore status`
+        # shows it. leave blank to disable
+        progress_file: toil-nanopore-progress.json
     """[1:])
 
 
+# the template only has examples of these, a config has to give them
+EXAMPLE_OPTIONS = ("output_dir", "ref", "ref_size", "hmm_file", "error_model")
+
+
+def loadConfig(config_path):
+    """the config in `config_path`, options it doesn't have (e.g. a config generated by an earlier version)
+    take their values from generateConfig
+    """
+    import yaml
+
+    config   = {x.replace('-', '_'): y for x, y in yaml.load(open(config_path).read()).iteritems()}
+    defaults = yaml.load(generateConfig())
+    for key, value in defaults.iteritems():
+        if key not in EXAMPLE_OPTIONS:
+            config.setdefault(key, value)
+    return config
+
+
 def generateManifest():
     return textwrap.dedent("""
         #   Edit this manifest to include information for each sample to be run.
@@ -331,6 +556,8 @@ def generateManifest():
 
 
 def parseManifest(path_to_manifest):
+    from bd2k.util.humanize import human2bytes
+
     require(os.path.exists(path_to_manifest), "[parseManifest]Didn't find manifest file, looked "
             "{}".format(path_to_manifest))
     allowed_file_types = ["fq", "bam"]
@@ -359,12 +586,61 @@ def main():
         run_parser = subparsers.add_parser("run",
                                            help="runs nanopore pipeline with config on samples in manifest")
         subparsers.add_parser("generate", help="generates config and manifest files for your run, do this first")
+        watch_parser = subparsers.add_parser("watch",
+                                             help="aligns and calls the FASTQ chunks in a directory as they arrive")
         run_parser.add_argument("--config", default="config-toil-nanopore.yaml", type=str,
                                 help='Path to the (filled in) config file, generated with "generate".')
         run_parser.add_argument('--manifest', default='manifest-toil-nanopore.tsv', type=str,
                                 help='Path to the (filled in) manifest file, generated with "generate". '
                                      '\nDefault value: "%(default)s".')
-        Job.Runner.addToilOptions(run_parser)
+        status_parser = subparsers.add_parser("status", help="shows the progress of each stage of the runs")
+        status_parser.add_argument("--progress_file", default="toil-nanopore-progress.json", type=str,
+                                   help="The progress_file from the config of the run. "
+                                        "\nDefault value: %(default)s.")
+        status_parser.add_argument("--sample", action="append", dest="samples",
+                                   help="Only show this sample, can be given more than once.")
+        status_parser.add_argument("--interval", type=int,
+                                   help="Print the status again every this many seconds.")
+        evaluate_parser = subparsers.add_parser("evaluate", help="compares variant calls with a truth set")
+        evaluate_parser.add_argument("--calls", type=str, help="The called VCF (.vcf or .vcf.gz).")
+        evaluate_parser.add_argument("--truth", type=str,
+                                     help="Truth VCF, or TSV of contig, 0-based position, alt and ref like "
+                                          "tests/mutations.txt.")
+        evaluate_parser.add_argument("--stratify", action="append", default=[], metavar="NAME=BED",
+                                     help="Also report the variants in the regions of this BED, can be given "
+                                          "more than once.")
+        evaluate_parser.add_argument("--region", action="append", dest="regions", metavar="CONTIG[:START-END]",
+                                     help="Only evaluate this region, can be given more than once.")
+        evaluate_parser.add_argument("--shard", type=str, default="1/1", metavar="K/N",
+                                     help="Only evaluate the K-th of N shards of the contigs, for running on "
+                                          "several machines. \nDefault value: %(default)s.")
+        evaluate_parser.add_argument("--processes", type=int, default=1,
+                                     help="Compare this many contigs at once. \nDefault value: %(default)s.")
+        evaluate_parser.add_argument("--pass_only", action="store_true",
+                                     help="Skip calls that don't have FILTER PASS (or .).")
+        evaluate_parser.add_argument("--counts_out", type=str,
+                                     help="Also write the counts as JSON, to combine with the counts of the "
+                                          "other shards later.")
+        evaluate_parser.add_argument("--combine", nargs="+", metavar="COUNTS_JSON",
+                                     help="Report on the combined counts from --counts_out files instead.")
+        watch_parser.add_argument("--config", default="config-toil-nanopore.yaml", type=str,
+                                  help='Path to the (filled in) config file, generated with "generate".')
+        watch_parser.add_argument("--watch_dir", required=True, type=str,
+                                  help="Local directory the sequencer writes FASTQ chunks (.fq/.fastq) to.")
+        watch_parser.add_argument("--sample_label", required=True, type=str,
+                                  help="Label for the live outputs, each chunk's outputs are labelled "
+                                       "<sample_label>_<chunk>.")
+        watch_parser.add_argument("--interval", default=60, type=int,
+                                  help="Seconds between looking for new chunks. \nDefault value: %(default)s.")
+        watch_parser.add_argument("--settle", default=30, type=int,
+                                  help="Only take chunks that haven't changed for this many seconds."
+                                       "\nDefault value: %(default)s.")
+        if sys.argv[1] == "run":  # only pay for importing toil when we're going to run
+            from toil.job import Job
+            Job.Runner.addToilOptions(run_parser)
+        elif sys.argv[1] == "watch":
+            from toil.job import Job
+            Job.Runner.addToilOptions(watch_parser)
 
         return parser.parse_args()
 
@@ -393,18 +669,116 @@ def main():
         except UserError:
             print("[toil-nanopore]NOTICE using existing manifest {}".format(manifest_path))
 
+    elif args.command == "status":
+        from progress import printStatus
+        try:
+            printStatus(args.progress_file, args.samples, args.interval)
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == "evaluate":
+        from evaluate import evaluateCalls, formatReport, writeCounts, loadCounts
+
+        if args.combine:
+            counts = loadCounts(args.combine)
+        else:
+            require(args.calls and args.truth, "[toil-nanopore evaluate]--calls and --truth are needed "
+                                               "(or --combine)")
+            shard, _, shards = args.shard.partition("/")
+            require(shard.isdigit() and shards.isdigit() and 1 <= int(shard) <= int(shards),
+                    "[toil-nanopore evaluate]--shard is K/N with 1 <= K <= N, got {}".format(args.shard))
+            counts = evaluateCalls(args.calls, args.truth, args.stratify, args.regions, int(shard) - 1,
+                                   int(shards), args.processes, args.pass_only)
+            if args.counts_out:
+                writeCounts(counts, args.counts_out)
+        print(formatReport(counts))
+
     elif args.command == "run":
+        from toil.common import Toil
+        from toil.job import Job
+
         require(os.path.exists(args.config), "{config} not found run generate-config".format(config=args.config))
         # Parse config
-        config  = {x.replace('-', '_'): y for x, y in yaml.load(open(args.config).read()).iteritems()}
+        config  = loadConfig(args.config)
         samples = parseManifest(args.manifest)
         for sample in samples:
+            config["resource_model"] = fitResourceModel(config)
             with Toil(args) as toil:
-                if not toil.options.restart:
-                    root_job = Job.wrapJobFn(marginAlignRootJobFunction, config, sample)
-                    return toil.start(root_job)
-                else:
-                    toil.restart()
+                # the leader picks the telemetry records out of the job logs and delivers them as a report
+                telemetry = TelemetryCollector().attach()
+                progress  = ProgressTracker(config.get("progress_file"), sample.label).follow(telemetry)
+                usage     = JobStoreUsageMonitor(args.jobStore).start()
+                try:
+                    if not toil.options.restart:
+                        root_job = Job.wrapJobFn(marginAlignRootJobFunction, config, sample)
+                        return toil.start(root_job)
+                    else:
+                        toil.restart()
+                finally:
+                    telemetry.detach()
+                    progress.flush(finished=True)
+                    telemetry.peak_jobstore_bytes = usage.stop()
+                    deliverTelemetryReport(toil, telemetry, config, sample.label)
+                    appendResourceHistory(config, telemetry.records)
+                    evictPosteriorCache(config)
+
+    elif args.command == "watch":
+        import copy
+        import time
+        from toil.common import Toil
+        from toil.job import Job
+        from live import newChunks, loadWatchState, recordChunk, chunkLabel, liveConfig, CHUNK_ATTEMPTS
+
+        require(os.path.exists(args.config), "{config} not found run generate-config".format(config=args.config))
+        require(os.path.isdir(args.watch_dir), "{} isn't a directory".format(args.watch_dir))
+        config = liveConfig(loadConfig(args.config), args.sample_label)
+        require(config["caller"], "[toil-nanopore watch]caller needs to be True for live runs")
+        seen     = loadWatchState(args.watch_dir)
+        failures = {}  # filename: number of failed runs
+        print("[toil-nanopore watch]Watching {dir}, {n} chunks already processed".format(dir=args.watch_dir,
+                                                                                       n=len(seen)))
+        # the chunks are run one at a time, each one updates the running posterior totals in output_dir
+        while True:
+            for filename in newChunks(args.watch_dir, seen, args.settle):
+                path                = os.path.abspath(os.path.join(args.watch_dir, filename))
+                sample              = Sample(file_type="fq", URL="file://" + path,
+                                             label=chunkLabel(args.sample_label, filename),
+                                             file_size=os.path.getsize(path))
+                chunk_args          = copy.copy(args)
+                chunk_args.jobStore = "{store}-{chunk}".format(store=args.jobStore, chunk=uuid.uuid4().hex[:8])
+                config["resource_model"] = fitResourceModel(config)
+                print("[toil-nanopore watch]Processing {}".format(filename))
+                try:
+                    with Toil(chunk_args) as toil:
+                        telemetry = TelemetryCollector().attach()
+                        progress  = ProgressTracker(config.get("progress_file"), sample.label).follow(telemetry)
+                        usage     = JobStoreUsageMonitor(chunk_args.jobStore).start()
+                        try:
+                            toil.start(Job.wrapJobFn(marginAlignRootJobFunction, config, sample))
+                        finally:
+                            telemetry.detach()
+                            progress.flush(finished=True)
+                            telemetry.peak_jobstore_bytes = usage.stop()
+                            deliverTelemetryReport(toil, telemetry, config, sample.label)
+                            appendResourceHistory(config, telemetry.records)
+                            evictPosteriorCache(config)
+                except UserError:
+                    raise  # the config is wrong, the next chunk would fail the same way
+                except Exception as e:
+                    # one bad chunk doesn't stop the run. some of its blocks' totals may have been updated, so
+                    # it isn't recorded as done: it's run again (the blocks it's in already are skipped) at the
+                    # next interval, and after CHUNK_ATTEMPTS failures it's left until watch is restarted
+                    failures[filename] = failures.get(filename, 0) + 1
+                    print("[toil-nanopore watch]Chunk {chunk} failed ({n} of {max} attempts), its job store {store} "
+                          "is left for inspection: {e}".format(chunk=filename, n=failures[filename],
+                                                               max=CHUNK_ATTEMPTS, store=chunk_args.jobStore, e=e),
+                          file=sys.stderr)
+                    if failures[filename] >= CHUNK_ATTEMPTS:
+                        seen.add(filename)
+                    continue
+                recordChunk(args.watch_dir, filename)
+                seen.add(filename)
+            time.sleep(args.interval)
 
 
 if __name__ == '__main__':
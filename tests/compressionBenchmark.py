@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Alignment format benchmark for toil-nanopore
+
+Writes an alignment in each of the intermediate_format choices (sam, ubam, bam) and, when samtools is on
+the PATH, as CRAM (the cram output_format), then reads it back. Reports the CPU seconds to write and read
+each one and the bytes that would go through the job store or to output_dir. Run from the root of the
+repo, e.g.:
+    python tests/compressionBenchmark.py --alignment tests/inputBigMutationsBwa.bam --repeat 3
+"""
+from __future__ import print_function
+import os
+import sys
+import shutil
+import resource
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from distutils.spawn import find_executable
+
+import pysam
+
+# the same pysam modes as toil_nanopore.alignment_format.INTERMEDIATE_MODES
+PYSAM_FORMATS = [("sam", "wh"), ("ubam", "wbu"), ("bam", "wb")]
+
+
+def cpuSeconds():
+    own      = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def readAll(path):
+    sam = pysam.Samfile(path, "r")
+    n   = sum(1 for _ in sam)
+    sam.close()
+    return n
+
+
+def pysamFormat(alignment, path, mode):
+    source = pysam.Samfile(alignment, "r")
+    start  = cpuSeconds()
+    output = pysam.Samfile(path, mode, template=source)
+    for aln in source:
+        output.write(aln)
+    output.close()
+    write_cpu = cpuSeconds() - start
+    source.close()
+    start = cpuSeconds()
+    readAll(path)
+    return write_cpu, cpuSeconds() - start
+
+
+def cramFormat(alignment, path, reference):
+    start = cpuSeconds()
+    subprocess.check_call(["samtools", "view", "-C", "-T", reference, "-o", path, alignment])
+    write_cpu = cpuSeconds() - start
+    start     = cpuSeconds()
+    with open(os.devnull, "w") as null:
+        subprocess.check_call(["samtools", "view", "-T", reference, path], stdout=null)
+    return write_cpu, cpuSeconds() - start
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--alignment", default="tests/inputBigMutationsBwa.bam")
+    parser.add_argument("--reference", default="tests/referencesMutated.fa")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each format, the fastest is reported")
+    args = parser.parse_args()
+
+    formats = [(name, lambda a, p, mode=mode: pysamFormat(a, p, mode)) for name, mode in PYSAM_FORMATS]
+    if find_executable("samtools"):
+        formats.append(("cram", lambda a, p: cramFormat(a, p, os.path.abspath(args.reference))))
+    else:
+        print("[compressionBenchmark]samtools isn't on the PATH, skipping CRAM", file=sys.stderr)
+
+    workdir = tempfile.mkdtemp(dir=os.getcwd())
+    try:
+        print("format\twrite_cpu_seconds\tread_cpu_seconds\tbytes")
+        for name, run in formats:
+            path    = os.path.join(workdir, "alignment." + name)
+            timings = [run(os.path.abspath(args.alignment), path) for _ in xrange(args.repeat)]
+            print("%s\t%.3f\t%.3f\t%d" % (name, min(t[0] for t in timings), min(t[1] for t in timings),
+                                          os.path.getsize(path)))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
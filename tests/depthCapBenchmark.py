@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Depth capping benchmark for toil-nanopore
+
+Runs marginCaller on an alignment once for each `max_depth` and reports the wall time and the precision and
+recall of the calls against a truth set in the tests/mutations.txt format (contig, 0-based position, the
+base the reads carry, the base in the mutated reference), scored with toil_nanopore.evaluate the same way as
+test_toil_nanopore.py.
+Run from the root of the repo, e.g.:
+    python tests/depthCapBenchmark.py --depths 0 20 50 100
+the defaults use the mutated reference and alignment the CI tests use
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+import yaml
+from toil_nanopore.toil_nanopore_pipeline import generateConfig
+from toil_nanopore.evaluate import evaluateCalls, precisionRecall
+
+
+def scoreCalls(vcf, mutations):
+    """(calls, precision, recall) of all of the variant types together
+    """
+    by_type = evaluateCalls(vcf, mutations).get("all", {})
+    cells   = {outcome: sum(c[outcome] for c in by_type.values()) for outcome in ("tp", "fp", "fn")}
+    precision, recall, _ = precisionRecall(cells)
+    return cells["tp"] + cells["fp"], precision, recall
+
+
+def runCaller(workdir, alignment, reference, hmm, max_depth, no_margin):
+    output_dir = os.path.join(workdir, "output_{}".format(max_depth)) + "/"
+    os.mkdir(output_dir)
+    config = yaml.load(generateConfig())
+    config.update({
+        "chain"       : False,
+        "realign"     : False,
+        "caller"      : True,
+        "stats"       : False,
+        "EM"          : False,
+        "incremental" : False,
+        "output_dir"  : "file://" + output_dir,
+        "ref"         : "file://" + reference,
+        "hmm_file"    : "file://" + hmm,
+        "error_model" : "file://" + hmm,
+        "no_margin"   : no_margin,
+        "max_depth"   : max_depth or None,
+        "debug"       : False,
+    })
+    config_path   = os.path.join(workdir, "config_{}.yaml".format(max_depth))
+    manifest_path = os.path.join(workdir, "manifest_{}.tsv".format(max_depth))
+    with open(config_path, "w") as fH:
+        yaml.dump(config, fH, default_flow_style=False)
+    with open(manifest_path, "w") as fH:
+        fH.write("\t".join(["bam", "file://" + alignment, "depth", "%sK" % (os.path.getsize(alignment) // 1000 + 1)]))
+
+    command = ["toil-nanopore", "run", "file:" + os.path.join(workdir, "jobstore_{}".format(max_depth)),
+               "--config=" + config_path, "--manifest=" + manifest_path, "--workDir=" + workdir,
+               "--clean=always"]
+    start = time.time()
+    subprocess.check_call(command)
+    wall_time = time.time() - start
+
+    vcf = [f for f in os.listdir(output_dir) if f.endswith(".vcf")]
+    assert(len(vcf) == 1), "expected one VCF in %s, got %s" % (output_dir, vcf)
+    return wall_time, os.path.join(output_dir, vcf[0])
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--alignment", default="tests/inputBigMutationsBwa.bam")
+    parser.add_argument("--reference", default="tests/referencesMutated.fa")
+    parser.add_argument("--mutations", default="tests/mutations.txt")
+    parser.add_argument("--hmm", default="tests/last_hmm_20.txt")
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 10, 25, 50, 100],
+                        help="max_depth values to run, 0 means no cap")
+    parser.add_argument("--no_margin", action="store_true", default=False)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=os.getcwd())
+    try:
+        print("max_depth\twall_seconds\tcalls\tprecision\trecall")
+        for max_depth in args.depths:
+            wall_time, vcf = runCaller(workdir, os.path.abspath(args.alignment), os.path.abspath(args.reference),
+                                       os.path.abspath(args.hmm), max_depth, args.no_margin)
+            calls, precision, recall = scoreCalls(vcf, os.path.abspath(args.mutations))
+            print("%s\t%.1f\t%d\t%.3f\t%.3f" % (max_depth or "none", wall_time, calls, precision, recall))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Startup-time benchmark for toil-nanopore
+
+Times fresh interpreters doing what `toil-nanopore generate`, `toil-nanopore --help` and a Toil worker
+(importing the module that holds a job function) do, next to the cost of eagerly importing the modules that
+are now deferred to the job functions. Run from the root of the repo:
+    python tests/startupBenchmark.py --repeats 10
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+
+DEVNULL = open(os.devnull, 'w')
+
+# what the modules used to import when they were loaded
+EAGER_IMPORTS = ["toil.common", "toil.job", "toil_lib.programs", "bd2k.util.humanize", "yaml",
+                 "margin.toil.localFileManager", "margin.toil.hmm", "margin.toil.alignment",
+                 "margin.toil.stats", "margin.toil.bwa", "margin.toil.realign", "margin.toil.chainAlignment",
+                 "margin.toil.expectationMaximisation", "margin.toil.shardAlignment",
+                 "margin.toil.variantCaller", "margin.toil.variantCall"]
+
+
+def python_import(modules):
+    return [sys.executable, "-c", "; ".join("import %s" % m for m in modules)]
+
+
+def time_command(command, repeats, cwd=None):
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.check_call(command, stdout=DEVNULL, stderr=DEVNULL, cwd=cwd)
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=5, help="runs per measurement, the median is reported")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    benchmarks = [
+        ("interpreter", [sys.executable, "-c", "pass"]),
+        ("toil-nanopore --help", ["toil-nanopore", "--help"]),
+        ("toil-nanopore generate", ["toil-nanopore", "generate"]),
+        ("worker: toil_nanopore_pipeline", python_import(["toil_nanopore.toil_nanopore_pipeline"])),
+        ("worker: marginAlignToil", python_import(["toil_nanopore.marginAlignToil"])),
+        ("worker: marginCallerToil", python_import(["toil_nanopore.marginCallerToil"])),
+        ("eager imports (before)", python_import(EAGER_IMPORTS)),
+    ]
+    try:
+        print("benchmark\tmedian_seconds")
+        for label, command in benchmarks:
+            # generate doesn't overwrite existing files, start each run from an empty directory
+            for f in os.listdir(workdir):
+                os.remove(os.path.join(workdir, f))
+            print("%s\t%.3f" % (label, time_command(command, args.repeats, cwd=workdir)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,9 +11,9 @@ import pysam
 import numpy as np
 from itertools import izip
 from argparse import ArgumentParser
-from margin.marginCallerLib import vcfRead
 from margin.utils import ReadAlignmentStats
 from margin.toil.hmm import Hmm
+from toil_nanopore.evaluate import evaluateCalls, precisionRecall
 
 
 def baseDirectory():
@@ -173,13 +173,10 @@ class SubprogramCiTests(unittest.TestCase):
             self.assertTrue(False)
 
     def validateVcf(self):
-        mutations = set(map(lambda x : (x[0], int(x[1]) + 1, x[2]),
-                            map(lambda x : x.split(), open(self.mutations, 'r'))))
-        imputedMutations = vcfRead(self.out_vcf)
-        intersectionSize = float(len(mutations.intersection(imputedMutations)))
-        return intersectionSize / len(imputedMutations) if len(imputedMutations) else 0.0, \
-            intersectionSize / len(mutations) if len(mutations) else 0.0, \
-            len(imputedMutations), len(mutations)
+        by_type = evaluateCalls(self.out_vcf, self.mutations).get("all", {})
+        cells   = {outcome: sum(c[outcome] for c in by_type.values()) for outcome in ("tp", "fp", "fn")}
+        precision, recall, _ = precisionRecall(cells)
+        return precision, recall, cells["tp"] + cells["fp"], cells["tp"] + cells["fn"]
 
     @staticmethod
     def print_stats(test_name, stats):
@@ -0,0 +1,661 @@
+#!/usr/bin/env python
+"""Unit tests for toil-nanopore's helpers, on small fixtures that don't need toil, docker or the test data
+"""
+from __future__ import print_function
+import os
+import time
+import shutil
+import logging
+import random
+import tempfile
+import unittest
+from StringIO import StringIO
+from collections import namedtuple
+
+from toil_nanopore.sharding import coverageBalancedRanges
+from toil_nanopore.downsample import depthCappedReads, DEPTH_BIN_SIZE
+from toil_nanopore.targets import parseBed, overlapsTargets
+from toil_nanopore.pool import shardGroups, coalesceUnits, jobGroups, flattenResults
+from toil_nanopore.em import weightedReservoirSample
+from toil_nanopore.evaluate import VariantFile, compareContig, combineCounts
+from toil_nanopore.ingest import ReadFilter, meanQuality, fastqRecords
+from toil_nanopore.realign import alignmentIdentity, needsRealignment, realignCacheKeys
+from toil_nanopore.posterior_cache import PosteriorCache, digest, readKeys
+from toil_nanopore.live import newChunks, chunkLabel, contigFilename, liveBlockFilename, splitIntoBlocks, \
+    addChunkTotals, LIVE_BLOCK_LENGTH
+from toil_nanopore.resources import fitEnvelope, appendResourceHistory, loadHistory, predictedResources, \
+    HISTORY_PER_STAGE, RESOURCE_FLOORS
+from toil_nanopore.telemetry import TelemetryCollector, TOIL_JOB_FAILED, jobUnitName, parseUnitName
+from toil_nanopore.progress import ProgressTracker, stageRates, formatStatus
+from toil_nanopore.fingerprint import STAGE_CONFIG_KEYS, inputDigest, stageDigest, computeStageFingerprints, \
+    callsFingerprint
+
+
+class CoverageBalancedRangesTests(unittest.TestCase):
+    def testCutsAtTargetBases(self):
+        ranges = coverageBalancedRanges([10] * 10, [(0, 1000)], bin_size=100, target_bases=30)
+        self.assertEqual(ranges, [(0, 300), (300, 600), (600, 900), (900, 1000)])
+
+    def testZeroCoverageIsOneRange(self):
+        self.assertEqual(coverageBalancedRanges([0] * 10, [(0, 1000)], bin_size=100, target_bases=30),
+                         [(0, 1000)])
+
+    def testRangesCoverTheIntervals(self):
+        histogram = [0, 50, 500, 0, 0, 5, 5, 200, 0, 1]
+        intervals = [(50, 350), (600, 1000)]
+        ranges    = coverageBalancedRanges(histogram, intervals, bin_size=100, target_bases=100)
+        self.assertEqual(ranges, [(50, 300), (300, 350), (600, 800), (800, 1000)])
+        for start, end in ranges:
+            self.assertLess(start, end)
+            self.assertTrue(any(i_start <= start and end <= i_end for i_start, i_end in intervals))
+
+    def testNoEmptyRangeAtTheEnd(self):
+        ranges = coverageBalancedRanges([1000] * 10, [(0, 1000)], bin_size=100, target_bases=1)
+        self.assertEqual(ranges, [(i * 100, (i + 1) * 100) for i in xrange(10)])
+
+
+class DepthCappedReadsTests(unittest.TestCase):
+    def depths(self, read_spans, kept):
+        depth = {}
+        for i in kept:
+            _, start, end = read_spans[i]
+            for b in xrange(start // DEPTH_BIN_SIZE, ((end - 1) // DEPTH_BIN_SIZE) + 1):
+                depth[b] = depth.get(b, 0) + 1
+        return depth
+
+    def testCapsDepth(self):
+        read_spans = [("read%d" % i, (i % 7) * 20, (i % 7) * 20 + 300) for i in xrange(40)]
+        kept       = depthCappedReads(read_spans, max_depth=5)
+        self.assertTrue(kept)
+        self.assertLessEqual(max(self.depths(read_spans, kept).values()), 5)
+
+    def testStackedReads(self):
+        read_spans = [("read%d" % i, 0, 100) for i in xrange(10)]
+        self.assertEqual(len(depthCappedReads(read_spans, max_depth=3)), 3)
+
+    def testSameReadsForTheSameSeed(self):
+        read_spans     = [("read%d" % i, 0, 100) for i in xrange(10)]
+        reversed_spans = list(reversed(read_spans))
+        kept_names     = set(read_spans[i][0] for i in depthCappedReads(read_spans, 3, seed=7))
+        # the reads are chosen by name (and seed), not by their order in the shard
+        self.assertEqual(kept_names, set(reversed_spans[i][0] for i in depthCappedReads(reversed_spans, 3, seed=7)))
+
+    def testReadsUnderTheCapAreAllKept(self):
+        read_spans = [("read%d" % i, i * 1000, i * 1000 + 500) for i in xrange(10)]
+        self.assertEqual(depthCappedReads(read_spans, max_depth=1), set(xrange(10)))
+
+    def testReadsOutsideTheRegionDontAddDepth(self):
+        read_spans = [("read%d" % i, 0, 100) for i in xrange(5)] + [("inside", 1000, 1100)]
+        self.assertEqual(depthCappedReads(read_spans, 1, region_start=1000, region_end=2000), set(xrange(6)))
+
+    def testNoReads(self):
+        self.assertEqual(depthCappedReads([], max_depth=5), set())
+
+
+class TargetsTests(unittest.TestCase):
+    def testParseBed(self):
+        bed = StringIO("track name=panel\n"
+                       "# a comment\n"
+                       "chr2\t500\t600\n"
+                       "chr1\t300\t400\tamplicon_b\n"
+                       "chr1\t100\t200\tamplicon_a\n"
+                       "\n"
+                       "chr1\t150\t250\n"
+                       "chr1\t250\t260\n")
+        # sorted, and overlapping or abutting intervals merged
+        self.assertEqual(parseBed(bed), {"chr1": [(100, 260), (300, 400)], "chr2": [(500, 600)]})
+
+    def testEmptyBed(self):
+        targets = parseBed(StringIO(""))
+        self.assertEqual(targets, {})
+        self.assertFalse(overlapsTargets(targets, "chr1", 0, 1000))
+
+    def testInvalidBed(self):
+        from toil_lib import UserError
+
+        with self.assertRaises(UserError):
+            parseBed(StringIO("chr1\t100\n"))
+        with self.assertRaises(UserError):
+            parseBed(StringIO("chr1\t200\t100\n"))
+
+    def testOverlapsTargets(self):
+        targets = {"chr1": [(100, 200), (300, 400)]}
+        self.assertTrue(overlapsTargets(targets, "chr1", 150, 160))
+        self.assertTrue(overlapsTargets(targets, "chr1", 0, 101))
+        self.assertTrue(overlapsTargets(targets, "chr1", 199, 300))
+        self.assertTrue(overlapsTargets(targets, "chr1", 0, 1000))
+        # BED intervals are half-open
+        self.assertFalse(overlapsTargets(targets, "chr1", 0, 100))
+        self.assertFalse(overlapsTargets(targets, "chr1", 200, 300))
+        self.assertFalse(overlapsTargets(targets, "chr1", 400, 500))
+        self.assertFalse(overlapsTargets(targets, "chr2", 150, 160))
+
+
+class JobGroupTests(unittest.TestCase):
+    def config(self, cores=1, min_job_seconds=None):
+        return {"cores_per_shard_job": cores, "min_job_seconds": min_job_seconds, "job_overhead_seconds": 5,
+                "job_seconds_per_mb": {"realign": 60.0}}
+
+    def testShardGroups(self):
+        self.assertEqual(shardGroups(range(5), 2), [[0, 1], [2, 3], [4]])
+        self.assertEqual(shardGroups(range(4), 4), [[0, 1, 2, 3]])
+        self.assertEqual(shardGroups([], 4), [])
+
+    def testCoalesceUnits(self):
+        self.assertEqual(coalesceUnits(range(6), [1.0] * 6, 2.0), [[0, 1], [2, 3], [4, 5]])
+        # the remainder goes into the last group
+        self.assertEqual(coalesceUnits(range(5), [1.0] * 5, 2.0), [[0, 1], [2, 3, 4]])
+        self.assertEqual(coalesceUnits(range(4), [1.0, 10.0, 1.0, 1.0], 2.0), [[0, 1], [2, 3]])
+        # a unit that's long enough on its own is a job on its own
+        self.assertEqual(coalesceUnits(range(3), [10.0, 10.0, 10.0], 2.0), [[0], [1], [2]])
+
+    def testCoalesceUnitsUnderMinimum(self):
+        self.assertEqual(coalesceUnits(range(3), [0.1] * 3, 60.0), [[0, 1, 2]])
+        self.assertEqual(coalesceUnits([], [], 60.0), [])
+
+    def testJobGroups(self):
+        units = range(8)
+        mb    = [1 << 20] * 8  # a minute of work each
+        self.assertIsNone(jobGroups(self.config(), "realign", units, mb))
+        self.assertEqual(jobGroups(self.config(cores=4), "realign", units, mb), [[0, 1, 2, 3], [4, 5, 6, 7]])
+        self.assertEqual(jobGroups(self.config(min_job_seconds=180), "realign", units, mb),
+                         [[0, 1, 2], [3, 4, 5, 6, 7]])
+        # with more cores a job gets more work
+        self.assertEqual(jobGroups(self.config(cores=2, min_job_seconds=180), "realign", units, mb),
+                         [units])
+
+    def testFlattenResults(self):
+        self.assertEqual(flattenResults([[1, 2], 3, [], [4]]), [1, 2, 3, 4])
+
+
+class WeightedReservoirSampleTests(unittest.TestCase):
+    def setUp(self):
+        self.items = [("aln%d" % i, 100 + (i * 37) % 900) for i in xrange(200)]
+
+    def testSampleReachesTarget(self):
+        sample = weightedReservoirSample(self.items, 5000, random.Random(1))
+        weight = dict(self.items)
+        total  = sum(weight[item] for _, item in sample)
+        self.assertGreaterEqual(total, 5000)
+        # dropping the lowest keyed item would take it under the target, so dropping the heaviest would too
+        self.assertLess(total - max(weight[item] for _, item in sample), 5000)
+
+    def testSampleIsInInputOrder(self):
+        sample = weightedReservoirSample(self.items, 5000, random.Random(1))
+        self.assertEqual(sample, sorted(sample))
+        for position, item in sample:
+            self.assertEqual(self.items[position][0], item)
+
+    def testSeededSampleIsReproducible(self):
+        first = weightedReservoirSample(self.items, 5000, random.Random(42))
+        self.assertEqual(first, weightedReservoirSample(self.items, 5000, random.Random(42)))
+        self.assertNotEqual(first, weightedReservoirSample(self.items, 5000, random.Random(43)))
+
+    def testStreamsTheInput(self):
+        self.assertEqual(weightedReservoirSample(iter(self.items), 5000, random.Random(42)),
+                         weightedReservoirSample(self.items, 5000, random.Random(42)))
+
+    def testEverythingWhenUnderTarget(self):
+        items = [("a", 10), ("b", 0), ("c", 20)]
+        # items without weight (e.g. alignments with no aligned bases) are never sampled
+        self.assertEqual(weightedReservoirSample(items, 1000, random.Random(1)), [(0, "a"), (2, "c")])
+        self.assertEqual(weightedReservoirSample([], 1000, random.Random(1)), [])
+
+    def testHeavierItemsAreFavoured(self):
+        items  = [("light%d" % i, 10) for i in xrange(100)] + [("heavy%d" % i, 1000) for i in xrange(100)]
+        picked = [item for seed in xrange(20)
+                  for _, item in weightedReservoirSample(items, 10000, random.Random(seed))]
+        self.assertGreater(sum(item.startswith("heavy") for item in picked), len(picked) * 0.9)
+
+
+class CompareContigTests(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.calls   = self.write("calls.vcf", "##fileformat=VCFv4.2\n"
+                                               "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+                                               "chr1\t100\t.\tA\tG\t50\tPASS\t.\n"
+                                               "chr1\t200\t.\tC\tT\t50\tPASS\t.\n"
+                                               "chr1\t400\t.\tA\tC,T\t50\tPASS\t.\n"
+                                               "chr1\t500\t.\tACG\tA\t50\tPASS\t.\n"
+                                               "chr2\t10\t.\tG\tA\t50\tPASS\t.\n")
+        # contig, 0-based position, alt, ref
+        self.truth   = self.write("truth.txt", "chr1\t99\tG\tA\n"
+                                               "chr1\t299\tA\tG\n"
+                                               "chr1\t399\tC\tA\n")
+        self.strata  = [("hp", {"chr1": [(99, 100), (450, 600)]})]
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def write(self, filename, contents):
+        path = os.path.join(self.workdir, filename)
+        with open(path, "w") as fH:
+            fH.write(contents)
+        return path
+
+    def compare(self, contig, start=None, end=None):
+        return compareContig(VariantFile(self.calls), VariantFile(self.truth), self.strata, {}, contig, start, end)
+
+    def testAllStratum(self):
+        counts = self.compare("chr1")
+        # 100 and 400 C are found, 200 and 400 T are false, 300 is missed
+        self.assertEqual(counts["all"]["snv"], {"tp": 2, "fp": 2, "fn": 1})
+        self.assertEqual(counts["all"]["deletion"], {"tp": 0, "fp": 1, "fn": 0})
+
+    def testBedStratum(self):
+        counts = self.compare("chr1")
+        self.assertEqual(counts["hp"]["snv"], {"tp": 1, "fp": 0, "fn": 0})
+        self.assertEqual(counts["hp"]["deletion"], {"tp": 0, "fp": 1, "fn": 0})
+        self.assertEqual(sorted(counts), ["all", "hp"])
+
+    def testRegion(self):
+        counts = self.compare("chr1", 150, 350)
+        self.assertEqual(counts, {"all": {"snv": {"tp": 0, "fp": 1, "fn": 1}}})
+
+    def testContigMissingFromTheTruth(self):
+        self.assertEqual(self.compare("chr2"), {"all": {"snv": {"tp": 0, "fp": 1, "fn": 0}}})
+        self.assertEqual(self.compare("chr3"), {})
+
+    def testCombineCounts(self):
+        combined = combineCounts([self.compare("chr1"), self.compare("chr2")])
+        self.assertEqual(combined["all"]["snv"], {"tp": 2, "fp": 3, "fn": 1})
+        self.assertEqual(combined["hp"]["snv"], {"tp": 1, "fp": 0, "fn": 0})
+
+
+class ReadFilterTests(unittest.TestCase):
+    Q30, Q20, Q10 = "?", "5", "+"  # Phred+33 symbols
+
+    def read(self, length, symbol):
+        return "A" * length, symbol * length
+
+    def testLengthThreshold(self):
+        read_filter = ReadFilter(min_length=100, min_quality=None, target_bases=None)
+        self.assertTrue(read_filter.keep(*self.read(100, self.Q10)))
+        self.assertFalse(read_filter.keep(*self.read(99, self.Q30)))
+        self.assertEqual(read_filter.counts["dropped_short_reads"], 1)
+        self.assertEqual(read_filter.counts["dropped_short_bases"], 99)
+
+    def testQualityThreshold(self):
+        sequence, qualities = "ACGTACGT", "?5+?5+?5"
+        read_filter         = ReadFilter(min_length=None, min_quality=meanQuality(qualities), target_bases=None)
+        # a read exactly at the threshold is kept
+        self.assertTrue(read_filter.keep(sequence, qualities))
+        self.assertFalse(read_filter.keep(sequence, qualities.replace("?", "5")))
+        self.assertEqual(read_filter.counts["dropped_quality_reads"], 1)
+
+    def testMeanQualityIsOfTheErrorProbabilities(self):
+        self.assertAlmostEqual(meanQuality(self.Q20 * 10), 20.0)
+        # half Q10 and half Q30 bases, a mean error of 0.0505 rather than a mean Phred score of 20
+        self.assertAlmostEqual(meanQuality(self.Q10 * 5 + self.Q30 * 5), 12.967, places=3)
+        self.assertEqual(meanQuality(""), 0.0)
+
+    def testTargetBasesKeepsTheBestReads(self):
+        reads       = [self.read(100, self.Q10), self.read(100, self.Q30), self.read(100, self.Q20),
+                       self.read(100, self.Q20), self.read(10, self.Q30)]
+        read_filter = ReadFilter(min_length=50, min_quality=None, target_bases=150)
+        read_filter.plan([("@read", sequence, "+", qualities) for sequence, qualities in reads])
+        # the short read isn't in the histogram, it's dropped before the target is considered
+        self.assertEqual(sorted(read_filter.histogram.values()), [100, 100, 200])
+        self.assertEqual(read_filter.threshold, read_filter._bin(meanQuality(self.Q20 * 100)))
+        self.assertEqual(read_filter.budget, 50)
+        self.assertEqual([read_filter.keep(*read) for read in reads], [False, True, True, False, False])
+        self.assertEqual(read_filter.counts["ingested_bases"], 200)
+        self.assertEqual(read_filter.counts["dropped_target_reads"], 2)
+        self.assertEqual(read_filter.counts["dropped_short_reads"], 1)
+
+    def testTargetBasesOverTheTotalKeepsEverything(self):
+        reads       = [self.read(100, self.Q10), self.read(100, self.Q30)]
+        read_filter = ReadFilter(min_length=None, min_quality=None, target_bases=1000)
+        read_filter.plan([("@read", sequence, "+", qualities) for sequence, qualities in reads])
+        self.assertIsNone(read_filter.threshold)
+        self.assertTrue(all(read_filter.keep(*read) for read in reads))
+
+    def testFastqRecords(self):
+        records = list(fastqRecords(StringIO("@r1\nACGT\n+\n????\n@r2\nAC\n+\n55\n")))
+        self.assertEqual(records, [["@r1", "ACGT", "+", "????"], ["@r2", "AC", "+", "55"]])
+        with self.assertRaises(RuntimeError):
+            list(fastqRecords(StringIO("@r1\nACGT\n+\n")))
+
+
+class FingerprintTests(unittest.TestCase):
+    ALIGNMENT_STAGES = ["input", "chained", "trainedmodel", "realigned"]
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.sample  = namedtuple("Sample", ["URL", "file_type"])(self.write("reads.fq", "@r\nACGT\n+\n????\n"), "fq")
+        self.config  = {key: "value" for keys in STAGE_CONFIG_KEYS.values() for key in keys}
+        self.config.update(incremental=True, chain=True, EM=True, realign=True, target_regions=None,
+                           ref=self.write("ref.fa", ">chr1\nACGT\n"), hmm_file=self.write("model.hmm", "hmm"),
+                           error_model=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def write(self, filename, contents):
+        path = os.path.join(self.workdir, filename)
+        with open(path, "w") as fH:
+            fH.write(contents)
+        return "file://" + path
+
+    def fingerprints(self, **changes):
+        config = dict(self.config, **changes)
+        config["fingerprints"] = computeStageFingerprints(config, self.sample)
+        stages = {stage: config["fingerprints"][stage] for stage in self.ALIGNMENT_STAGES}
+        for kind in ("expectations", "calls"):
+            stages[kind] = callsFingerprint(config, "realigned", "label", kind=kind)
+        return stages
+
+    def changed(self, **changes):
+        before, after = self.fingerprints(), self.fingerprints(**changes)
+        return sorted(stage for stage in before if before[stage] != after[stage])
+
+    def testEachKeyChangesItsStage(self):
+        for kind, keys in STAGE_CONFIG_KEYS.items():
+            for key in keys:
+                self.assertNotEqual(stageDigest(kind, self.config, ["upstream"]),
+                                    stageDigest(kind, dict(self.config, **{key: "changed"}), ["upstream"]),
+                                    msg="{} doesn't change {}".format(key, kind))
+        self.assertEqual(stageDigest("calls", self.config, ["upstream"]),
+                         stageDigest("calls", dict(self.config, output_dir="elsewhere"), ["upstream"]))
+
+    def testUpstreamChangesPropagate(self):
+        downstream = self.ALIGNMENT_STAGES + ["calls", "expectations"]
+        for n, stage in enumerate(self.ALIGNMENT_STAGES):
+            # a key that's only used by this stage changes it and everything after it
+            key = next(key for key in STAGE_CONFIG_KEYS[stage] if
+                       not any(key in STAGE_CONFIG_KEYS[other] for other in downstream if other != stage))
+            self.assertEqual(self.changed(**{key: "changed"}), sorted(downstream[n:]), msg=key)
+
+    def testVariantThresholdOnlyChangesTheCalls(self):
+        self.assertEqual(self.changed(variant_threshold="changed"), ["calls"])
+        self.assertEqual(self.changed(no_margin="changed"), ["calls", "expectations"])
+
+    def testInputContent(self):
+        before = self.fingerprints()
+        self.write("reads.fq", "@r\nACGA\n+\n????\n")
+        after  = self.fingerprints()
+        self.assertTrue(all(after[stage] != before[stage] for stage in before))
+        self.write("ref.fa", ">chr1\nACGA\n")
+        self.assertNotEqual(self.fingerprints()["chained"], after["chained"])
+
+    def testNotIncremental(self):
+        self.assertEqual(set(computeStageFingerprints(dict(self.config, incremental=False), self.sample).values()),
+                         {None})
+
+    def testInputDigest(self):
+        url    = self.write("input.txt", "some content")
+        digest = inputDigest(url)
+        self.assertEqual(inputDigest(self.write("copy.txt", "some content")), digest)
+        self.write("input.txt", "other content")
+        self.assertNotEqual(inputDigest(url), digest)
+        self.assertEqual(inputDigest(None), "")
+
+
+class StubSegment(object):
+    """the parts of a pysam AlignedSegment that the prefilter looks at
+    """
+    def __init__(self, cigartuples, nm=None, mapping_quality=60):
+        self.cigartuples            = cigartuples
+        self.mapping_quality        = mapping_quality
+        self.query_alignment_length = sum(length for op, length in cigartuples if op in (0, 1, 7, 8))
+        self.tags                   = {} if nm is None else {"NM": nm}
+
+    def has_tag(self, tag):
+        return tag in self.tags
+
+    def get_tag(self, tag):
+        return self.tags[tag]
+
+
+class PrefilterTests(unittest.TestCase):
+    config = {"prefilter_min_length": 100, "prefilter_min_mapq": 30, "prefilter_min_identity": 0.9}
+
+    def testIdentityFromNM(self):
+        # 95 M, 5 I: 100 columns, NM counts the mismatches and the inserted bases
+        self.assertAlmostEqual(alignmentIdentity(StubSegment([(4, 10), (0, 95), (1, 5)], nm=8)), 0.92)
+
+    def testIdentityFromTheCigarWithoutNM(self):
+        self.assertAlmostEqual(alignmentIdentity(StubSegment([(7, 90), (8, 6), (2, 4)])), 0.9)
+        self.assertIsNone(alignmentIdentity(StubSegment([(0, 100)])))  # M doesn't say what's a match
+        self.assertIsNone(alignmentIdentity(StubSegment([(4, 100)], nm=0)))  # no aligned columns
+
+    def testConfidentAlignmentIsPassedThrough(self):
+        self.assertFalse(needsRealignment(self.config, StubSegment([(0, 100)], nm=10)))
+
+    def testThresholds(self):
+        self.assertTrue(needsRealignment(self.config, StubSegment([(0, 99)], nm=0)))                      # length
+        self.assertTrue(needsRealignment(self.config, StubSegment([(0, 100)], nm=0, mapping_quality=29)))  # MAPQ
+        self.assertTrue(needsRealignment(self.config, StubSegment([(0, 100)], nm=11)))                    # identity
+        self.assertFalse(needsRealignment(self.config, StubSegment([(0, 100)], nm=0, mapping_quality=30)))
+
+    def testMissingNMIsRealigned(self):
+        self.assertTrue(needsRealignment(self.config, StubSegment([(0, 200)])))
+        self.assertFalse(needsRealignment(self.config, StubSegment([(7, 200)])))
+
+
+class LiveTests(unittest.TestCase):
+    def setUp(self):
+        self.watch_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.watch_dir)
+
+    def chunk(self, filename, age):
+        path = os.path.join(self.watch_dir, filename)
+        open(path, "w").close()
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def testNewChunks(self):
+        self.chunk("b.fq", 100)
+        self.chunk("a.fastq", 200)
+        self.chunk("c.fq", 1)        # still being written
+        self.chunk("d.fq", 300)      # processed already
+        self.chunk("notes.txt", 100)
+        os.mkdir(os.path.join(self.watch_dir, "dir.fq"))
+        self.assertEqual(newChunks(self.watch_dir, {"d.fq"}, 30), ["a.fastq", "b.fq"])  # oldest first
+        self.assertEqual(newChunks(self.watch_dir, {"d.fq"}, 0), ["a.fastq", "b.fq", "c.fq"])
+
+    def testChunkLabel(self):
+        self.assertEqual(chunkLabel("run", "reads_0.fastq"), "run_reads_0")
+        self.assertEqual(chunkLabel("run", "reads_0.fq"), "run_reads_0")
+
+    def testContigFilename(self):
+        self.assertEqual(contigFilename("chr1"), "chr1")
+        # both are made chr1_2, the digests keep their files apart
+        self.assertNotEqual(contigFilename("chr1:2"), contigFilename("chr1|2"))
+        self.assertTrue(contigFilename("chr1:2").startswith("chr1_2-"))
+
+    def testBlocksSplitAtTheBoundary(self):
+        blocks = splitIntoBlocks({"chr1": {LIVE_BLOCK_LENGTH - 1: [1, 0, 0, 0], LIVE_BLOCK_LENGTH: [0, 1, 0, 0]}}, {})
+        self.assertEqual(blocks, {("chr1", 0): {LIVE_BLOCK_LENGTH - 1: [1, 0, 0, 0]},
+                                  ("chr1", 1): {LIVE_BLOCK_LENGTH: [0, 1, 0, 0]}})
+        self.assertNotEqual(liveBlockFilename("run", "chr1", 0, "expectations"),
+                            liveBlockFilename("run", "chr1", 1, "expectations"))
+
+    def testChunkIsOnlyAddedOnce(self):
+        block_totals = {"chunks": set(), "totals": {}}
+        self.assertTrue(addChunkTotals(block_totals, "run_a", {5: [1.0, 0.0, 0.0, 0.0]}))
+        self.assertTrue(addChunkTotals(block_totals, "run_b", {5: [1.0, 2.0, 0.0, 0.0]}))
+        self.assertFalse(addChunkTotals(block_totals, "run_a", {5: [1.0, 0.0, 0.0, 0.0]}))
+        self.assertEqual(block_totals, {"chunks": {"run_a", "run_b"}, "totals": {5: [2.0, 2.0, 0.0, 0.0]}})
+
+
+class PosteriorCacheTests(unittest.TestCase):
+    config = {"gap_gamma": 0.5, "match_gamma": 0.0, "band_width": None}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache     = PosteriorCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def batch(self, sequence="ACGTAC", cigar="M 6", tstart=2, contig_seq="TTACGTACTT", label="read"):
+        return {"exonerate_cigars": ["cigar: {label} 0 6 + chr1 {s} {e} + 1 {cigar}\n".format(
+                    label=label, s=tstart, e=tstart + 6, cigar=cigar)],
+                "query_sequences" : [sequence + "\n"],
+                "query_labels"    : [label + "\n"],
+                "contig_seq"      : contig_seq}
+
+    def key(self, hmm="hmm", config=None, **batch):
+        return realignCacheKeys(dict(self.config, **(config or {})), self.batch(**batch), hmm).values()[0]
+
+    def testDigest(self):
+        self.assertEqual(digest("a", 1), digest("a", 1))
+        self.assertNotEqual(digest("a", 1), digest("a1"))
+        self.assertNotEqual(digest("ab", "c"), digest("a", "bc"))
+
+    def testReadKeyIgnoresTheReadName(self):
+        self.assertEqual(readKeys(self.batch(label="uid1")), readKeys(self.batch(label="uid2")))
+
+    def testKeyChangesWithEverythingThatGoesIntoIt(self):
+        key = self.key()
+        self.assertEqual(self.key(), key)
+        self.assertNotEqual(self.key(sequence="ACGTAA"), key)
+        self.assertNotEqual(self.key(cigar="M 5 I 1"), key)
+        self.assertNotEqual(self.key(tstart=1), key)
+        self.assertNotEqual(self.key(contig_seq="TTACGAACTT"), key)  # same coordinates, different reference
+        self.assertEqual(self.key(contig_seq="GGACGTACGG"), key)     # only the window the read covers
+        self.assertNotEqual(self.key(hmm="other hmm"), key)
+        self.assertNotEqual(self.key(config={"gap_gamma": 0.2}), key)
+        self.assertNotEqual(self.key(config={"match_gamma": 0.2}), key)
+        self.assertNotEqual(self.key(config={"band_width": 20, "band_trim": 4}), key)
+
+    def testGetAndPut(self):
+        self.assertIsNone(self.cache.get("ab12"))
+        self.cache.put("ab12", "posteriors")
+        self.cache.put("ab12", "posteriors")  # a second writer of the same key
+        self.assertEqual(self.cache.get("ab12"), "posteriors")
+        self.assertEqual(os.listdir(os.path.join(self.directory, "ab")), ["ab12.entry"])
+
+    def testEvictsTheLeastRecentlyUsed(self):
+        for age, key in enumerate(["new", "mid", "old"]):
+            self.cache.put(key, "x" * 10)
+            mtime = time.time() - 100 * (age + 1)
+            os.utime(self.cache._path(key), (mtime, mtime))
+        self.cache.get("old")  # used now, so it's the most recent
+        self.assertEqual(self.cache.evict(20), (1, 10))
+        self.assertIsNone(self.cache.get("mid"))
+        self.assertEqual(self.cache.evict(0), (2, 20))
+        self.assertEqual(self.cache.evict(0), (0, 0))
+
+
+class ResourceModelTests(unittest.TestCase):
+    FileStoreID = namedtuple("FileStoreID", ["size"])
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.config  = {"resource_history": os.path.join(self.workdir, "history.jsonl"), "resource_safety_margin": 1.5}
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def record(self, stage="caller_shard", input_bytes=100, peak_rss=1000, failed=False, counts=None):
+        return {"stage": stage, "input_bytes": input_bytes, "peak_rss": peak_rss, "peak_rss_scope": "job",
+                "requested_memory": 4000, "bytes_read": 10, "bytes_written": 20, "local_disk": 50,
+                "failed": failed, "counts": counts or {}}
+
+    def testEnvelopeIsAboveTheQuantile(self):
+        rng    = random.Random(7)
+        points = [(x, 3 * x + 100 + rng.gauss(0, 50)) for x in range(0, 1000, 10)]
+        points.append((500, 100000))  # an outlier doesn't pull the line up
+        intercept, slope = fitEnvelope(points, 0.9)
+        above = sum(1 for x, y in points if intercept + slope * x >= y - 1e-6)
+        self.assertGreaterEqual(above, 0.9 * len(points))
+        self.assertLess(above, len(points))
+        self.assertAlmostEqual(slope, 3, delta=0.5)
+
+    def testSlopeIsNeverNegative(self):
+        intercept, slope = fitEnvelope([(x, 1000 - x) for x in range(100)], 1.0)
+        self.assertEqual(slope, 0.0)
+        self.assertGreaterEqual(intercept, 1000)
+
+    def testHistorySkipsFailedJobsButNotOutOfMemory(self):
+        appendResourceHistory(self.config, [self.record(), self.record(failed=True),
+                                            self.record(failed=True, counts={"oom": 1})])
+        history = loadHistory(self.config["resource_history"])
+        self.assertEqual([entry["memory"] for entry in history], [1000, 8000])  # oom is twice what it had
+        self.assertEqual(history[0]["disk"], 50)
+
+    def testHistoryIsTrimmedPerStage(self):
+        appendResourceHistory(self.config, [self.record(input_bytes=n) for n in range(HISTORY_PER_STAGE + 10)])
+        appendResourceHistory(self.config, [self.record(stage="chain")])
+        history = loadHistory(self.config["resource_history"])
+        shards  = [entry["input_bytes"] for entry in history if entry["stage"] == "caller_shard"]
+        self.assertEqual(shards, range(10, HISTORY_PER_STAGE + 10))  # the oldest are dropped
+        self.assertEqual(len(history), HISTORY_PER_STAGE + 1)
+
+    def testPredictedResources(self):
+        config = dict(self.config, resource_model={"caller_shard": {"memory": (0.0, 2.0), "disk": (-100.0, 0.0)}})
+        # the input size is from the arguments the way the telemetry works it out, e.g. a list of sizes
+        requested = predictedResources(config, "caller_shard", ([self.FileStoreID(1000 << 20)],), memory=1, disk=1)
+        self.assertEqual(requested["memory"], int(1.5 * 2 * (1000 << 20)))
+        self.assertEqual(requested["disk"], RESOURCE_FLOORS["disk"])
+        self.assertEqual(parseUnitName(requested["name"]), ("caller_shard", 1000 << 20))
+        # the built-in estimates for stages the model doesn't cover
+        self.assertEqual(predictedResources(config, "chain", (), memory=5, disk=None),
+                         {"memory": 5, "name": jobUnitName("chain", 0)})
+
+    def testKilledJobIsCountedAsOutOfMemory(self):
+        job_node  = namedtuple("JobNode", ["jobName", "unitName", "jobStoreID", "memory", "disk"])
+        collector = TelemetryCollector()
+        shard     = jobUnitName("caller_shard", 100)
+        for exit_value, node in [(-9, job_node("callerShardJobFunction", shard, "a", 4000, 0)),
+                                 (137, job_node("cPecanRealignJobFunction", None, "b", 4000, 0)),
+                                 (1, job_node("chainSamFileJobFunction", None, "c", 4000, 0))]:
+            collector.emit(logging.makeLogRecord({"msg": TOIL_JOB_FAILED, "args": (exit_value, node)}))
+        self.assertEqual([job["job_store_id"] for job in collector.killedJobs()], ["a", "b"])
+        appendResourceHistory(self.config, collector.records)
+        # the one whose input size is unknown can't be used
+        self.assertEqual(loadHistory(self.config["resource_history"]),
+                         [{"stage": "caller_shard", "input_bytes": 100, "memory": 8000, "disk": None,
+                           "peak_rss_scope": None}])
+
+
+class ProgressTests(unittest.TestCase):
+    def stage(self, **fields):
+        stage = {"jobs": 1, "failed": 0, "shards_done": 10, "shards_issued": 0, "reads": 200, "bases": 2000,
+                 "first_start": 100.0, "last_finish": 110.0}
+        stage.update(fields)
+        return stage
+
+    def record(self, stage, wall_time=1.0, **counts):
+        return {"stage": stage, "wall_time": wall_time, "failed": False, "counts": counts}
+
+    def testRatesAndEta(self):
+        reads, bases, shards, eta = stageRates(self.stage(shards_issued=30), 120.0)
+        self.assertEqual((reads, bases, shards), (10.0, 100.0, 0.5))
+        self.assertEqual(eta, 40.0)  # 20 shards to go at 0.5 a second
+
+    def testNoEtaWithoutIssuedCounts(self):
+        self.assertIsNone(stageRates(self.stage(), 120.0)[3])
+        self.assertIsNone(stageRates(self.stage(shards_issued=30, shards_done=0), 120.0)[3])
+        self.assertEqual(stageRates(self.stage(first_start=None), 120.0), (0.0, 0.0, 0.0, None))
+
+    def testFormatStatus(self):
+        progress = {"sample": {"started": 100.0, "updated": 110.0, "finished": None,
+                               "stages": {"caller_shard": self.stage(shards_issued=30),
+                                          "chain": self.stage(first_start=50.0, last_finish=60.0)}}}
+        lines    = formatStatus(progress, now=120.0).split("\n")
+        self.assertEqual(lines[1], "sample\trunning, updated 0:00:10 ago")
+        self.assertEqual(lines[2].split("\t"), ["sample", "chain", "10/?", "1", "0", "2.9", "29", "-", "0:01:00"])
+        # idle is the time since the stage's last job finished
+        self.assertEqual(lines[3].split("\t"), ["sample", "caller_shard", "10/30", "1", "0", "10.0", "100",
+                                                "0:00:40", "0:00:10"])
+        self.assertEqual(formatStatus(progress, sample_labels=["other"], now=120.0).count("\n"), 0)
+
+    def testIssuedCountsGoToTheirStage(self):
+        tracker = ProgressTracker(None, "sample")
+        tracker.update(self.record("caller", issued_caller_shard=3, issued_shard_group=2))
+        tracker.update(self.record("caller_shard", shards=1, reads=5))
+        tracker.update(self.record("caller_shard", shards=1, reads=5))
+        stages = tracker.sample["stages"]
+        self.assertEqual((stages["caller_shard"]["shards_issued"], stages["caller_shard"]["shards_done"]), (3, 2))
+        self.assertEqual(stages["shard_group"]["shards_issued"], 2)
+        self.assertEqual(stages["caller"]["shards_issued"], 0)
+        self.assertEqual((stages["caller_shard"]["jobs"], stages["caller_shard"]["reads"]), (2, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Per-call overhead of the tool_backend choices for toil-nanopore
+
+Runs a trivial samtools call (printing the header of a small BAM) many times with each tool_backend: a fresh
+container per call (docker), `docker exec` into one long-lived container (container) and, when samtools is
+on the PATH, the native executable (native). The time of a call is almost all startup, which is what the
+shard, sharding and conversion jobs pay on every call. Run from the root of the repo, e.g.:
+    python tests/toolBackendBenchmark.py --calls 20
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from distutils.spawn import find_executable
+
+DEVNULL = open(os.devnull, 'w')
+
+
+def time_calls(command, calls):
+    timings = []
+    for _ in range(calls):
+        start = time.time()
+        subprocess.check_call(command, stdout=DEVNULL, stderr=DEVNULL)
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--alignment", default="tests/bwa_bam.bam")
+    parser.add_argument("--image", default="quay.io/ucsc_cgl/samtools")
+    parser.add_argument("--calls", type=int, default=10, help="calls per backend, the median is reported")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=os.getcwd())
+    name    = "toil-nanopore-benchmark-{}".format(os.getpid())
+    try:
+        shutil.copy(args.alignment, os.path.join(workdir, "alignment.bam"))
+        entrypoint = subprocess.check_output(["docker", "inspect", "-f", "{{join .Config.Entrypoint \" \"}}",
+                                              args.image]).split()
+        subprocess.check_call(["docker", "run", "-d", "--rm", "--name", name, "-v", "{d}:{d}".format(d=workdir),
+                               "--entrypoint", "sleep", args.image, "3600"], stdout=DEVNULL)
+        benchmarks = [
+            ("docker", ["docker", "run", "--rm", "--log-driver=none", "-v", "{}:/data".format(workdir),
+                        args.image, "view", "-H", "/data/alignment.bam"]),
+            ("container", ["docker", "exec", "-w", workdir, name] + entrypoint +
+                          ["view", "-H", os.path.join(workdir, "alignment.bam")]),
+        ]
+        if find_executable("samtools"):
+            benchmarks.append(("native", ["samtools", "view", "-H", os.path.join(workdir, "alignment.bam")]))
+        else:
+            print("[toolBackendBenchmark]samtools isn't on the PATH, skipping native", file=sys.stderr)
+
+        print("tool_backend\tmedian_seconds_per_call")
+        for label, command in benchmarks:
+            print("%s\t%.3f" % (label, time_calls(command, args.calls)))
+            sys.stdout.flush()
+    finally:
+        subprocess.call(["docker", "rm", "-f", name], stdout=DEVNULL, stderr=DEVNULL)
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()